@@ -0,0 +1,215 @@
+import os
+import shutil
+import time
+import argparse
+from dotenv import load_dotenv
+
+from rag_chunking import DocumentSplitter
+from rag_embeddings import embedding_settings, make_embeddings
+from rag_loaders import list_upload_files, load_files_parallel, print_load_summary
+from rag_index_manifest import IndexManifest, assign_chunk_ids
+from rag_ingest import IngestCheckpoint, add_ingest_arguments, stream_ingest
+from rag_notion_sync import ChangeList
+from rag_lexical import write_lexical_index
+from rag_vectorstores import Chroma, ChromaWriter, FaissWriter, MultiWriter, store_chunk_ids
+from rag_faiss_index import DEFAULT_INDEX_SPEC, DEFAULT_TRAIN_SAMPLE, settings_changed
+
+# Load environment variables
+load_dotenv()
+
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
+BACKEND_DIRS = {"faiss": "faiss_db", "chroma": "chroma_db"}
+DEFAULT_BACKENDS = "faiss,chroma"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="從 uploaded_docs 建立向量資料庫：只載入、切割與計算一次 embeddings，同時寫入 FAISS 與 Chroma")
+    add_ingest_arguments(parser)
+    parser.add_argument("--backends", default=os.getenv("RAG_BACKENDS", DEFAULT_BACKENDS),
+                        help="要寫入的 backend，以逗號分隔（faiss、chroma）")
+    parser.add_argument("--index-spec", default=os.getenv("RAG_FAISS_INDEX", DEFAULT_INDEX_SPEC),
+                        help='FAISS index_factory 字串，例如 "Flat"、"HNSW32"、"IVF256,Flat"、"PCA256,SQfp16"')
+    parser.add_argument("--search-params", default=os.getenv("RAG_FAISS_SEARCH_PARAMS", ""),
+                        help='FAISS 查詢參數，例如 "efSearch=64"、"nprobe=16" 或 "rescore=4"')
+    parser.add_argument("--train-sample", type=int, default=DEFAULT_TRAIN_SAMPLE,
+                        help="IVF/PQ 訓練時最多抽樣的向量數")
+    parser.add_argument("--no-zip", action="store_true", help="不要壓縮各資料夾")
+    return parser.parse_args()
+
+
+def parse_backends(value):
+    backends = [b.strip().lower() for b in value.split(",") if b.strip()]
+    unknown = [b for b in backends if b not in BACKEND_DIRS]
+    if unknown or not backends:
+        raise SystemExit(f"未知的 backend: {', '.join(unknown) or value}（可用：{', '.join(BACKEND_DIRS)}）")
+    return list(dict.fromkeys(backends))
+
+
+def load_shared_manifest(store_dirs):
+    """每個 backend 資料夾各有一份 manifest；內容一致時才能共用同一個增量計畫。
+
+    回傳 (manifest, 無法增量的原因或 None)；manifest 存檔時會同步寫入所有資料夾。
+    """
+    manifests = [IndexManifest.load(d, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                     **embedding_settings()) for d in store_dirs]
+    manifest = manifests[0]
+    reason = next((f"{d}: {m.reset_reason}" for d, m in zip(store_dirs, manifests) if m.reset_reason), None)
+    if reason is None and any(m.files != manifest.files for m in manifests[1:]):
+        reason = "各 backend 的 manifest 內容不同"
+    manifest.mirror_paths = [m.path for m in manifests[1:]]
+    return manifest, reason
+
+
+def verify_backends(writers, manifest):
+    """確認每個 backend 內的 chunk ID 與 manifest 完全相同。"""
+    expected = set(manifest.all_chunk_ids())
+    ok = True
+    for w in writers:
+        ids = store_chunk_ids(w.store)
+        if ids == expected:
+            print(f"✅ {w.name}: {len(ids)} 個區塊，與 manifest 一致。")
+            continue
+        ok = False
+        print(f"❌ {w.name}: {len(ids)} 個區塊，缺少 {len(expected - ids)} 個、多出 {len(ids - expected)} 個。")
+    return ok
+
+
+def print_stage_timings(timings):
+    print("各階段耗時：")
+    for stage, seconds in timings.items():
+        print(f"  {stage:<16} {seconds:8.2f}s")
+
+
+def main():
+    args = parse_args()
+    backends = parse_backends(args.backends)
+    if "chroma" in backends and Chroma is None:
+        print("找不到 Chroma vectorstore 套件 (chromadb). 請先安裝 chromadb，或改用 --backends faiss。")
+        return
+
+    upload_dir = "uploaded_docs"
+    if not os.path.exists(upload_dir):
+        print(f"資料夾 '{upload_dir}' 不存在。請先將文件放到該資料夾後再執行。")
+        return
+    files, skipped = list_upload_files(upload_dir)
+    for fn in skipped:
+        print(f"跳過不支援的檔案: {fn}")
+    if not files and not args.incremental:
+        print(f"資料夾 '{upload_dir}' 目前為空。請放入 .txt/.pdf/.docx 文件後再執行。")
+        return
+
+    store_dirs = [BACKEND_DIRS[b] for b in backends]
+    primary_dir = store_dirs[0]
+    manifest, reset_reason = load_shared_manifest(store_dirs)
+    resume = args.stream and IngestCheckpoint(primary_dir).exists() and not reset_reason
+    changes = ChangeList.load(args.changes) if args.changes else None
+    incremental = (args.incremental or changes is not None or resume) and not reset_reason
+    if resume:
+        print("發現未完成的串流建置 checkpoint，將從中斷處繼續。")
+    elif (args.incremental or changes is not None) and not incremental:
+        print(f"無法增量更新（{reset_reason}），改為完整重建。")
+    if not incremental:
+        for store_dir in store_dirs:
+            IngestCheckpoint(store_dir).clear()
+        if "chroma" in backends and os.path.exists(BACKEND_DIRS["chroma"]):
+            print(f"發現既有 {BACKEND_DIRS['chroma']}，將會覆寫它。")
+            shutil.rmtree(BACKEND_DIRS["chroma"])
+        mirrors = manifest.mirror_paths
+        manifest = IndexManifest(manifest.path, manifest.settings)
+        manifest.mirror_paths = mirrors
+
+    only = changes.filenames() if changes is not None and incremental else None
+    plan = manifest.plan(upload_dir, files, only=only)
+    print(f"檔案比對結果：{plan.summary()}")
+    faiss_dir = BACKEND_DIRS["faiss"]
+    spec_changed = incremental and "faiss" in backends and os.path.isdir(faiss_dir) and \
+        settings_changed(faiss_dir, args.index_spec, args.search_params)
+    if incremental and plan.is_empty and not resume and not spec_changed:
+        print("索引已是最新，不需重新計算 embeddings。")
+        if changes is not None:
+            changes.clear()
+        return
+
+    start = time.perf_counter()
+    embedding_model = make_embeddings()
+    writers = []
+    for backend in backends:
+        if backend == "faiss":
+            writers.append(FaissWriter(faiss_dir, embedding_model, load_existing=incremental,
+                                       index_spec=args.index_spec, search_params=args.search_params,
+                                       train_sample=args.train_sample))
+        else:
+            writers.append(ChromaWriter(BACKEND_DIRS["chroma"], embedding_model))
+    writer = MultiWriter(writers, embedding_model)
+    splitter = DocumentSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    timings = {"setup": time.perf_counter() - start}
+    print(f"寫入 backend：{', '.join(f'{b} -> {d}' for b, d in zip(backends, store_dirs))}")
+
+    start = time.perf_counter()
+    if args.stream:
+        stream_ingest(writer, manifest, plan, upload_dir, splitter, batch_size=args.batch_size,
+                      workers=args.workers, checkpoint_every=args.checkpoint_every)
+    else:
+        stale_ids = manifest.chunk_ids(plan.removed + plan.changed)
+        for fn in plan.removed:
+            manifest.forget(fn)
+        results = load_files_parallel(upload_dir, plan.to_index, workers=args.workers)
+        print_load_summary(results, time.perf_counter() - start)
+        split_docs, split_ids = [], []
+        for result in results:
+            fn = result.fn
+            manifest.forget(fn)
+            if result.error:
+                print(f"載入 {fn} 失敗: {result.error}")
+                continue
+            chunks = splitter.split_documents(result.docs)
+            ids = assign_chunk_ids(chunks, fn, plan.hashes[fn])
+            split_docs.extend(chunks)
+            split_ids.extend(ids)
+            manifest.record(fn, plan.hashes[fn], result.loader, len(result.docs), ids)
+        print(f"已分割成 {len(split_docs)} 個區塊。")
+
+        deleted = writer.delete(stale_ids)
+        if deleted:
+            print(f"已刪除 {deleted} 個過期區塊。")
+        writer.add(split_docs, split_ids)
+        writer.flush()
+        manifest.save()
+    # 串流模式的載入與切割跟寫入交錯進行，扣掉 embedding/寫入/存檔的時間即為載入 + 切割
+    timings["load + split"] = time.perf_counter() - start - sum(writer.timings.values())
+    timings.update(writer.timings)
+
+    if writer.store is None:
+        print("沒有載入任何文件。結束程式。")
+        return
+
+    start = time.perf_counter()
+    for w in writers:
+        # BM25 倒排索引（hybrid 檢索用）跟著每個向量資料庫一起存放
+        write_lexical_index(w.store, w.path)
+    timings["lexical"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ok = verify_backends(writers, manifest)
+    timings["verify"] = time.perf_counter() - start
+
+    if not args.no_zip:
+        start = time.perf_counter()
+        for store_dir in store_dirs:
+            shutil.make_archive(store_dir, "zip", store_dir)
+            print(f"✅ 已將 '{store_dir}' 壓縮為 '{store_dir}.zip'。")
+        timings["zip"] = time.perf_counter() - start
+
+    if ok and changes is not None:
+        changes.clear()
+    print(embedding_model.stats.report())
+    timings["total"] = sum(timings.values())
+    print_stage_timings(timings)
+    if not ok:
+        raise SystemExit("各 backend 的區塊不一致，請以完整重建（不加 --incremental）修復。")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,103 +1,126 @@
 import os
 import shutil
+import time
+import argparse
 from dotenv import load_dotenv
 
 # Document loaders and splitters
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, UnstructuredWordDocumentLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from rag_chunking import DocumentSplitter
 
-# Embeddings
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from rag_loaders import list_upload_files, load_files_parallel, print_load_summary
+from rag_index_manifest import IndexManifest, assign_chunk_ids
+from rag_ingest import IngestCheckpoint, add_ingest_arguments, stream_ingest
+from rag_notion_sync import ChangeList
+from rag_lexical import write_lexical_index
 
-# Try to import Chroma from community or core
-try:
-    from langchain_community.vectorstores import Chroma
-except Exception:
-    try:
-        from langchain.vectorstores import Chroma
-    except Exception:
-        Chroma = None
+# Embeddings (shared E5 wrapper with on-disk cache)
+from rag_embeddings import embedding_settings, make_embeddings
+
+# Chroma may be unavailable (chromadb not installed)
+from rag_vectorstores import Chroma, ChromaWriter
 
 # Load environment
 load_dotenv()
 
-# E5 embeddings wrapper (keeps passage/query prefixes)
-class E5Embeddings(HuggingFaceEmbeddings):
-    def __init__(self, **kwargs):
-        super().__init__(
-            model_name="intfloat/multilingual-e5-large",
-            encode_kwargs={"normalize_embeddings": True},
-            **kwargs,
-        )
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
 
-    def embed_documents(self, texts):
-        texts = [f"passage: {t}" for t in texts]
-        return super().embed_documents(texts)
 
-    def embed_query(self, text):
-        return super().embed_query(f"query: {text}")
+def parse_args():
+    parser = argparse.ArgumentParser(description="從 uploaded_docs 建立 Chroma 向量資料庫")
+    add_ingest_arguments(parser)
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
     upload_dir = "uploaded_docs"
     if not os.path.exists(upload_dir):
         print(f"資料夾 '{upload_dir}' 不存在。請先將文件放到該資料夾後再執行。")
         return
 
-    files = os.listdir(upload_dir)
-    if not files:
+    files, skipped = list_upload_files(upload_dir)
+    for fn in skipped:
+        print(f"跳過不支援的檔案: {fn}")
+    if not files and not args.incremental:
         print(f"資料夾 '{upload_dir}' 目前為空。請放入 .txt/.pdf/.docx 文件後再執行。")
         return
 
-    documents = []
-    for fn in files:
-        path = os.path.join(upload_dir, fn)
-        if fn.lower().endswith('.txt'):
-            loader = TextLoader(path, encoding='utf-8')
-        elif fn.lower().endswith('.pdf'):
-            loader = PyPDFLoader(path)
-        elif fn.lower().endswith('.docx'):
-            loader = UnstructuredWordDocumentLoader(path)
-        else:
-            print(f"跳過不支援的檔案: {fn}")
-            continue
-        try:
-            docs = loader.load()
-            documents.extend(docs)
-            print(f"已載入 {fn} -> {len(docs)} 文件片段")
-        except Exception as e:
-            print(f"載入 {fn} 失敗: {e}")
-
-    if not documents:
-        print("沒有載入任何文件。結束。")
-        return
-
-    # split
-    splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-    split_docs = splitter.split_documents(documents)
-    print(f"已分割成 {len(split_docs)} 個區塊。")
-
-    # embeddings
-    emb = E5Embeddings()
-
     if Chroma is None:
         print("找不到 Chroma vectorstore 套件 (chromadb). 請先安裝 chromadb。")
         return
 
     chroma_dir = "chroma_db"
+    manifest = IndexManifest.load(chroma_dir, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                  **embedding_settings())
+    resume = args.stream and IngestCheckpoint(chroma_dir).exists() and not manifest.reset_reason
+    changes = ChangeList.load(args.changes) if args.changes else None
+    incremental = (args.incremental or changes is not None or resume) and not manifest.reset_reason
+    if resume:
+        print("發現未完成的串流建置 checkpoint，將從中斷處繼續。")
+    elif (args.incremental or changes is not None) and not incremental and os.path.exists(chroma_dir):
+        print(f"無法增量更新（{manifest.reset_reason}），改為完整重建。")
     # Remove existing chroma dir if exists to create fresh index
-    if os.path.exists(chroma_dir):
-        print(f"發現既有 {chroma_dir}，將會覆寫它。")
-        shutil.rmtree(chroma_dir)
+    if not incremental:
+        if os.path.exists(chroma_dir):
+            print(f"發現既有 {chroma_dir}，將會覆寫它。")
+            shutil.rmtree(chroma_dir)
+        manifest = IndexManifest(manifest.path, manifest.settings)
+
+    only = changes.filenames() if changes is not None and incremental else None
+    plan = manifest.plan(upload_dir, files, only=only)
+    print(f"檔案比對結果：{plan.summary()}")
+    if plan.is_empty and not resume:
+        print("索引已是最新，不需重新計算 embeddings。")
+        if changes is not None:
+            changes.clear()
+        return
+
+    # embeddings
+    emb = make_embeddings()
+    splitter = DocumentSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
 
     print("建立 Chroma 向量資料庫... 這可能需要一些時間（計算 embeddings）")
     try:
-        vect = Chroma.from_documents(split_docs, embedding=emb, persist_directory=chroma_dir)
-        try:
-            vect.persist()
-        except Exception:
-            pass
+        writer = ChromaWriter(chroma_dir, emb)
+        if args.stream:
+            stream_ingest(writer, manifest, plan, upload_dir, splitter, batch_size=args.batch_size,
+                          workers=args.workers, checkpoint_every=args.checkpoint_every)
+        else:
+            # 先刪除已移除或已變更檔案的舊向量
+            deleted = writer.delete(manifest.chunk_ids(plan.removed + plan.changed))
+            if deleted:
+                print(f"已刪除 {deleted} 個過期區塊。")
+            for fn in plan.removed:
+                manifest.forget(fn)
+
+            start = time.perf_counter()
+            results = load_files_parallel(upload_dir, plan.to_index, workers=args.workers)
+            print_load_summary(results, time.perf_counter() - start)
+
+            total_chunks = 0
+            for result in results:
+                fn = result.fn
+                manifest.forget(fn)
+                if result.error:
+                    print(f"載入 {fn} 失敗: {result.error}")
+                    continue
+                print(f"已載入 {fn} -> {len(result.docs)} 文件片段")
+                chunks = splitter.split_documents(result.docs)
+                ids = assign_chunk_ids(chunks, fn, plan.hashes[fn])
+                writer.add(chunks, ids)
+                manifest.record(fn, plan.hashes[fn], result.loader, len(result.docs), ids)
+                total_chunks += len(chunks)
+            print(f"已分割並寫入 {total_chunks} 個區塊。")
+
+            writer.flush()
+            manifest.save()
+        # BM25 倒排索引（hybrid 檢索用）跟著向量資料庫一起存放
+        write_lexical_index(writer.store, chroma_dir)
         print(f"✅ Chroma 向量資料庫已儲存在 '{chroma_dir}'")
+        if changes is not None:
+            changes.clear()
+        print(emb.stats.report())
     except Exception as e:
         print(f"建立 Chroma 向量資料庫失敗: {e}")
         return
@@ -1,86 +1,154 @@
 import os
 import shutil
+import time
+import argparse
 from dotenv import load_dotenv
-from langchain_community.document_loaders import TextLoader, PyPDFLoader, UnstructuredWordDocumentLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
+from rag_chunking import DocumentSplitter
 from huggingface_hub import login
 
+from rag_embeddings import embedding_settings, make_embeddings
+from rag_loaders import list_upload_files, load_files_parallel, print_load_summary
+from rag_index_manifest import IndexManifest, assign_chunk_ids
+from rag_ingest import IngestCheckpoint, add_ingest_arguments, stream_ingest
+from rag_notion_sync import ChangeList
+from rag_lexical import write_lexical_index
+from rag_vectorstores import FaissWriter
+from rag_faiss_index import DEFAULT_INDEX_SPEC, DEFAULT_TRAIN_SAMPLE, settings_changed
+
 # Load environment variables
 load_dotenv()
 
-# 1. 建立資料夾
-upload_dir = "uploaded_docs"
-os.makedirs(upload_dir, exist_ok=True)
-print(f"請將你的 .txt, .pdf, .docx 檔案放到這個資料夾中： {upload_dir}")
-
-# Check if directory is empty
-if not os.listdir(upload_dir):
-    print(f"警告: {upload_dir} 資料夾是空的。請放入文件後再執行此程式。")
-    # We can choose to exit or continue (which will result in empty vector db)
-    # exit()
-
-# 3. 改用 E5 模型 (因為 Gemma 是 gated model，需要特殊權限)
-class E5Embeddings(HuggingFaceEmbeddings):
-    def __init__(self, **kwargs):
-        super().__init__(
-            model_name="intfloat/multilingual-e5-large",
-            encode_kwargs={"normalize_embeddings": True},
-            **kwargs
-        )
-
-    def embed_documents(self, texts):
-        # E5 文件前綴
-        texts = [f'passage: {t}' for t in texts]
-        return super().embed_documents(texts)
-
-    def embed_query(self, text):
-        # E5 查詢前綴
-        return super().embed_query(f'query: {text}')
-
-# ... (rest of the code)
-
-# 4. 載入文件
-folder_path = upload_dir
-documents = []
-for file in os.listdir(folder_path):
-    path = os.path.join(folder_path, file)
-    if file.endswith(".txt"):
-        loader = TextLoader(path, encoding='utf-8')
-    elif file.endswith(".pdf"):
-        loader = PyPDFLoader(path)
-    elif file.endswith(".docx"):
-        loader = UnstructuredWordDocumentLoader(path)
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="從 uploaded_docs 建立 FAISS 向量資料庫")
+    add_ingest_arguments(parser)
+    parser.add_argument("--index-spec", default=os.getenv("RAG_FAISS_INDEX", DEFAULT_INDEX_SPEC),
+                        help='FAISS index_factory 字串，例如 "Flat"、"HNSW32"、"IVF256,Flat"、"IVF256,PQ64"、"PCA256,SQfp16"')
+    parser.add_argument("--search-params", default=os.getenv("RAG_FAISS_SEARCH_PARAMS", ""),
+                        help='查詢參數，例如 "efSearch=64"（HNSW）、"nprobe=16"（IVF）或 "rescore=4"（以原始向量重排），會存在索引旁供載入時套用')
+    parser.add_argument("--train-sample", type=int, default=DEFAULT_TRAIN_SAMPLE,
+                        help="IVF/PQ 訓練時最多抽樣的向量數")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # 1. 建立資料夾
+    upload_dir = "uploaded_docs"
+    os.makedirs(upload_dir, exist_ok=True)
+    print(f"請將你的 .txt, .pdf, .docx 檔案放到這個資料夾中： {upload_dir}")
+
+    # Check if directory is empty
+    if not os.listdir(upload_dir):
+        print(f"警告: {upload_dir} 資料夾是空的。請放入文件後再執行此程式。")
+
+    files, _ = list_upload_files(upload_dir)
+
+    # 2. 比對 manifest，決定要重新處理哪些檔案
+    faiss_dir = "faiss_db"
+    manifest = IndexManifest.load(faiss_dir, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                                  **embedding_settings())
+    resume = args.stream and IngestCheckpoint(faiss_dir).exists() and not manifest.reset_reason
+    changes = ChangeList.load(args.changes) if args.changes else None
+    incremental = (args.incremental or changes is not None or resume) and not manifest.reset_reason
+    if resume:
+        print("發現未完成的串流建置 checkpoint，將從中斷處繼續。")
+    elif (args.incremental or changes is not None) and not incremental and os.path.exists(faiss_dir):
+        print(f"無法增量更新（{manifest.reset_reason}），改為完整重建。")
+    if not incremental:
+        manifest = IndexManifest(manifest.path, manifest.settings)
+        IngestCheckpoint(faiss_dir).clear()
+
+    only = changes.filenames() if changes is not None and incremental else None
+    plan = manifest.plan(upload_dir, files, only=only)
+    print(f"檔案比對結果：{plan.summary()}")
+    # 只改了索引類型或查詢參數時不需要重新計算 embeddings，但仍要重建 ANN 索引
+    spec_changed = incremental and os.path.isdir(faiss_dir) and \
+        settings_changed(faiss_dir, args.index_spec, args.search_params)
+    if spec_changed:
+        print(f"索引設定變更為 {args.index_spec} {args.search_params}".rstrip() + "，將重建索引。")
+    if incremental and plan.is_empty and not resume and not spec_changed:
+        print("索引已是最新，不需重新計算 embeddings。")
+        if changes is not None:
+            changes.clear()
+        return
+
+    splitter = DocumentSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+    # Login to HuggingFace
+    hf_token = os.getenv('HUGGINGFACE_TOKEN')
+    if hf_token:
+        login(token=hf_token)
     else:
-        continue
-    documents.extend(loader.load())
+        print("警告: 未找到 HUGGINGFACE_TOKEN 環境變數。")
+
+    embedding_model = make_embeddings()
+    writer = FaissWriter(faiss_dir, embedding_model, load_existing=incremental, index_spec=args.index_spec,
+                         search_params=args.search_params, train_sample=args.train_sample)
+
+    if args.stream:
+        # 4-6. 串流模式：邊載入邊切割、分批 embedding 並寫入，定期存檔
+        stream_ingest(writer, manifest, plan, upload_dir, splitter, batch_size=args.batch_size,
+                      workers=args.workers, checkpoint_every=args.checkpoint_every)
+        if writer.store is None:
+            print("沒有載入任何文件。結束程式。")
+            return
+    else:
+        # 已移除或已變更檔案的舊向量，稍後從索引中刪除
+        stale_ids = manifest.chunk_ids(plan.removed + plan.changed)
+        for fn in plan.removed:
+            manifest.forget(fn)
+
+        # 4. 載入文件（未變更的檔案不會執行 loader）
+        split_docs, split_ids = [], []
+        loaded = 0
+        start = time.perf_counter()
+        results = load_files_parallel(upload_dir, plan.to_index, workers=args.workers)
+        print_load_summary(results, time.perf_counter() - start)
+        for result in results:
+            fn = result.fn
+            if result.error:
+                print(f"載入 {fn} 失敗: {result.error}")
+                manifest.forget(fn)
+                continue
+            loaded += len(result.docs)
+            chunks = splitter.split_documents(result.docs)
+            ids = assign_chunk_ids(chunks, fn, plan.hashes[fn])
+            split_docs.extend(chunks)
+            split_ids.extend(ids)
+            manifest.record(fn, plan.hashes[fn], result.loader, len(result.docs), ids)
 
-if not documents:
-    print("沒有載入任何文件。結束程式。")
-    exit()
+        if not incremental and not split_docs:
+            print("沒有載入任何文件。結束程式。")
+            return
 
-print(f"已載入 {len(documents)} 份文件。")
+        print(f"已載入 {loaded} 份文件。")
+        print(f"已分割成 {len(split_docs)} 個區塊。")
 
-# 5. 建立向量資料庫
-splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
-split_docs = splitter.split_documents(documents)
-print(f"已分割成 {len(split_docs)} 個區塊。")
+        # 5. 建立（或增量更新）向量資料庫
+        deleted = writer.delete(stale_ids)
+        if deleted:
+            print(f"已刪除 {deleted} 個過期區塊。")
+        writer.add(split_docs, split_ids)
 
-# Login to HuggingFace
-hf_token = os.getenv('HUGGINGFACE_TOKEN')
-if hf_token:
-    login(token=hf_token)
-else:
-    print("警告: 未找到 HUGGINGFACE_TOKEN 環境變數。")
+        # 6. 儲存向量資料庫
+        writer.flush()
+        manifest.save()
+    # BM25 倒排索引（hybrid 檢索用）跟著向量資料庫一起存放
+    write_lexical_index(writer.store, faiss_dir)
+    print("✅ 向量資料庫已儲存為 'faiss_db' 資料夾。")
+    if changes is not None:
+        changes.clear()
+    print(embedding_model.stats.report())
 
-embedding_model = E5Embeddings()
-vectorstore = FAISS.from_documents(split_docs, embedding_model)
+    # Optional: Zip the folder if needed (mimicking the notebook)
+    shutil.make_archive("faiss_db", 'zip', "faiss_db")
+    print("✅ 向量資料庫已壓縮為 'faiss_db.zip'。")
 
-# 6. 儲存向量資料庫
-vectorstore.save_local("faiss_db")
-print("✅ 向量資料庫已儲存為 'faiss_db' 資料夾。")
 
-# Optional: Zip the folder if needed (mimicking the notebook)
-shutil.make_archive("faiss_db", 'zip', "faiss_db")
-print("✅ 向量資料庫已壓縮為 'faiss_db.zip'。")
+if __name__ == "__main__":
+    main()
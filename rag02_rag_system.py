@@ -1,52 +1,76 @@
 import os
 from dotenv import load_dotenv
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import HuggingFaceEmbeddings
-import aisuite as ai
-import gradio as gr
-from huggingface_hub import login
+
+# 重量級模組（huggingface_hub、sentence-transformers、langchain、FAISS）在背景初始化時才 import，
+# Gradio 介面可以先啟動；RAG_STARTUP=eager 改回啟動時同步載入
+from rag_startup import LOADING, PRESET_QUESTIONS, BackgroundInit, StartupTimer, warm_up, warmup_enabled
+from rag_llm import StreamStats, make_client, split_model, stream_chat
+from rag_tracing import Tracer, format_stage_stats
+
+startup_timer = StartupTimer()
+with startup_timer.phase("import gradio"):
+    import gradio as gr
 
 # Load environment variables
 load_dotenv()
 
-# Login to HuggingFace
-hf_token = os.getenv('HUGGINGFACE_TOKEN')
-if hf_token:
-    login(token=hf_token)
-else:
-    print("警告: 未找到 HUGGINGFACE_TOKEN 環境變數。")
-
-# 2. 自訂 E5 embedding 類別
-class E5Embeddings(HuggingFaceEmbeddings):
-    def __init__(self, **kwargs):
-        super().__init__(
-            model_name="intfloat/multilingual-e5-large",
-            encode_kwargs={"normalize_embeddings": True},
-            **kwargs
-        )
-
-    def embed_documents(self, texts):
-        # E5 文件前綴
-        texts = [f"passage: {t}" for t in texts]
-        return super().embed_documents(texts)
-
-    def embed_query(self, text):
-        # E5 查詢前綴
-        return super().embed_query(f"query: {text}")
-
-# 3. 載入 faiss_db
-if not os.path.exists("faiss_db"):
-    print("錯誤: 找不到 'faiss_db' 資料夾。請先執行 rag01_create_vector_db.py 建立向量資料庫。")
-    exit()
-
-embedding_model = E5Embeddings()
-vectorstore = FAISS.load_local(
-    "faiss_db",
-    embeddings=embedding_model,
-    allow_dangerous_deserialization=True
-)
-
-retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
+top_k = 4
+embedding_model = vectorstore = lexical_index = reranker = query_cache = answer_cache = context_packer = None
+
+
+def load_vectorstore():
+    from rag_faiss_index import load_store
+
+    # 套用 faiss_index.json 記錄的查詢參數（HNSW efSearch / IVF nprobe）
+    return load_store("faiss_db", embedding_model)
+
+
+def initialize(timer):
+    """背景初始化：HuggingFace 登入、載入 E5 模型與 faiss_db，並以範例問題預熱快取。"""
+    global embedding_model, vectorstore, lexical_index, reranker, query_cache, answer_cache, context_packer
+    # 3. 載入 faiss_db
+    if not os.path.exists("faiss_db"):
+        raise FileNotFoundError("找不到 'faiss_db' 資料夾。請先執行 rag01_create_vector_db.py 建立向量資料庫。")
+
+    # Login to HuggingFace
+    hf_token = os.getenv('HUGGINGFACE_TOKEN')
+    if hf_token:
+        with timer.phase("huggingface login"):
+            timer.import_module("huggingface_hub").login(token=hf_token)
+    else:
+        print("警告: 未找到 HUGGINGFACE_TOKEN 環境變數。")
+
+    # 2. 自訂 E5 embedding 類別（共用模組，含磁碟快取）
+    rag_embeddings = timer.import_module("rag_embeddings")
+    rag_query_cache = timer.import_module("rag_query_cache")
+    rag_retrieval = timer.import_module("rag_retrieval")
+    rag_rerank = timer.import_module("rag_rerank")
+    with timer.phase("load embedding model"):
+        embedding_model = rag_embeddings.make_embeddings()
+    with timer.phase("open faiss_db"):
+        vectorstore = load_vectorstore()
+        # BM25 倒排索引：補上 dense 檢索容易漏掉的逐字比對（例如 `git reset --hard`、EC2 機型名稱）
+        lexical_index = rag_retrieval.load_lexical_index("faiss_db")
+    # 第二階段 reranker（RAG_RERANKER=lexical/embedding/cross-encoder，預設不使用）
+    with timer.phase("load reranker"):
+        reranker = rag_rerank.make_reranker(embedding=embedding_model)
+
+    # 相同問題（例如重複點選的範例問題）直接沿用 query 向量與檢索結果
+    query_cache = rag_query_cache.QueryCache.from_env()
+    query_cache.sync(rag_query_cache.index_fingerprint("faiss_db"))
+    # 換句話說的相同問題（且檢索到同一組資料）直接沿用上次的回答，不再呼叫 LLM
+    answer_cache = timer.import_module("rag_answer_cache").SemanticAnswerCache.from_env()
+    # 合併重疊的區塊、去掉近似重複，控制送進 LLM 的內容在 RAG_CONTEXT_TOKENS 以內
+    context_packer = timer.import_module("rag_context").ContextPacker.from_env()
+
+    if warmup_enabled():
+        # 第一次 encode 會配置模型的運算資源，讓它發生在使用者提問之前
+        with timer.phase(f"warm-up ({len(PRESET_QUESTIONS)} questions)"):
+            warm_up(lambda q: rag_retrieval.retrieve(vectorstore, q, k=top_k, lexical=lexical_index, cache=query_cache,
+                                                     embedding=embedding_model, reranker=reranker))
+
+
+startup = BackgroundInit(initialize, timer=startup_timer).start()
 
 # 4. 設定好我們要的 LLM
 # 這裡使用 Groq 服務
@@ -57,9 +81,13 @@ else:
     os.environ['GROQ_API_KEY'] = api_key
 
 model = "groq:openai/gpt-oss-120b"
-# base_url="https://api.groq.com/openai/v1" # Not used in aisuite call directly here
-
-client = ai.Client()
+# Groq 的 OpenAI 相容端點（https://api.groq.com/openai/v1），以 stream=True 逐字取得回覆
+# 設定 RAG_LLM_BASE_URL 可改接本機 mock server（rag_mock_llm_server.py）
+try:
+    client = make_client(split_model(model)[0])
+except RuntimeError as e:
+    print(f"警告: 無法建立 LLM client ({e})")
+    client = None
 
 # 5. prompt 設計
 system_prompt = "你是我(Sam)的筆記管理人員，請根據資料來回應我的問題。請親切、簡潔並附帶具體建議。請用台灣習慣的中文回應。"
@@ -76,44 +104,126 @@ prompt_template = """
 # 6. 使用 RAG 來回應
 chat_history = []
 
-def chat_with_rag(user_input):
-    global chat_history
-    # 取回相關資料
-    docs = retriever.invoke(user_input)
-    retrieved_chunks = "\n\n".join([doc.page_content for doc in docs])
-
-    # 將自定 prompt 套入格式
-    final_prompt = prompt_template.format(retrieved_chunks=retrieved_chunks, question=user_input)
+# 每次請求的各階段耗時寫入 logs/rag_traces.jsonl（RAG_TRACE=0 關閉）
+tracer = Tracer.from_env()
 
-    # 用 AI Suite 呼叫語言模型
+def stream_chat_with_rag(user_input):
+    """逐步產生目前為止的完整回答（每收到一段文字就 yield 一次）。"""
+    trace = tracer.start("gradio", question=user_input)
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": final_prompt},
-            ]
-        )
-        answer = response.choices[0].message.content
+        yield from _stream_chat_with_rag(user_input, trace)
     except Exception as e:
+        trace.finish("error", e)
+        raise
+    finally:
+        # 使用者中途離開（generator 被關閉）也要留下紀錄
+        trace.finish()
+
+
+def _stream_chat_with_rag(user_input, trace):
+    global chat_history, vectorstore, lexical_index
+    if not startup.ready:
+        # 背景初始化還沒完成：先告訴使用者，再等它完成
+        yield startup.describe()
+        with trace.span("startup_wait"):
+            startup.wait()
+    # 初始化時已 import，這裡只是取用
+    from rag_query_cache import index_fingerprint
+    from rag_retrieval import format_timings, load_lexical_index, retrieve
+    from rag_answer_cache import chunk_signature, context_key
+    from rag_context import format_context_report
+    from rag_vectorstores import chunk_id_of
+
+    # faiss_db 重建後，清除查詢快取並重新載入索引
+    with trace.span("index_check"):
+        if query_cache.sync(index_fingerprint("faiss_db")):
+            vectorstore = load_vectorstore()
+            lexical_index = load_lexical_index("faiss_db")
+            trace.event("index_reloaded")
+    # 取回相關資料（dense + BM25，以 reciprocal rank fusion 合併，再交給 reranker）
+    timings = {}
+    docs = retrieve(vectorstore, user_input, k=top_k, lexical=lexical_index, cache=query_cache,
+                    embedding=embedding_model, reranker=reranker, timings=timings)
+    print(f"[retrieval] {format_timings(timings)}")
+    trace.add_retrieval(timings)
+    trace.set(chunk_ids=[chunk_id_of(d) for d in docs])
+
+    with trace.span("prompt"):
+        retrieved_chunks, context_report = context_packer.pack(docs)
+        # 將自定 prompt 套入格式
+        final_prompt = prompt_template.format(retrieved_chunks=retrieved_chunks, question=user_input)
+    print(f"[context] {format_context_report(context_report)}")
+    trace.set(context=context_report)
+
+    with trace.span("answer_cache"):
+        query_vector = query_cache.get_vector(user_input) or embedding_model.embed_query(user_input)
+        chunk_ids = chunk_signature(docs)
+        answer_context = context_key(model, system_prompt, prompt_template)
+        answer, _ = answer_cache.lookup(query_vector, chunk_ids, answer_context)
+    trace.set(answer_cache_hit=answer is not None)
+    if answer is not None:
+        chat_history.append((user_input, answer))
+        yield answer
+        return
+
+    # 串流呼叫語言模型
+    answer = ""
+    stats = None
+    try:
+        if client is None:
+            raise RuntimeError("未設定 GROQ_API_KEY")
+        stats = StreamStats(*split_model(model))
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": final_prompt},
+        ]
+        for delta in stream_chat(model, messages, client=client, stats=stats):
+            answer += delta
+            yield answer
+        answer_cache.store(query_vector, chunk_ids, answer, stats.total_seconds, answer_context)
+    except Exception as e:
+        trace.event("llm_error", provider=split_model(model)[0], error=str(e))
         answer = f"發生錯誤: {str(e)}"
+        yield answer
+    finally:
+        trace.add_llm(stats)
 
     chat_history.append((user_input, answer))
+
+
+def chat_with_rag(user_input):
+    answer = ""
+    for answer in stream_chat_with_rag(user_input):
+        pass
     return answer
 
 # 7. 用 Gradio 打造 Web App
 with gr.Blocks() as demo:
     gr.Markdown("# AI 筆記管理人員")
+    status = gr.Markdown(startup.describe())
     chatbot = gr.Chatbot()
     msg = gr.Textbox(placeholder="請輸入你的問題...")
+    with gr.Accordion("Metrics（最近請求各階段 p50 / p95）", open=False):
+        metrics = gr.Markdown(format_stage_stats(tracer.stage_stats()))
+        refresh_metrics = gr.Button("Refresh")
 
     def respond(message, chat_history_local):
         chat_history_local.append({"role": "user", "content": message})
-        response = chat_with_rag(message)
-        chat_history_local.append({"role": "assistant", "content": response})
-        return "", chat_history_local
-
-    msg.submit(respond, [msg, chatbot], [msg, chatbot])
+        chat_history_local.append({"role": "assistant", "content": ""})
+        # 逐段更新最後一則回覆，讓使用者在第一個 token 到達時就看到內容
+        for partial in stream_chat_with_rag(message):
+            chat_history_local[-1]["content"] = partial
+            yield "", chat_history_local
+
+    msg.submit(respond, [msg, chatbot], [msg, chatbot]).then(
+        lambda: format_stage_stats(tracer.stage_stats()), None, metrics)
+    refresh_metrics.click(lambda: format_stage_stats(tracer.stage_stats()), None, metrics)
+
+    # 背景初始化期間每秒更新狀態列，完成（或失敗）後停止計時器
+    status_timer = gr.Timer(1.0, active=not startup.ready)
+    status_timer.tick(lambda: (startup.describe(), gr.Timer(active=startup.state == LOADING)),
+                      None, [status, status_timer])
+    demo.load(startup.describe, None, status)
 
 if __name__ == "__main__":
     demo.launch(debug=True)
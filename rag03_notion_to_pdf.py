@@ -1,7 +1,9 @@
 import os
-import sys
 import json
-from notion_client import Client
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from notion2md.exporter.block import StringExporter
 import markdown
 try:
@@ -10,12 +12,32 @@ except Exception:
     pisa = None
 from dotenv import load_dotenv
 
+from rag_notion_api import make_notion_client, install_for_notion2md, iter_database_items
+from rag_pdf_renderer import PdfRenderer
+from rag_chunking import format_front_matter
+from rag_notion_sync import NotionSync, edited_since_filter, is_archived, utc_now_iso
+
 # Load environment variables
 load_dotenv()
 
-def save_text_to_pdf(text, output_path):
+# md：只輸出 Markdown（rag01_* 直接依標題切段建索引）；pdf：只輸出 PDF；both：兩者皆輸出
+EXPORT_FORMATS = ("md", "pdf", "both")
+
+
+def export_format():
+    fmt = os.getenv("NOTION_EXPORT_FORMAT", "md").lower()
+    return fmt if fmt in EXPORT_FORMATS else "md"
+
+
+def wants_pdf(fmt=None):
+    return (fmt or export_format()) in ("pdf", "both")
+
+def save_text_to_pdf(text, output_path, renderer=None):
     """
     Converts Markdown text to HTML and then to PDF.
+
+    When a running `PdfRenderer` is given, its pooled browsers are reused instead of
+    launching Chromium for this page.
     """
     # Basic sanitization to avoid problematic unicode/punctuation
     def sanitize_md(md_text: str) -> str:
@@ -52,6 +74,11 @@ def save_text_to_pdf(text, output_path):
     </html>
     """
 
+    if renderer is not None and renderer.available:
+        if renderer.render(full_html, output_path):
+            return True
+        return _save_pdf_fallback(sanitized, full_html, output_path)
+
     # Try Playwright only if available
     try:
         from playwright.sync_api import sync_playwright
@@ -62,42 +89,69 @@ def save_text_to_pdf(text, output_path):
             page.pdf(path=output_path, print_background=True, format="A4")
             browser.close()
         return True
-    except Exception as e:
+    except Exception:
         # If Playwright isn't available, fall back to xhtml2pdf only when its dependency is present
-        if pisa is None:
-            # Neither Playwright nor xhtml2pdf available — save markdown as fallback
-            try:
-                # Save the markdown content to a .md file next to requested output
-                md_path = os.path.splitext(output_path)[0] + ".md"
-                with open(md_path, "w", encoding="utf-8") as f:
-                    f.write(sanitized)
-                print(f"Playwright/xhtml2pdf not installed. Saved markdown fallback: {md_path}")
-                return False
-            except Exception as e3:
-                print(f"Failed to save markdown fallback: {e3}")
-                return False
-        else:
-            try:
-                with open(output_path, "wb") as pdf_file:
-                    pisa_status = pisa.CreatePDF(full_html, dest=pdf_file)
-                if pisa_status.err:
-                    print(f"Error creating PDF with xhtml2pdf: {pisa_status.err}")
-                    return False
-                return True
-            except Exception as e2:
-                print(f"xhtml2pdf failed: {e2}")
+        return _save_pdf_fallback(sanitized, full_html, output_path)
+
+
+def _save_pdf_fallback(sanitized, full_html, output_path):
+    if pisa is None:
+        # Neither Playwright nor xhtml2pdf available — save markdown as fallback
+        try:
+            # Save the markdown content to a .md file next to requested output
+            md_path = os.path.splitext(output_path)[0] + ".md"
+            with open(md_path, "w", encoding="utf-8") as f:
+                f.write(sanitized)
+            print(f"Playwright/xhtml2pdf not installed. Saved markdown fallback: {md_path}")
+            return False
+        except Exception as e3:
+            print(f"Failed to save markdown fallback: {e3}")
+            return False
+    else:
+        try:
+            with open(output_path, "wb") as pdf_file:
+                pisa_status = pisa.CreatePDF(full_html, dest=pdf_file)
+            if pisa_status.err:
+                print(f"Error creating PDF with xhtml2pdf: {pisa_status.err}")
                 return False
+            return True
+        except Exception as e2:
+            print(f"xhtml2pdf failed: {e2}")
+            return False
 
-def fetch_notion_page_as_pdf(page_id, output_folder="uploaded_docs"):
+def save_notion_page(md_string, output_base, page_id, title, last_edited_time=None, renderer=None):
+    """
+    Saves an exported page as `<output_base>.md` (with Notion metadata front matter) and/or
+    `<output_base>.pdf`, depending on NOTION_EXPORT_FORMAT. Returns the list of written paths.
+    """
+    fmt = export_format()
+    written = []
+    if wants_pdf(fmt) and save_text_to_pdf(md_string, output_base + ".pdf", renderer=renderer):
+        written.append(output_base + ".pdf")
+    if fmt in ("md", "both"):
+        # Written after the PDF so it replaces save_text_to_pdf's bare markdown fallback
+        meta = {"notion_page_id": page_id, "title": title, "last_edited_time": last_edited_time}
+        with open(output_base + ".md", "w", encoding="utf-8") as f:
+            f.write(format_front_matter(meta) + md_string)
+        written.append(output_base + ".md")
+    return written
+
+
+def fetch_notion_page_as_pdf(page_id, output_folder="uploaded_docs", renderer=None, output_name=None, sync=None):
     """
-    Fetches a Notion page by ID, converts it to Markdown, then PDF.
+    Fetches a Notion page by ID, converts it to Markdown, then saves it as Markdown and/or PDF.
+
+    `output_name` overrides the file name (without extension) derived from the page title.
+    With a `NotionSync`, unchanged pages are skipped and archived pages have their outputs removed.
+    Returns the number of pages exported (a database counts each of its pages).
     """
     notion_token = os.getenv("NOTION_TOKEN")
     if not notion_token:
         print("Error: NOTION_TOKEN not found in environment variables.")
-        return
+        return 0
 
-    client = Client(auth=notion_token)
+    client = make_notion_client(notion_token)
+    install_for_notion2md(client)
 
     # First check if the id is a database
     try:
@@ -107,11 +161,19 @@ def fetch_notion_page_as_pdf(page_id, output_folder="uploaded_docs"):
         is_database = False
             # Priority: CLI arg > NOTION_SOURCE_URL env var > NOTION_SOURCE_URL_LIST JSON mapping
     if is_database:
-        return fetch_notion_database_as_pdfs(page_id, output_folder)
+        return fetch_notion_database_as_pdfs(page_id, output_folder, renderer=renderer, sync=sync)
 
     print(f"Fetching Notion page: {page_id}...")
     try:
         page = client.pages.retrieve(page_id)
+        if sync is not None:
+            if is_archived(page):
+                sync.archived(page["id"])
+                sync.save()
+                return 0
+            if not sync.should_export(page):
+                print(f"Unchanged since last sync, skipped: {page_id}")
+                return 0
         title = "Untitled"
 
         # Extract title safely
@@ -123,8 +185,7 @@ def fetch_notion_page_as_pdf(page_id, output_folder="uploaded_docs"):
                     break
 
         safe_title = "".join([c for c in title if c.isalnum() or c in (' ', '-', '_')]).strip()
-        output_filename = f"{safe_title}.pdf"
-        output_path = os.path.join(output_folder, output_filename)
+        output_base = os.path.join(output_folder, output_name or safe_title or page_id)
 
         # Ensure environ available for notion2md
         if "NOTION_TOKEN" not in os.environ:
@@ -136,16 +197,23 @@ def fetch_notion_page_as_pdf(page_id, output_folder="uploaded_docs"):
 
         if not md_string:
             print("Warning: No content found or failed to convert to Markdown.")
-            return
-
-        print(f"Saving to PDF: {output_path}...")
-        if save_text_to_pdf(md_string, output_path):
-            print(f"Successfully saved {output_path}")
+            return 0
+
+        print(f"Saving page as {export_format()}: {output_base}...")
+        written = save_notion_page(md_string, output_base, page_id, title,
+                                   page.get("last_edited_time"), renderer=renderer)
+        if written:
+            print(f"Successfully saved {', '.join(written)}")
+            if sync is not None:
+                sync.exported(page["id"], page.get("last_edited_time"), written)
+                sync.save()
+            return 1
         else:
             print("Failed to save PDF.")
 
     except Exception as e:
         print(f"An error occurred: {e}")
+    return 0
 
 
 def _get_title_from_properties(properties: dict) -> str:
@@ -158,68 +226,135 @@ def _get_title_from_properties(properties: dict) -> str:
     return ""
 
 
-def fetch_notion_database_as_pdfs(database_id, output_folder="uploaded_docs"):
+def default_export_workers():
+    return max(1, int(os.getenv("NOTION_EXPORT_WORKERS", "4")))
+
+
+def _export_database_item(client, item, output_folder, renderer=None, sync=None, database_id=None):
+    """把資料庫中的一個頁面轉成 Markdown 並存成 .md 和/或 PDF；成功回傳 True。"""
+    page_id = item.get("id")
+    title = _get_title_from_properties(item.get("properties", {}))
+    if not title:
+        try:
+            p = client.pages.retrieve(page_id)
+            if "properties" in p:
+                title = _get_title_from_properties(p.get("properties", {}))
+        except Exception:
+            title = "Untitled"
+
+    safe_title = "".join([c for c in (title or "Untitled") if c.isalnum() or c in (' ', '-', '_')]).strip()
+    output_base = os.path.join(output_folder, safe_title or page_id)
+
+    print(f"Converting page {page_id} -> {os.path.basename(output_base)} ({export_format()})...")
+    try:
+        md_exporter = StringExporter(block_id=page_id)
+        md_string = md_exporter.export()
+        if not md_string:
+            print(f"Warning: page {page_id} returned empty markdown.")
+            return False
+        written = save_notion_page(md_string, output_base, page_id, title,
+                                   item.get("last_edited_time"), renderer=renderer)
+        if written:
+            print(f"Saved: {', '.join(written)}")
+            if sync is not None:
+                sync.exported(page_id, item.get("last_edited_time"), written, parent=database_id)
+            return True
+        print(f"Failed to save PDF for page {page_id}")
+    except Exception as e:
+        print(f"Error exporting page {page_id}: {e}")
+    return False
+
+
+def _sync_database_removals(client, database_id, sync, live_ids=None):
+    """Removes outputs of pages that are no longer in the database (archived or deleted)."""
+    if live_ids is None:
+        # Only page IDs are needed, so ask for the title property alone
+        live_ids = {item["id"] for item in iter_database_items(client, database_id, filter_properties=["title"])}
+    for page_id in sync.state.page_ids(database_id):
+        if page_id not in live_ids:
+            sync.archived(page_id)
+
+
+def fetch_notion_database_as_pdfs(database_id, output_folder="uploaded_docs", workers=None, renderer=None, sync=None):
     """
     Queries a Notion database and exports each page to a PDF in `output_folder`.
+
+    Pages are exported by a bounded thread pool (`NOTION_EXPORT_WORKERS`, default 4) while the
+    next cursor page is prefetched; every API call goes through a shared token bucket with
+    429/5xx retries (see rag_notion_api). PDFs are rendered by a shared browser pool
+    (`PdfRenderer`) instead of one Chromium launch per page.
+
+    With a `NotionSync`, the query is filtered by last_edited_time since the previous sync,
+    unchanged pages are skipped and outputs of archived pages are deleted.
+    Returns the number of pages exported.
     """
     notion_token = os.getenv("NOTION_TOKEN")
     if not notion_token:
         print("Error: NOTION_TOKEN not found in environment variables.")
-        return
+        return 0
+
+    client = make_notion_client(notion_token)
+    install_for_notion2md(client)
+    workers = workers or default_export_workers()
+    print(f"Fetching Notion database: {database_id} (workers={workers})...")
 
-    client = Client(auth=notion_token)
-    print(f"Fetching Notion database: {database_id}...")
+    own_renderer = renderer is None and wants_pdf()
+    if own_renderer:
+        renderer = PdfRenderer().start()
 
-    start_cursor = None
+    sync_started = utc_now_iso()
+    query_filter = edited_since_filter(sync.state.watermark(database_id)) if sync is not None else None
+    if query_filter:
+        print(f"Sync: only pages edited on or after {query_filter['last_edited_time']['on_or_after']}")
+
+    start = time.perf_counter()
     count = 0
-    while True:
+    total = 0
+    seen = set()
+    query_ok = True
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # 最多同時排入 workers * 2 個頁面，其餘留在 cursor 上，讓查詢與轉換重疊進行
+        pending = deque()
         try:
-            resp = client.databases.query(database_id=database_id, start_cursor=start_cursor, page_size=100)
+            for item in iter_database_items(client, database_id, filter=query_filter):
+                seen.add(item["id"])
+                if sync is not None:
+                    if is_archived(item):
+                        sync.archived(item["id"])
+                        continue
+                    if not sync.should_export(item):
+                        continue
+                pending.append(pool.submit(_export_database_item, client, item, output_folder, renderer,
+                                           sync, database_id))
+                total += 1
+                while len(pending) >= workers * 2:
+                    count += pending.popleft().result()
         except Exception as e:
             print(f"Failed to query database: {e}")
-            return
-
-        results = resp.get("results", [])
-        for item in results:
-            page_id = item.get("id")
-            title = _get_title_from_properties(item.get("properties", {}))
-            if not title:
-                try:
-                    p = client.pages.retrieve(page_id)
-                    if "properties" in p:
-                        title = _get_title_from_properties(p.get("properties", {}))
-                except Exception:
-                    title = "Untitled"
-
-            safe_title = "".join([c for c in (title or "Untitled") if c.isalnum() or c in (' ', '-', '_')]).strip()
-            output_filename = f"{safe_title or page_id}.pdf"
-            output_path = os.path.join(output_folder, output_filename)
-
-            # Ensure environ available for notion2md
-            if "NOTION_TOKEN" not in os.environ:
-                os.environ["NOTION_TOKEN"] = notion_token
-
-            print(f"Converting page {page_id} -> {output_filename}...")
-            try:
-                md_exporter = StringExporter(block_id=page_id)
-                md_string = md_exporter.export()
-                if not md_string:
-                    print(f"Warning: page {page_id} returned empty markdown.")
-                    continue
-                if save_text_to_pdf(md_string, output_path):
-                    print(f"Saved: {output_path}")
-                    count += 1
-                else:
-                    print(f"Failed to save PDF for page {page_id}")
-            except Exception as e:
-                print(f"Error exporting page {page_id}: {e}")
-
-        if resp.get("has_more"):
-            start_cursor = resp.get("next_cursor")
-        else:
-            break
+            query_ok = False
+        while pending:
+            count += pending.popleft().result()
 
-    print(f"Completed. Exported {count} pages to {output_folder}")
+    if sync is not None:
+        try:
+            if query_ok:
+                _sync_database_removals(client, database_id, sync, None if query_filter else seen)
+            # Failed pages keep their old state; holding the watermark makes the next sync retry them
+            if query_ok and count == total:
+                sync.state.set_watermark(database_id, sync_started)
+        except Exception as e:
+            print(f"Failed to check for archived pages: {e}")
+        sync.save()
+        print(sync.summary())
+
+    elapsed = time.perf_counter() - start
+    if own_renderer:
+        renderer.close()
+    rate = total / elapsed if elapsed > 0 else 0.0
+    render_summary = f", {renderer.summary()}" if renderer is not None else ""
+    print(f"Completed. Exported {count}/{total} pages to {output_folder} "
+          f"in {elapsed:.1f}s ({rate:.2f} pages/sec, API retries: {client.retries}{render_summary})")
+    return count
 
 if __name__ == "__main__":
     # Ensure output directory exists
@@ -307,9 +442,15 @@ if __name__ == "__main__":
         return None, None
 
     # Priority: CLI arg > NOTION_SOURCE_URL env var > NOTION_SOURCE_URL_LIST (JSON mapping)
-    page_id = None
-    if len(sys.argv) > 1:
-        page_id = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Export Notion pages or databases into uploaded_docs/")
+    parser.add_argument("page_id", nargs="?", help="Notion page or database ID")
+    parser.add_argument("--sync", action="store_true",
+                        help="only export pages edited since the last sync (state in notion_sync_state.json) "
+                             "and write the changed/removed files to notion_changes.json")
+    args = parser.parse_args()
+    sync = NotionSync() if args.sync else None
+
+    page_id = args.page_id
 
     if not page_id:
         src = os.getenv("NOTION_SOURCE_URL") or os.getenv("NOTION_PAGE_ID")
@@ -318,7 +459,7 @@ if __name__ == "__main__":
 
     if page_id:
         print(f"Using Notion page id: {page_id}")
-        fetch_notion_page_as_pdf(page_id)
+        fetch_notion_page_as_pdf(page_id, sync=sync)
     else:
         # Read mapping from a JSON file; path can be set via NOTION_SOURCE_JSON env var
         json_path = os.getenv("NOTION_SOURCE_JSON", "notion_sources.json")
@@ -334,30 +475,34 @@ if __name__ == "__main__":
             print(f"Notion sources JSON not found at {json_path}")
 
         if isinstance(obj, dict):
+            mapped_ids = set()
+            # One browser pool for the whole mapping instead of a Chromium launch per page
+            renderer = PdfRenderer().start() if wants_pdf() else None
+            start = time.perf_counter()
+            count = 0
             for name, url in obj.items():
                 pid = extract_page_id_from_url(url)
                 if not pid:
                     print(f"Could not extract page id from URL for '{name}': {url}")
                     continue
+                mapped_ids.add(pid.replace("-", "").lower())
                 print(f"Exporting '{name}' from {pid}...")
-                fetch_notion_page_as_pdf(pid)
-                # Try to rename most recently created file to the provided name
-                try:
-                    files = sorted([f for f in os.listdir("uploaded_docs")], key=lambda x: os.path.getmtime(os.path.join("uploaded_docs", x)), reverse=True)
-                    if files:
-                        latest = files[0]
-                        target = f"{name}.pdf"
-                        src_path = os.path.join("uploaded_docs", latest)
-                        dst_path = os.path.join("uploaded_docs", target)
-                        if src_path != dst_path:
-                            try:
-                                os.replace(src_path, dst_path)
-                                print(f"Renamed {latest} -> {target}")
-                            except Exception:
-                                pass
-                except Exception:
-                    pass
-            print("Completed exporting mapping.")
+                # Pages are saved under the mapping name directly (databases keep per-page titles)
+                count += fetch_notion_page_as_pdf(pid, renderer=renderer, output_name=name, sync=sync)
+            if sync is not None:
+                # Pages dropped from the mapping are treated like archived pages
+                for old_id in sync.state.page_ids("page"):
+                    if old_id.replace("-", "").lower() not in mapped_ids:
+                        sync.archived(old_id)
+                sync.save()
+                print(sync.summary())
+            elapsed = time.perf_counter() - start
+            if renderer is not None:
+                renderer.close()
+            rate = count / elapsed if elapsed > 0 else 0.0
+            render_summary = f", {renderer.summary()}" if renderer is not None else ""
+            print(f"Completed exporting mapping. Exported {count} pages from {len(mapped_ids)} sources to uploaded_docs "
+                  f"in {elapsed:.1f}s ({rate:.2f} pages/sec{render_summary})")
         else:
             print("NOTION_SOURCE_URL_LIST must be provided as a JSON file (set NOTION_SOURCE_JSON or put notion_sources.json in repo).")
             print("Usage: python rag03_notion_to_pdf.py <NOTION_PAGE_ID>")
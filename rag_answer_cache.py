@@ -0,0 +1,120 @@
+import os
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from rag_vectorstores import chunk_id_of
+
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_TTL_SECONDS = 6 * 3600
+DEFAULT_MAX_ENTRIES = 256
+
+
+def context_key(*parts):
+    """把模型名稱、system prompt、prompt 樣板等會影響回答的設定合成一個 key。"""
+    return hashlib.sha256("\x00".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:16]
+
+
+def chunk_signature(docs):
+    """檢索結果的 chunk ID 清單；舊索引沒有 ID 時以內容 hash 代替。"""
+    return [chunk_id_of(d) or hashlib.sha1(d.page_content.encode("utf-8")).hexdigest() for d in docs]
+
+
+class SemanticAnswerCache:
+    """放在 LLM 呼叫前的語意回答快取。
+
+    新問題的 E5 query 向量與快取中某個問題的 cosine 相似度 >= `threshold`，
+    且檢索到的 chunk 集合相同、設定（context key）相同時，直接沿用上次的回答。
+    例如「GIT reset 怎麼寫？」與「git reset 用法」會取回同一組區塊，就不需要再呼叫 LLM。
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_entries=DEFAULT_MAX_ENTRIES, enabled=True):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._entries = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            threshold=float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", DEFAULT_THRESHOLD)),
+            ttl_seconds=float(os.getenv("RAG_ANSWER_CACHE_TTL", DEFAULT_TTL_SECONDS)),
+            max_entries=int(os.getenv("RAG_ANSWER_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+            enabled=os.getenv("RAG_ANSWER_CACHE", "1").lower() not in ("0", "false", "no", "off"),
+        )
+
+    def lookup(self, query_vector, chunk_ids, context="", threshold=None):
+        """回傳 (answer, similarity)；沒有命中時回傳 (None, 最佳相似度)。
+
+        `threshold` 覆寫這次查詢的相似度門檻（例如 Streamlit 各 session 的設定），不修改共用的快取。
+        """
+        threshold = self.threshold if threshold is None else threshold
+        if not self.enabled:
+            return None, 0.0
+        vector = _unit(query_vector)
+        chunk_set = frozenset(chunk_ids)
+        now = time.time()
+        with self._lock:
+            self._entries = [e for e in self._entries if now - e["created"] < self.ttl_seconds]
+            candidates = [e for e in self._entries if e["chunks"] == chunk_set and e["context"] == context]
+            best, best_sim = None, 0.0
+            if candidates:
+                sims = np.stack([e["vector"] for e in candidates]) @ vector
+                i = int(np.argmax(sims))
+                best, best_sim = candidates[i], float(sims[i])
+            if best is None or best_sim < threshold:
+                self.misses += 1
+                return None, best_sim
+            best["last_used"] = now
+            best["hits"] += 1
+            self.hits += 1
+            self.saved_seconds += best["llm_seconds"]
+            return best["answer"], best_sim
+
+    def store(self, query_vector, chunk_ids, answer, llm_seconds, context=""):
+        if not self.enabled or not answer:
+            return
+        now = time.time()
+        with self._lock:
+            self._entries.append({
+                "vector": _unit(query_vector),
+                "chunks": frozenset(chunk_ids),
+                "context": context,
+                "answer": answer,
+                "llm_seconds": llm_seconds,
+                "created": now,
+                "last_used": now,
+                "hits": 0,
+            })
+            if len(self._entries) > self.max_entries:
+                self._entries.sort(key=lambda e: e["last_used"])
+                del self._entries[: len(self._entries) - self.max_entries]
+
+    def clear(self):
+        with self._lock:
+            self._entries = []
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "saved_seconds": self.saved_seconds,
+            "entries": len(self._entries),
+        }
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
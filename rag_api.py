@@ -0,0 +1,547 @@
+"""不依賴 Gradio / Streamlit 的非同步 HTTP API（aiohttp）。
+
+整個 process 共用一份向量資料庫、embedding 模型、查詢/回答快取與 tracer；
+每個 session 各自保留對話紀錄。檢索在固定大小的 thread pool 執行，
+LLM 呼叫以 semaphore 限制同時數量，排隊的請求超過上限或等待逾時就回 503（附 Retry-After），
+讓上游知道要退避，而不是把延遲無限拉長。
+
+端點：
+    GET    /health
+    GET    /metrics                 各階段 p50/p95、排隊與拒絕數、session 數、context 節省的 token 數
+    POST   /retrieve                {"question": "...", "k": 4}
+    POST   /answer                  {"question": "...", "session_id": "..."}
+    POST   /answer/stream           同上，以 SSE 逐段回傳（event: meta / delta / done / error）
+    DELETE /sessions/{session_id}
+
+用法：
+    python rag_api.py --store faiss_db --port 8000
+    python rag_api.py --offline                    # HashingEmbeddings，搭配 mock LLM server 做壓力測試
+"""
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from rag_embeddings import HashingEmbeddings, QueryBatcher, make_embeddings
+from rag_query_cache import QueryCache, index_fingerprint
+from rag_retrieval import load_lexical_index, retrieve
+from rag_rerank import make_reranker
+from rag_answer_cache import SemanticAnswerCache, chunk_signature, context_key
+from rag_context import ContextPacker
+from rag_llm import StreamStats, make_client, split_model, stream_chat
+from rag_tracing import Tracer
+from rag_vectorstores import chunk_id_of, open_vectorstore
+
+DEFAULT_STORE = "faiss_db"
+DEFAULT_MODEL = "groq:openai/gpt-oss-120b"
+DEFAULT_TOP_K = 4
+MAX_TOP_K = 50
+MAX_QUESTION_CHARS = 4000
+DEFAULT_RETRIEVAL_WORKERS = 4
+DEFAULT_LLM_CONCURRENCY = 8
+DEFAULT_MAX_QUEUE = 32
+DEFAULT_QUEUE_TIMEOUT = 10.0
+DEFAULT_MAX_SESSIONS = 1000
+DEFAULT_SESSION_TTL = 3600
+# 每個 session 送給 LLM 的前幾輪對話（問題 + 回答）
+DEFAULT_HISTORY_TURNS = 3
+
+SYSTEM_PROMPT = "你是我(Sam)的筆記管理人員，請根據資料來回應我的問題。請親切、簡潔並附帶具體建議。請用台灣習慣的中文回應。"
+
+PROMPT_TEMPLATE = """
+根據下列資料：
+{retrieved_chunks}
+
+回答使用者的問題：{question}
+
+請根據資料內容回覆，若資料不足請告訴我(Sam)。
+"""
+
+
+class Overloaded(Exception):
+    """排隊已滿或等待逾時；HTTP 層轉成 503 + Retry-After。"""
+
+    def __init__(self, gate, reason):
+        super().__init__(f"{gate.name} {reason}")
+        self.gate = gate
+        self.reason = reason
+
+
+class Gate:
+    """限制同時執行數量的 asyncio semaphore，外加排隊上限與等待逾時（backpressure）。
+
+    `limit` 個請求同時執行，最多 `max_queue` 個在後面等待；再多就立即拒絕，
+    等待超過 `timeout` 秒也會拒絕，避免請求在佇列中堆積到使用者早已放棄。
+    """
+
+    def __init__(self, name, limit, max_queue=DEFAULT_MAX_QUEUE, timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.completed = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self):
+        """取得執行權，回傳等待秒數；滿載時丟出 Overloaded。"""
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self, "queue full")
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded(self, "queue timeout") from None
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return time.perf_counter() - start
+
+    def release(self):
+        self.active -= 1
+        self.completed += 1
+        self._semaphore.release()
+
+    def stats(self):
+        return {"limit": self.limit, "active": self.active, "waiting": self.waiting,
+                "max_queue": self.max_queue, "rejected": self.rejected, "completed": self.completed}
+
+
+class Session:
+    def __init__(self, session_id, max_turns):
+        self.id = session_id
+        self.history = deque(maxlen=max_turns)
+        self.last_used = time.time()
+        # 同一個 session 的請求依序處理，對話紀錄才不會交錯
+        self.lock = asyncio.Lock()
+
+
+class SessionStore:
+    """session_id -> Session 的 LRU；超過 `max_sessions` 或閒置超過 `ttl_seconds` 的 session 會被移除。"""
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, ttl_seconds=DEFAULT_SESSION_TTL,
+                 max_turns=DEFAULT_HISTORY_TURNS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_turns = max_turns
+        self._sessions = OrderedDict()
+
+    def get(self, session_id=None):
+        self._expire()
+        session = self._sessions.get(session_id) if session_id else None
+        if session is None:
+            session = Session(session_id or uuid.uuid4().hex, self.max_turns)
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session.id)
+        session.last_used = time.time()
+        return session
+
+    def drop(self, session_id):
+        return self._sessions.pop(session_id, None) is not None
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if oldest.last_used >= cutoff:
+                break
+            self._sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class RAGService:
+    """HTTP handler 共用的狀態：向量資料庫、embedding、快取、LLM client、限流與 session。"""
+
+    def __init__(self, store_dir=DEFAULT_STORE, embedding=None, model=DEFAULT_MODEL, top_k=DEFAULT_TOP_K,
+                 retrieval_workers=DEFAULT_RETRIEVAL_WORKERS, llm_concurrency=DEFAULT_LLM_CONCURRENCY,
+                 max_queue=DEFAULT_MAX_QUEUE, queue_timeout=DEFAULT_QUEUE_TIMEOUT, sessions=None, tracer=None):
+        self.store_dir = store_dir
+        self.embedding = embedding if embedding is not None else make_embeddings()
+        self.model = model
+        self.top_k = top_k
+        self.vectorstore = self._open_store()
+        # 同時到達的查詢合併成一次 embedding 呼叫（RAG_EMBED_BATCH=0 關閉）
+        self.embedding = QueryBatcher.from_env(self.embedding)
+        self.lexical_index = load_lexical_index(store_dir)
+        self.reranker = make_reranker(embedding=self.embedding)
+        self.query_cache = QueryCache.from_env()
+        self.query_cache.sync(index_fingerprint(store_dir))
+        self.answer_cache = SemanticAnswerCache.from_env()
+        self.answer_context = context_key(model, SYSTEM_PROMPT, PROMPT_TEMPLATE)
+        self.context_packer = ContextPacker.from_env()
+        self.tracer = tracer if tracer is not None else Tracer.from_env()
+        self.sessions = sessions if sessions is not None else SessionStore()
+        try:
+            self.client = make_client(split_model(model)[0])
+        except RuntimeError as e:
+            print(f"警告: 無法建立 LLM client ({e})")
+            self.client = None
+        self.retrieval_workers = retrieval_workers
+        self.llm_concurrency = llm_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._reload_lock = threading.Lock()
+        # 檢索（embedding + 向量搜尋）與 LLM 串流都是阻塞呼叫，各自在獨立的 thread pool 執行
+        self._retrieval_pool = ThreadPoolExecutor(retrieval_workers, thread_name_prefix="rag-retrieve")
+        self._llm_pool = ThreadPoolExecutor(llm_concurrency, thread_name_prefix="rag-llm")
+        self.retrieval_gate = None
+        self.llm_gate = None
+
+    @classmethod
+    def from_env(cls, store_dir=None, embedding=None):
+        return cls(
+            store_dir=store_dir or os.getenv("RAG_API_STORE", DEFAULT_STORE),
+            embedding=embedding,
+            model=os.getenv("RAG_API_MODEL", DEFAULT_MODEL),
+            top_k=int(os.getenv("RAG_API_TOP_K", DEFAULT_TOP_K)),
+            retrieval_workers=int(os.getenv("RAG_API_RETRIEVAL_WORKERS", DEFAULT_RETRIEVAL_WORKERS)),
+            llm_concurrency=int(os.getenv("RAG_API_LLM_CONCURRENCY", DEFAULT_LLM_CONCURRENCY)),
+            max_queue=int(os.getenv("RAG_API_MAX_QUEUE", DEFAULT_MAX_QUEUE)),
+            queue_timeout=float(os.getenv("RAG_API_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT)),
+            sessions=SessionStore(
+                max_sessions=int(os.getenv("RAG_API_MAX_SESSIONS", DEFAULT_MAX_SESSIONS)),
+                ttl_seconds=float(os.getenv("RAG_API_SESSION_TTL", DEFAULT_SESSION_TTL)),
+                max_turns=int(os.getenv("RAG_API_HISTORY_TURNS", DEFAULT_HISTORY_TURNS)),
+            ),
+        )
+
+    def _open_store(self):
+        store = open_vectorstore(self.store_dir, self.embedding)
+        dim = getattr(getattr(store, "index", None), "d", None)
+        if isinstance(self.embedding, HashingEmbeddings) and dim and dim != self.embedding.size:
+            # 離線模式：配合既有索引的維度，檢索結果只反映字面重疊
+            self.embedding = HashingEmbeddings(dim)
+            store.embedding_function = self.embedding
+        return store
+
+    async def start(self, app=None):
+        # asyncio 物件要在 event loop 內建立
+        self.retrieval_gate = Gate("retrieval", self.retrieval_workers, self.max_queue, self.queue_timeout)
+        self.llm_gate = Gate("llm", self.llm_concurrency, self.max_queue, self.queue_timeout)
+
+    async def close(self, app=None):
+        self._retrieval_pool.shutdown(wait=False, cancel_futures=True)
+        self._llm_pool.shutdown(wait=False, cancel_futures=True)
+        self.tracer.close()
+
+    def _retrieve_sync(self, question, k, timings):
+        # 索引重建後，清除查詢快取並重新載入（與 rag02_rag_system.py 相同）
+        with self._reload_lock:
+            if self.query_cache.sync(index_fingerprint(self.store_dir)):
+                self.vectorstore = self._open_store()
+                self.lexical_index = load_lexical_index(self.store_dir)
+                timings["index_reloaded"] = True
+        return retrieve(self.vectorstore, question, k=k, lexical=self.lexical_index, cache=self.query_cache,
+                        embedding=self.embedding, reranker=self.reranker, timings=timings)
+
+    async def retrieve(self, question, k, trace):
+        wait = await self.retrieval_gate.acquire()
+        trace.add_span("retrieval_queue", wait * 1000)
+        try:
+            timings = {}
+            loop = asyncio.get_running_loop()
+            docs = await loop.run_in_executor(self._retrieval_pool, partial(self._retrieve_sync, question, k, timings))
+        finally:
+            self.retrieval_gate.release()
+        if timings.pop("index_reloaded", False):
+            trace.event("index_reloaded")
+        trace.add_retrieval(timings)
+        trace.set(chunk_ids=[chunk_id_of(d) for d in docs])
+        return docs, timings
+
+    async def answer_events(self, question, session, trace):
+        """一次回答的事件序列：("meta", {...})、("delta", 文字)…、("done", {...})。
+
+        呼叫端需持有 `session.lock`；完成後才把這一輪寫入 session 的對話紀錄。
+        """
+        docs, _ = await self.retrieve(question, self.top_k, trace)
+        chunk_ids = chunk_signature(docs)
+        with trace.span("context_packing"):
+            retrieved_chunks, context_report = self.context_packer.pack(docs)
+        trace.set(context=context_report)
+        yield "meta", {"session_id": session.id, "chunk_ids": [chunk_id_of(d) for d in docs],
+                       "sources": [_source(d) for d in docs], "context": context_report}
+
+        with trace.span("prompt"):
+            final_prompt = PROMPT_TEMPLATE.format(retrieved_chunks=retrieved_chunks, question=question)
+            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+            for past_question, past_answer in session.history:
+                messages.append({"role": "user", "content": past_question})
+                messages.append({"role": "assistant", "content": past_answer})
+            messages.append({"role": "user", "content": final_prompt})
+
+        # 回答快取只用在沒有前文的第一輪，否則同一個問題在不同對話中的答案可能不同
+        query_vector = None
+        if not session.history:
+            with trace.span("answer_cache"):
+                query_vector = self.query_cache.get_vector(question)
+                if query_vector is None:
+                    # 快取沒有時才計算；E5 推論（與 QueryBatcher 的等待）不能佔住 event loop
+                    loop = asyncio.get_running_loop()
+                    query_vector = await loop.run_in_executor(self._retrieval_pool, self.embedding.embed_query,
+                                                              question)
+                answer, _ = self.answer_cache.lookup(query_vector, chunk_ids, self.answer_context)
+            trace.set(answer_cache_hit=answer is not None)
+            if answer is not None:
+                session.history.append((question, answer))
+                yield "delta", answer
+                yield "done", {"cached": True}
+                return
+
+        if self.client is None:
+            raise RuntimeError("未設定 LLM API key（GROQ_API_KEY / OPENAI_API_KEY 或 RAG_LLM_BASE_URL）")
+        wait = await self.llm_gate.acquire()
+        trace.add_span("llm_queue", wait * 1000)
+        stats = StreamStats(*split_model(self.model))
+        parts = []
+        try:
+            stream = partial(stream_chat, self.model, messages, client=self.client, stats=stats)
+            async for delta in _iterate_in_thread(self._llm_pool, stream):
+                parts.append(delta)
+                yield "delta", delta
+        finally:
+            self.llm_gate.release()
+            trace.add_llm(stats)
+        answer = "".join(parts)
+        if query_vector is not None:
+            self.answer_cache.store(query_vector, chunk_ids, answer, stats.total_seconds, self.answer_context)
+        session.history.append((question, answer))
+        yield "done", {"cached": False, "ttft_ms": stats.ttft * 1000 if stats.ttft is not None else None,
+                       "tokens": stats.token_counts()}
+
+    def metrics(self):
+        return {
+            "stages": self.tracer.stage_stats(),
+            "retrieval": self.retrieval_gate.stats(),
+            "llm": self.llm_gate.stats(),
+            "sessions": len(self.sessions),
+            "query_cache": self.query_cache.stats(),
+            "answer_cache": self.answer_cache.stats(),
+            "context": self.context_packer.stats(),
+            "query_batcher": self.embedding.batch_stats() if isinstance(self.embedding, QueryBatcher) else None,
+        }
+
+
+_DONE = object()
+
+
+async def _iterate_in_thread(pool, make_iterator):
+    """在 thread pool 中執行同步 generator，把每個項目交回 event loop。
+
+    呼叫端提早離開（例如客戶端斷線）時通知背景執行緒停止讀取 LLM 串流。
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce():
+        iterator = make_iterator()
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(items.put_nowait, (item, None))
+        except Exception as e:
+            loop.call_soon_threadsafe(items.put_nowait, (_DONE, e))
+            return
+        finally:
+            iterator.close()
+        loop.call_soon_threadsafe(items.put_nowait, (_DONE, None))
+
+    loop.run_in_executor(pool, produce)
+    try:
+        while True:
+            item, error = await items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _source(doc):
+    meta = doc.metadata
+    return {key: meta[key] for key in ("source", "page", "heading_path") if key in meta}
+
+
+async def _read_question(request):
+    try:
+        body = await request.json()
+    except (ValueError, UnicodeDecodeError):
+        raise web.HTTPBadRequest(text="request body must be JSON")
+    question = str(body.get("question") or "").strip()
+    if not question:
+        raise web.HTTPBadRequest(text='"question" is required')
+    if len(question) > MAX_QUESTION_CHARS:
+        raise web.HTTPRequestEntityTooLarge(max_size=MAX_QUESTION_CHARS, actual_size=len(question))
+    return body, question
+
+
+def _overloaded_response(e):
+    retry_after = max(1, int(e.gate.timeout / 2))
+    return web.json_response({"error": "overloaded", "detail": str(e)}, status=503,
+                             headers={"Retry-After": str(retry_after)})
+
+
+async def handle_health(request):
+    service = request.app["service"]
+    return web.json_response({"status": "ok", "store": service.store_dir, "model": service.model})
+
+
+async def handle_metrics(request):
+    return web.json_response(request.app["service"].metrics())
+
+
+async def handle_retrieve(request):
+    service = request.app["service"]
+    body, question = await _read_question(request)
+    try:
+        k = min(max(int(body.get("k", service.top_k)), 1), MAX_TOP_K)
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(text='"k" must be an integer')
+    trace = service.tracer.start("api.retrieve", question=question)
+    try:
+        docs, timings = await service.retrieve(question, k, trace)
+    except Overloaded as e:
+        trace.finish("rejected", e)
+        return _overloaded_response(e)
+    except Exception as e:
+        trace.finish("error", e)
+        raise
+    trace.finish()
+    return web.json_response({
+        "chunks": [{"id": chunk_id_of(d), "content": d.page_content, "metadata": d.metadata} for d in docs],
+        "timings": timings,
+    }, dumps=_dumps)
+
+
+async def handle_answer(request):
+    service = request.app["service"]
+    body, question = await _read_question(request)
+    session = service.sessions.get(body.get("session_id"))
+    trace = service.tracer.start("api.answer", question=question, session_id=session.id)
+    result, parts = {}, []
+    try:
+        async with session.lock:
+            async for kind, payload in service.answer_events(question, session, trace):
+                if kind == "delta":
+                    parts.append(payload)
+                else:
+                    result.update(payload)
+    except Overloaded as e:
+        trace.finish("rejected", e)
+        return _overloaded_response(e)
+    except Exception as e:
+        trace.finish("error", e)
+        return web.json_response({"error": str(e), "session_id": session.id}, status=502)
+    trace.finish()
+    return web.json_response({**result, "answer": "".join(parts)}, dumps=_dumps)
+
+
+async def handle_answer_stream(request):
+    service = request.app["service"]
+    body, question = await _read_question(request)
+    session = service.sessions.get(body.get("session_id"))
+    trace = service.tracer.start("api.answer_stream", question=question, session_id=session.id)
+    response = None
+    try:
+        async with session.lock:
+            events = service.answer_events(question, session, trace)
+            try:
+                async for kind, payload in events:
+                    if response is None:
+                        # 第一個事件（檢索完成）之前的 Overloaded 仍可回 503
+                        response = web.StreamResponse(headers={"Content-Type": "text/event-stream",
+                                                               "Cache-Control": "no-cache",
+                                                               "X-Session-Id": session.id})
+                        await response.prepare(request)
+                    data = {"text": payload} if kind == "delta" else payload
+                    await response.write(_sse(kind, data))
+            finally:
+                await events.aclose()
+    except Overloaded as e:
+        trace.finish("rejected", e)
+        if response is None:
+            return _overloaded_response(e)
+        await response.write(_sse("error", {"error": "overloaded", "detail": str(e)}))
+    except (ConnectionResetError, asyncio.CancelledError):
+        trace.event("client_disconnected")
+        trace.finish("cancelled")
+        raise
+    except Exception as e:
+        trace.finish("error", e)
+        if response is None:
+            return web.json_response({"error": str(e), "session_id": session.id}, status=502)
+        await response.write(_sse("error", {"error": str(e)}))
+    trace.finish()
+    await response.write_eof()
+    return response
+
+
+async def handle_drop_session(request):
+    dropped = request.app["service"].sessions.drop(request.match_info["session_id"])
+    return web.json_response({"dropped": dropped}, status=200 if dropped else 404)
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {_dumps(data)}\n\n".encode("utf-8")
+
+
+def make_app(service):
+    app = web.Application(client_max_size=1024 * 1024)
+    app["service"] = service
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.close)
+    app.add_routes([
+        web.get("/health", handle_health),
+        web.get("/metrics", handle_metrics),
+        web.post("/retrieve", handle_retrieve),
+        web.post("/answer", handle_answer),
+        web.post("/answer/stream", handle_answer_stream),
+        web.delete("/sessions/{session_id}", handle_drop_session),
+    ])
+    return app
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Async HTTP API for retrieval and answering")
+    parser.add_argument("--host", default=os.getenv("RAG_API_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("RAG_API_PORT", 8000)))
+    parser.add_argument("--store", default=None, help="faiss_db or chroma_db (default: RAG_API_STORE or faiss_db)")
+    parser.add_argument("--offline", action="store_true", help="use HashingEmbeddings instead of E5 (no download)")
+    args = parser.parse_args()
+
+    embedding = HashingEmbeddings() if args.offline else None
+    service = RAGService.from_env(args.store, embedding)
+    print(f"RAG API: store={service.store_dir} model={service.model} "
+          f"llm_concurrency={service.llm_concurrency} max_queue={service.max_queue}")
+    web.run_app(make_app(service), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""rag_api.py 的壓力測試：模擬 1、4、16… 位同時在線的使用者，量測吞吐量、延遲與 503 比例。
+
+每位使用者有自己的 session，依序送出 `--requests` 個問題（取自 rag_bench_queries.jsonl），
+收到回覆才送下一題。串流端點另外記錄 time-to-first-token（第一個 delta 事件）。
+
+用法（離線：mock LLM + HashingEmbeddings）：
+    python rag_mock_llm_server.py --port 8001
+    set RAG_LLM_BASE_URL=http://127.0.0.1:8001/v1
+    python rag_api.py --offline --port 8000
+    python rag_api_loadtest.py --url http://127.0.0.1:8000 --users 1,4,16,64 --md-out load.md
+"""
+import json
+import time
+import uuid
+import asyncio
+import argparse
+
+import aiohttp
+import numpy as np
+
+from rag_bench_retrieval import DEFAULT_QUERIES_PATH, load_queries
+
+DEFAULT_USERS = "1,4,16,32"
+DEFAULT_REQUESTS_PER_USER = 5
+ENDPOINTS = {"stream": "/answer/stream", "answer": "/answer", "retrieve": "/retrieve"}
+
+
+async def run_request(http, url, endpoint, question, session_id):
+    """回傳 (HTTP status, 總秒數, TTFT 秒數或 None)。"""
+    start = time.perf_counter()
+    ttft = None
+    async with http.post(url + ENDPOINTS[endpoint], json={"question": question, "session_id": session_id}) as resp:
+        if resp.status != 200:
+            await resp.read()
+            return resp.status, time.perf_counter() - start, None
+        if endpoint != "stream":
+            await resp.read()
+        else:
+            async for line in resp.content:
+                if ttft is None and line.startswith(b"event: delta"):
+                    ttft = time.perf_counter() - start
+                elif line.startswith(b"event: error"):
+                    return "error", time.perf_counter() - start, ttft
+    return resp.status, time.perf_counter() - start, ttft
+
+
+async def run_user(http, url, endpoint, questions, requests_per_user, offset, results):
+    session_id = uuid.uuid4().hex
+    for i in range(requests_per_user):
+        question = questions[(offset + i) % len(questions)]
+        try:
+            results.append(await run_request(http, url, endpoint, question, session_id))
+        except aiohttp.ClientError as e:
+            results.append((type(e).__name__, 0.0, None))
+
+
+async def run_level(url, endpoint, questions, users, requests_per_user, timeout):
+    results = []
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(run_user(http, url, endpoint, questions, requests_per_user, u * requests_per_user,
+                                        results) for u in range(users)))
+        wall = time.perf_counter() - start
+        async with http.get(url + "/metrics") as resp:
+            metrics = await resp.json()
+    return summarize(users, results, wall, metrics)
+
+
+def summarize(users, results, wall, metrics):
+    ok = [r for r in results if r[0] == 200]
+    latencies = np.asarray([r[1] for r in ok]) * 1000
+    ttfts = np.asarray([r[2] for r in ok if r[2] is not None]) * 1000
+
+    def pct(values, q):
+        return float(np.percentile(values, q)) if len(values) else None
+
+    return {
+        "users": users,
+        "requests": len(results),
+        "ok": len(ok),
+        "rejected": sum(1 for r in results if r[0] == 503),
+        "errors": sum(1 for r in results if r[0] not in (200, 503)),
+        "throughput_rps": len(ok) / wall if wall else 0.0,
+        "p50_ms": pct(latencies, 50),
+        "p95_ms": pct(latencies, 95),
+        "ttft_p50_ms": pct(ttfts, 50),
+        "ttft_p95_ms": pct(ttfts, 95),
+        "llm_queue_p95_ms": metrics.get("stages", {}).get("llm_queue", {}).get("p95_ms"),
+        "wall_s": wall,
+    }
+
+
+def format_markdown(rows):
+    headers = ["users", "requests", "ok", "503", "errors", "req/s", "p50 ms", "p95 ms",
+               "TTFT p50 ms", "TTFT p95 ms", "LLM queue p95 ms"]
+    keys = ["users", "requests", "ok", "rejected", "errors", "throughput_rps", "p50_ms", "p95_ms",
+            "ttft_p50_ms", "ttft_p95_ms", "llm_queue_p95_ms"]
+    lines = ["| " + " | ".join(headers) + " |", "|" + "---|" * len(headers)]
+    for r in rows:
+        cells = []
+        for key in keys:
+            value = r[key]
+            cells.append("-" if value is None else f"{value:.1f}" if isinstance(value, float) else str(value))
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+async def main_async(args):
+    questions = [q["question"] for q in load_queries(args.queries)]
+    rows = []
+    for users in sorted({int(u) for u in args.users.split(",")}):
+        row = await run_level(args.url.rstrip("/"), args.endpoint, questions, users, args.requests, args.timeout)
+        rows.append(row)
+        print(f"{users:>4} users: {row['ok']}/{row['requests']} ok, {row['rejected']} rejected, "
+              f"{row['throughput_rps']:.1f} req/s, p95 {row['p95_ms'] or 0:.0f} ms")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for rag_api.py")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoint", choices=list(ENDPOINTS), default="stream")
+    parser.add_argument("--users", default=DEFAULT_USERS, help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS_PER_USER, help="requests per user")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES_PATH)
+    parser.add_argument("--timeout", type=float, default=120.0, help="client timeout per level (seconds)")
+    parser.add_argument("--json-out", help="write results as JSON")
+    parser.add_argument("--md-out", help="write results as a Markdown table")
+    args = parser.parse_args()
+
+    rows = asyncio.run(main_async(args))
+    markdown = format_markdown(rows)
+    print()
+    print(markdown)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"url": args.url, "endpoint": args.endpoint, "results": rows}, f, ensure_ascii=False, indent=2)
+    if args.md_out:
+        with open(args.md_out, "w", encoding="utf-8") as f:
+            f.write(markdown + "\n")
+
+
+if __name__ == "__main__":
+    main()
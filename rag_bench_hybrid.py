@@ -0,0 +1,96 @@
+"""比較純 dense 檢索與 hybrid（dense + BM25 + RRF）檢索的延遲。
+
+用法：
+    python rag_bench_hybrid.py --store faiss_db --repeat 50
+    python rag_bench_hybrid.py --store faiss_db --offline   # 不下載 E5，以固定的假向量只量測延遲
+
+query 向量事先算好並重複使用，量到的差異就是 BM25 查詢、RRF 融合與補抓 Document 的額外成本。
+"""
+import time
+import argparse
+
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+
+from rag_faiss_index import load_store
+from rag_lexical import LexicalIndex, write_lexical_index
+from rag_retrieval import hybrid_search
+
+DEFAULT_QUERIES = [
+    "GIT reset 怎麼寫？",
+    "git reset --hard",
+    "Vue 的 props 是甚麼用途",
+    "AWS EC2 是甚麼？",
+    "t3.micro 的規格",
+    "S3 bucket policy",
+]
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """把每個 query 的向量先算好，計時時不包含 embedding 模型的時間。"""
+
+    def __init__(self, base, queries):
+        self.vectors = {q: base.embed_query(q) for q in queries}
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+    def embed_documents(self, texts):
+        return [self.vectors[t] for t in texts]
+
+
+def percentile_ms(samples, p):
+    return float(np.percentile(samples, p) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dense vs hybrid retrieval latency")
+    parser.add_argument("--store", default="faiss_db", help="FAISS folder")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--offline", action="store_true", help="use deterministic fake query vectors")
+    parser.add_argument("--query", action="append", help="query to benchmark (repeatable)")
+    args = parser.parse_args()
+    queries = args.query or DEFAULT_QUERIES
+
+    store = load_store(args.store, DeterministicFakeEmbedding(size=1))
+    if args.offline:
+        base = DeterministicFakeEmbedding(size=store.index.d)
+    else:
+        from rag_embeddings import make_embeddings
+        base = make_embeddings()
+    store.embedding_function = PrecomputedEmbeddings(base, queries)
+
+    start = time.perf_counter()
+    lexical = LexicalIndex.load(args.store)
+    load_seconds = time.perf_counter() - start
+    if lexical is None:
+        print("找不到 BM25 索引，先依目前的向量資料庫建立。")
+        lexical = write_lexical_index(store, args.store)
+        start = time.perf_counter()
+        lexical = LexicalIndex.load(args.store)
+        load_seconds = time.perf_counter() - start
+    print(f"BM25 index: {len(lexical)} chunks, {len(lexical.vocab)} terms, load {load_seconds * 1000:.1f} ms")
+
+    dense, hybrid, added = [], [], 0
+    for _ in range(args.repeat):
+        for q in queries:
+            t0 = time.perf_counter()
+            dense_docs = store.similarity_search(q, k=args.k)
+            t1 = time.perf_counter()
+            hybrid_docs = hybrid_search(store, q, args.k, lexical=lexical)
+            t2 = time.perf_counter()
+            dense.append(t1 - t0)
+            hybrid.append(t2 - t1)
+            added += len({d.id for d in hybrid_docs} - {d.id for d in dense_docs})
+
+    n = len(dense)
+    print(f"{n} searches, k={args.k}")
+    print(f"dense   p50 {percentile_ms(dense, 50):7.2f} ms  p95 {percentile_ms(dense, 95):7.2f} ms")
+    print(f"hybrid  p50 {percentile_ms(hybrid, 50):7.2f} ms  p95 {percentile_ms(hybrid, 95):7.2f} ms")
+    print(f"overhead p50 {percentile_ms(hybrid, 50) - percentile_ms(dense, 50):+.2f} ms; "
+          f"hybrid results not in dense top-{args.k}: {added / n:.2f} per query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""檢索基準測試：recall@k、MRR、查詢延遲 p50/p95/p99，以及索引建置時間、大小與常駐記憶體。
+
+對每一組 (切割參數 × backend × FAISS 索引類型 × dense/hybrid) 從 uploaded_docs 重新建立暫存索引，
+以標註好的問題集（JSONL）評分，結果輸出成 JSON 與 Markdown 表格。
+
+用法：
+    python rag_bench_retrieval.py --offline                  # 以 HashingEmbeddings 離線執行（CI 用）
+    python rag_bench_retrieval.py --backends faiss,chroma --chunking 500:100,300:50 \\
+        --index-specs "Flat;HNSW32@efSearch=64;IVF16,Flat@nprobe=4" --k 1,3,5,10 --json-out bench.json --md-out bench.md
+    python rag_bench_retrieval.py --backends faiss --index-specs "Flat;PCA256,SQfp16@rescore=4;PCA256,SQ8@rescore=8"
+
+問題集每行一個 JSON：
+    {"question": "...", "source": "Vue3 + Vite.pdf", "contains": ["props"]}
+區塊符合所有給定條件即視為相關：`source`（檔名）、`pages`（頁碼清單）、
+`contains`（內文包含任一字串，不分大小寫）、`chunk_ids`（指定 chunk ID，只適用於單一切割參數）。
+"""
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from importlib.util import find_spec
+
+import numpy as np
+
+from rag_chunking import DocumentSplitter
+from rag_embeddings import HashingEmbeddings, make_embeddings
+from rag_faiss_index import DEFAULT_INDEX_SPEC, is_flat, load_index_settings, resident_bytes, transform_bytes
+from rag_index_manifest import assign_chunk_ids
+from rag_lexical import LexicalIndex
+from rag_loaders import list_upload_files, load_files_parallel
+from rag_retrieval import hybrid_search
+from rag_vectorstores import Chroma, ChromaWriter, FaissWriter, open_vectorstore
+
+DEFAULT_QUERIES_PATH = "rag_bench_queries.jsonl"
+DEFAULT_CHUNKING = "500:100"
+DEFAULT_KS = "1,3,5,10"
+LABEL_KEYS = ("source", "pages", "contains", "chunk_ids")
+
+
+def load_queries(path):
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            query = json.loads(line)
+            if "question" not in query or not any(k in query for k in LABEL_KEYS):
+                raise ValueError(f"{path}:{line_no} 需要 question 以及 {'/'.join(LABEL_KEYS)} 其中一個標註")
+            queries.append(query)
+    return queries
+
+
+def source_name(doc):
+    # 建置時的 source 可能是 Windows 路徑（uploaded_docs\\xxx.pdf）
+    return re.split(r"[\\/]", str(doc.metadata.get("source", "")))[-1]
+
+
+def is_relevant(doc, query):
+    if "chunk_ids" in query and doc.metadata.get("chunk_id") not in query["chunk_ids"]:
+        return False
+    if "source" in query and source_name(doc) != query["source"]:
+        return False
+    if "pages" in query and doc.metadata.get("page") not in query["pages"]:
+        return False
+    if "contains" in query:
+        text = doc.page_content.lower()
+        if not any(c.lower() in text for c in query["contains"]):
+            return False
+    return True
+
+
+def evaluate(search, queries, ks):
+    """對每個問題取前 max(ks) 筆，回傳 recall@k（前 k 筆內至少一筆相關的比例）、MRR 與延遲。"""
+    k_max = max(ks)
+    hits = {k: 0 for k in ks}
+    reciprocal_ranks, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        docs = search(query["question"], k_max)
+        latencies.append(time.perf_counter() - start)
+        rank = next((i for i, d in enumerate(docs, start=1) if is_relevant(d, query)), None)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+        for k in ks:
+            hits[k] += rank is not None and rank <= k
+    n = max(len(queries), 1)
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        **{f"recall@{k}": hits[k] / n for k in ks},
+        "mrr": float(np.mean(reciprocal_ranks)) if reciprocal_ranks else 0.0,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, fn)) for root, _, files in os.walk(path) for fn in files)
+
+
+def build_store(backend, store_dir, embedding, chunks, ids, vectors, index_spec):
+    """以預先算好的向量建立索引，回傳建置秒數（寫入 + 存檔，不含 embedding）。
+
+    FAISS 的 index_spec 可在 "@" 後附上查詢參數，例如 "IVF16,Flat@nprobe=4"。
+    """
+    start = time.perf_counter()
+    if backend == "faiss":
+        spec, _, search_params = index_spec.partition("@")
+        writer = FaissWriter(store_dir, embedding, index_spec=spec, search_params=search_params)
+    else:
+        writer = ChromaWriter(store_dir, embedding)
+    writer.add_embeddings(chunks, ids, vectors)
+    writer.flush()
+    return time.perf_counter() - start
+
+
+def built_index_label(store_dir, index_spec):
+    """實際存下的索引類型；spec 不適用於資料時 save_store 會改存 Flat，表格要標示出來，不能沿用要求的 spec。"""
+    spec = index_spec.partition("@")[0]
+    saved = (load_index_settings(store_dir) or {}).get("spec", DEFAULT_INDEX_SPEC)
+    if is_flat(saved) and not is_flat(spec):
+        return f"{saved} (fallback from {index_spec})"
+    return index_spec
+
+
+def parse_chunking(value):
+    settings = []
+    for item in value.split(","):
+        size, _, overlap = item.strip().partition(":")
+        settings.append((int(size), int(overlap or 0)))
+    return settings
+
+
+def format_resident(row):
+    if row["resident_bytes"] is None:
+        return "-"
+    cell = f"{row['resident_bytes'] / 1e6:.2f}"
+    if row.get("transform_bytes"):
+        # PCA 矩陣大小固定，區塊數少時可能讓壓縮索引比 Flat 還大
+        cell += f" (PCA {row['transform_bytes'] / 1e6:.2f})"
+    return cell
+
+
+def format_markdown(rows, ks):
+    headers = (["backend", "chunking", "index", "mode", "chunks"] + [f"R@{k}" for k in ks]
+               + ["MRR", "p50 ms", "p95 ms", "p99 ms", "build s", "size MB", "index RAM MB"])
+    lines = ["| " + " | ".join(headers) + " |", "|" + "---|" * len(headers)]
+    for r in rows:
+        cells = ([r["backend"], f"{r['chunk_size']}/{r['chunk_overlap']}", r["index"], r["mode"], str(r["chunks"])]
+                 + [f"{r[f'recall@{k}']:.3f}" for k in ks]
+                 + [f"{r['mrr']:.3f}", f"{r['p50_ms']:.2f}", f"{r['p95_ms']:.2f}", f"{r['p99_ms']:.2f}",
+                    f"{r['build_s']:.2f}", f"{r['size_bytes'] / 1e6:.2f}",
+                    format_resident(r)])
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval benchmark: recall@k, MRR and latency")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES_PATH, help="labeled query file (JSONL)")
+    parser.add_argument("--docs", default="uploaded_docs", help="folder with the source documents")
+    parser.add_argument("--backends", default="faiss,chroma", help="comma separated: faiss, chroma")
+    parser.add_argument("--chunking", default=DEFAULT_CHUNKING, help="chunk_size:chunk_overlap list, e.g. 500:100,300:50")
+    parser.add_argument("--index-specs", default=DEFAULT_INDEX_SPEC, help='FAISS index specs separated by ";", optional search params after "@", e.g. "Flat;HNSW32@efSearch=64;IVF64,Flat@nprobe=8"')
+    parser.add_argument("--k", default=DEFAULT_KS, help="k values for recall@k")
+    parser.add_argument("--modes", default="dense,hybrid", help="dense and/or hybrid (dense + BM25 + RRF)")
+    parser.add_argument("--offline", action="store_true", help="use HashingEmbeddings instead of E5 (no download)")
+    parser.add_argument("--workers", type=int, default=None, help="document loader processes")
+    parser.add_argument("--json-out", help="write results as JSON")
+    parser.add_argument("--md-out", help="write results as a Markdown table")
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    ks = sorted({int(k) for k in args.k.split(",")})
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    specs = [s.strip() for s in args.index_specs.split(";") if s.strip()]
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    if "chroma" in backends and (Chroma is None or find_spec("chromadb") is None):
+        print("找不到 chromadb，略過 Chroma。")
+        backends.remove("chroma")
+
+    embedding = HashingEmbeddings() if args.offline else make_embeddings()
+
+    files, _ = list_upload_files(args.docs)
+    results = []
+    for result in load_files_parallel(args.docs, files, workers=args.workers):
+        if result.error:
+            print(f"載入 {result.fn} 失敗: {result.error}")
+        else:
+            results.append(result)
+    if not results:
+        # 例如缺少 pypdf 時所有 PDF 都會失敗；不要繼續建立空索引
+        raise SystemExit(f"沒有載入任何文件（{args.docs}，{len(files)} 個檔案）。結束程式。")
+    print(f"{len(queries)} 個問題、{len(results)} 份文件；embedding: {type(embedding).__name__}")
+
+    rows = []
+    work_dir = tempfile.mkdtemp(prefix="rag_bench_")
+    try:
+        for chunk_size, chunk_overlap in parse_chunking(args.chunking):
+            splitter = DocumentSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+            chunks, ids = [], []
+            for result in results:
+                split = splitter.split_documents(result.docs)
+                ids.extend(assign_chunk_ids(split, result.fn, f"{chunk_size}:{chunk_overlap}"))
+                chunks.extend(split)
+            if not chunks:
+                raise SystemExit(f"切割參數 {chunk_size}:{chunk_overlap} 沒有產生任何區塊（文件沒有文字內容？）。結束程式。")
+            start = time.perf_counter()
+            vectors = embedding.embed_documents([c.page_content for c in chunks])
+            embed_seconds = time.perf_counter() - start
+            lexical = LexicalIndex.build(ids, [c.page_content for c in chunks]) if "hybrid" in modes else None
+
+            for backend in backends:
+                for spec in specs if backend == "faiss" else ["-"]:
+                    store_dir = os.path.join(work_dir, f"{backend}_{chunk_size}_{chunk_overlap}_{len(rows)}")
+                    build_seconds = build_store(backend, store_dir, embedding, chunks, ids, vectors, spec)
+                    label = built_index_label(store_dir, spec) if backend == "faiss" else spec
+                    # 與 app 相同的載入方式（FAISS 為 memory map + SQLite docstore）
+                    store = open_vectorstore(store_dir, embedding)
+                    # 查詢時常駐記憶體的索引大小（rescore 的原始向量以 memory map 留在磁碟，不計入）
+                    resident = resident_bytes(store.index) if backend == "faiss" else None
+                    transform = transform_bytes(store.index) if backend == "faiss" else None
+                    for mode in modes:
+                        index = lexical if mode == "hybrid" else None
+
+                        def search(question, k, store=store, index=index):
+                            return hybrid_search(store, question, k, lexical=index)
+
+                        row = {
+                            "backend": backend, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap,
+                            "index": label, "requested_index": spec, "mode": mode, "chunks": len(chunks),
+                            **evaluate(search, queries, ks),
+                            "embed_s": embed_seconds, "build_s": build_seconds, "size_bytes": dir_size(store_dir),
+                            "resident_bytes": resident, "transform_bytes": transform,
+                        }
+                        rows.append(row)
+                        print(f"{backend:<6} {chunk_size}/{chunk_overlap} {label:<12} {mode:<6} "
+                              f"R@{ks[-1]} {row[f'recall@{ks[-1]}']:.3f}  MRR {row['mrr']:.3f}  "
+                              f"p95 {row['p95_ms']:.2f} ms")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    markdown = format_markdown(rows, ks)
+    print()
+    print(markdown)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"queries": args.queries, "embedding": type(embedding).__name__, "k": ks, "results": rows},
+                      f, ensure_ascii=False, indent=2)
+    if args.md_out:
+        with open(args.md_out, "w", encoding="utf-8") as f:
+            f.write(markdown + "\n")
+
+
+
+if __name__ == "__main__":
+    main()
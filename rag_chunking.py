@@ -0,0 +1,65 @@
+from langchain_core.documents import Document
+from langchain_text_splitters import Language, MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+
+# 依標題切段時追蹤的層級；heading_path 以 " > " 串接，例如 "Git 筆記 > reset > --hard"
+HEADERS_TO_SPLIT_ON = [("#", "h1"), ("##", "h2"), ("###", "h3")]
+HEADING_PATH_SEPARATOR = " > "
+
+
+def parse_front_matter(text):
+    """拆出檔案開頭 `---` 包住的 key: value 區塊，回傳 (metadata, 內文)。"""
+    if not text.startswith("---\n"):
+        return {}, text
+    end = text.find("\n---\n", 4)
+    if end == -1:
+        return {}, text
+    meta = {}
+    for line in text[4:end].splitlines():
+        key, sep, value = line.partition(":")
+        if sep and key.strip():
+            meta[key.strip()] = value.strip()
+    return meta, text[end + len("\n---\n"):]
+
+
+def format_front_matter(meta):
+    lines = [f"{k}: {' '.join(str(v).split())}" for k, v in meta.items() if v not in (None, "")]
+    return "---\n" + "\n".join(lines) + "\n---\n"
+
+
+def is_markdown(doc):
+    return doc.metadata.get("source", "").lower().endswith(".md")
+
+
+class DocumentSplitter:
+    """依文件格式挑選切割方式的 splitter，介面與 LangChain splitter 的 split_documents 相同。
+
+    一般文件（PDF、Word、純文字）沿用 RecursiveCharacterTextSplitter；Markdown（例如直接從
+    Notion 匯出的 .md）先依標題切段，把標題路徑寫入 `heading_path` metadata，再以
+    Markdown 分隔符號切到 chunk_size，盡量不把程式碼區塊從中間切斷。
+    每個區塊的 `start_index` metadata 記錄它在該頁/章節內的字元位置，查詢時 rag_context 依此合併重疊的區塊。
+    """
+
+    def __init__(self, chunk_size, chunk_overlap):
+        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                                            add_start_index=True)
+        self.markdown_splitter = RecursiveCharacterTextSplitter.from_language(
+            Language.MARKDOWN, chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+        self.header_splitter = MarkdownHeaderTextSplitter(HEADERS_TO_SPLIT_ON, strip_headers=False)
+
+    def split_documents(self, docs):
+        chunks = []
+        for doc in docs:
+            if is_markdown(doc):
+                chunks.extend(self.split_markdown(doc))
+            else:
+                chunks.extend(self.text_splitter.split_documents([doc]))
+        return chunks
+
+    def split_markdown(self, doc):
+        sections = []
+        for section in self.header_splitter.split_text(doc.page_content):
+            headings = [section.metadata[name] for _, name in HEADERS_TO_SPLIT_ON if name in section.metadata]
+            metadata = dict(doc.metadata)
+            metadata["heading_path"] = HEADING_PATH_SEPARATOR.join(headings)
+            sections.append(Document(page_content=section.page_content, metadata=metadata))
+        return self.markdown_splitter.split_documents(sections)
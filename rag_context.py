@@ -0,0 +1,228 @@
+"""組合送進 LLM 的檢索內容：合併重疊的區塊、去掉近似重複，並控制在 token 預算內。
+
+切割時 chunk_overlap=100，同一份文件相鄰的兩個命中會重複最多 100 個字元；直接以 "\\n\\n" 串接
+top-k 的 page_content 會讓 prompt 變長、LLM 延遲與費用增加。建置索引時 DocumentSplitter 會在
+metadata 記錄 `start_index`（區塊在該頁/章節內的字元位置），查詢時：
+
+  1. 同一來源（source + page + heading_path）位置重疊或相鄰的區塊合併成一段，重疊部分只保留一次
+  2. 依檢索排名挑選段落，與已選段落的字元 shingle 重疊比例 >= 門檻時視為近似重複而略過（MMR 風格）
+  3. 依 rag_llm.estimate_tokens 累計，超過預算的段落略過，第一段放不下時截斷
+
+沒有 start_index 的舊索引只做 2、3，重建索引後才會合併。
+
+環境變數：
+    RAG_CONTEXT_TOKENS=2000         內容的 token 預算（0 表示不限制）
+    RAG_CONTEXT_DEDUP=0.8           近似重複的門檻（shingle 重疊比例）
+    RAG_CONTEXT_PACKING=0           關閉，改回直接串接（比較用）
+"""
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+
+from rag_llm import estimate_tokens
+from rag_vectorstores import chunk_id_of
+
+DEFAULT_MAX_TOKENS = 2000
+DEFAULT_DUPLICATE_THRESHOLD = 0.8
+CHUNK_SEPARATOR = "\n\n"
+SHINGLE_SIZE = 3
+# 剩餘預算少於這個值時不截斷段落，只放得下的才放
+MIN_TRUNCATED_TOKENS = 50
+# splitter 會去掉區塊頭尾的空白，前後兩個區塊之間只差這麼幾個字元時視為相鄰
+ADJACENT_GAP = 2
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+@dataclass
+class Span:
+    """同一來源內一段連續的文字，由一或多個區塊合併而成；rank 為其中最前面的檢索名次。"""
+
+    key: tuple
+    start: int
+    end: int
+    text: str
+    rank: int
+    chunk_ids: list = field(default_factory=list)
+
+
+def span_key(doc):
+    """可以互相合併的範圍：同一檔案、同一頁（PDF）、同一標題路徑（Markdown）。"""
+    meta = doc.metadata
+    return meta.get("source", ""), meta.get("page"), meta.get("heading_path", "")
+
+
+def doc_span(doc, rank):
+    start = doc.metadata.get("start_index")
+    if not isinstance(start, int) or start < 0:
+        start = None
+    return Span(key=span_key(doc) if start is not None else None, start=start or 0,
+                end=(start or 0) + len(doc.page_content), text=doc.page_content, rank=rank,
+                chunk_ids=[chunk_id_of(doc)])
+
+
+def _try_merge(left, right):
+    """right 從 left 範圍內或緊接在 left 之後開始時合併；重疊的文字不一致（位置不可信）就不合併。"""
+    gap = right.start - left.end
+    if gap > ADJACENT_GAP:
+        return None
+    if gap > 0:
+        # 中間是被去掉的空白（通常是段落分隔），以換行接起來
+        text = left.text + "\n" + right.text
+    else:
+        overlap = -gap
+        if left.text[right.start - left.start:] != right.text[:overlap]:
+            return None
+        text = left.text + right.text[overlap:] if right.end > left.end else left.text
+    return Span(key=left.key, start=left.start, end=max(left.end, right.end), text=text,
+                rank=min(left.rank, right.rank), chunk_ids=left.chunk_ids + right.chunk_ids)
+
+
+def merge_spans(spans):
+    """合併同一來源位置重疊或相鄰的段落，回傳依 rank 排序的段落。"""
+    groups, merged = {}, []
+    for span in spans:
+        if span.key is None:
+            merged.append(span)
+        else:
+            groups.setdefault(span.key, []).append(span)
+    for group in groups.values():
+        group.sort(key=lambda s: (s.start, s.end))
+        current = group[0]
+        for span in group[1:]:
+            combined = _try_merge(current, span)
+            if combined is None:
+                merged.append(current)
+                current = span
+            else:
+                current = combined
+        merged.append(current)
+    return sorted(merged, key=lambda s: s.rank)
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    text = _WHITESPACE.sub(" ", text).strip().lower()
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def overlap_ratio(a, b):
+    """shingle 交集佔較小集合的比例；較短的段落幾乎被另一段包含時接近 1。"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """以二分搜尋找出 estimate_tokens 不超過 max_tokens 的最長前綴。"""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+class ContextPacker:
+    """把檢索到的 Document 組成 prompt 內容，並累計節省的 token 數。"""
+
+    def __init__(self, max_tokens=DEFAULT_MAX_TOKENS, duplicate_threshold=DEFAULT_DUPLICATE_THRESHOLD,
+                 enabled=True, separator=CHUNK_SEPARATOR):
+        self.max_tokens = max_tokens
+        self.duplicate_threshold = duplicate_threshold
+        self.enabled = enabled
+        self.separator = separator
+        self.requests = 0
+        self.raw_tokens = 0
+        self.packed_tokens = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_tokens=int(os.getenv("RAG_CONTEXT_TOKENS", DEFAULT_MAX_TOKENS)),
+            duplicate_threshold=float(os.getenv("RAG_CONTEXT_DEDUP", DEFAULT_DUPLICATE_THRESHOLD)),
+            enabled=os.getenv("RAG_CONTEXT_PACKING", "1").lower() not in ("0", "false", "no", "off"),
+        )
+
+    def pack(self, docs, max_tokens=None):
+        """回傳 (context 文字, 統計)；docs 需依檢索排名排序。
+
+        `max_tokens` 覆寫這次呼叫的 token 預算（0 為不限制），packer 由多個 session 共用時不修改共用設定。
+        """
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        raw = self.separator.join(d.page_content for d in docs)
+        report = {"chunks": len(docs), "raw_tokens": estimate_tokens(raw)}
+        if not self.enabled:
+            return raw, self._record(report, raw, spans=len(docs), merged=0, duplicates=0, over_budget=0,
+                                     truncated=False)
+
+        spans = merge_spans([doc_span(d, rank) for rank, d in enumerate(docs)])
+        selected, seen = [], []
+        duplicates = over_budget = 0
+        truncated = False
+        used = 0
+        for span in spans:
+            grams = shingles(span.text)
+            if any(overlap_ratio(grams, other) >= self.duplicate_threshold for other in seen):
+                duplicates += 1
+                continue
+            text = span.text
+            cost = estimate_tokens(text) + (estimate_tokens(self.separator) if selected else 0)
+            if max_tokens and used + cost > max_tokens:
+                remaining = max_tokens - used
+                if selected or remaining < MIN_TRUNCATED_TOKENS:
+                    over_budget += 1
+                    continue
+                text = truncate_to_tokens(text, remaining)
+                cost = estimate_tokens(text)
+                truncated = True
+            selected.append(text)
+            seen.append(grams)
+            used += cost
+        context = self.separator.join(selected)
+        return context, self._record(report, context, spans=len(spans), merged=len(docs) - len(spans),
+                                     duplicates=duplicates, over_budget=over_budget, truncated=truncated)
+
+    def _record(self, report, context, **counts):
+        report.update(counts)
+        report["packed_tokens"] = estimate_tokens(context)
+        report["saved_tokens"] = report["raw_tokens"] - report["packed_tokens"]
+        with self._lock:
+            self.requests += 1
+            self.raw_tokens += report["raw_tokens"]
+            self.packed_tokens += report["packed_tokens"]
+        return report
+
+    def stats(self):
+        with self._lock:
+            saved = self.raw_tokens - self.packed_tokens
+            return {
+                "enabled": self.enabled,
+                "max_tokens": self.max_tokens,
+                "requests": self.requests,
+                "raw_tokens": self.raw_tokens,
+                "packed_tokens": self.packed_tokens,
+                "saved_tokens": saved,
+                "saved_ratio": saved / self.raw_tokens if self.raw_tokens else 0.0,
+            }
+
+
+def format_context_report(report):
+    """一行摘要，給終端機 log 與 Streamlit caption 使用。"""
+    raw, packed = report["raw_tokens"], report["packed_tokens"]
+    line = (f"context {raw} -> {packed} tokens (saved {report['saved_tokens']}, "
+            f"{report['saved_tokens'] / raw if raw else 0.0:.0%}) · {report['chunks']} chunks -> "
+            f"{report['spans']} spans")
+    extras = [f"{report['merged']} merged"] if report["merged"] else []
+    if report["duplicates"]:
+        extras.append(f"{report['duplicates']} near-duplicate dropped")
+    if report["over_budget"]:
+        extras.append(f"{report['over_budget']} over budget")
+    if report["truncated"]:
+        extras.append("truncated")
+    return line + (f" ({', '.join(extras)})" if extras else "")
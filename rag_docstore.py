@@ -0,0 +1,123 @@
+import os
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from collections.abc import Mapping
+
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+
+DOCSTORE_NAME = "docstore.sqlite"
+STORE_MANIFEST_NAME = "store.json"
+STORE_FORMAT = 1
+
+
+def read_store_manifest(store_dir):
+    """讀取向量資料庫資料夾內的 store.json（記錄 backend 與檔案格式）；不存在時回傳 None。"""
+    try:
+        with open(os.path.join(store_dir, STORE_MANIFEST_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_store_manifest(store_dir, backend, **extra):
+    path = os.path.join(store_dir, STORE_MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"backend": backend, "format": STORE_FORMAT, **extra}, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def write_docstore(store_dir, docstore, index_to_docstore_id):
+    """把 FAISS 的 docstore 與 index_to_docstore_id 寫成 SQLite，取代 LangChain 的 index.pkl。"""
+    path = os.path.join(store_dir, DOCSTORE_NAME)
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    db = sqlite3.connect(tmp)
+    try:
+        db.execute("CREATE TABLE chunks (pos INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, "
+                   "content TEXT NOT NULL, metadata TEXT NOT NULL)")
+        rows = []
+        for pos, doc_id in sorted(index_to_docstore_id.items()):
+            doc = docstore.search(doc_id)
+            rows.append((int(pos), doc_id, doc.page_content,
+                         json.dumps(doc.metadata, ensure_ascii=False, default=str)))
+        db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp, path)
+    return len(rows)
+
+
+class SqliteDocstore(Docstore):
+    """唯讀的 SQLite docstore：只在檢索命中時才讀取該區塊的內文與 metadata。
+
+    單一連線由多個執行緒（Streamlit session）共用，以 lock 保護。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+
+    def search(self, search):
+        with self._lock:
+            row = self._db.execute("SELECT id, content, metadata FROM chunks WHERE id = ?", (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return _document(row)
+
+    def id_at(self, pos):
+        with self._lock:
+            row = self._db.execute("SELECT id FROM chunks WHERE pos = ?", (pos,)).fetchone()
+        return row[0] if row else None
+
+    def ids(self):
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT id FROM chunks ORDER BY pos")]
+
+    def load_all(self):
+        """一次讀出全部區塊，回傳 ({id: Document}, {pos: id})，給需要可寫入 store 的增量建置使用。"""
+        with self._lock:
+            rows = self._db.execute("SELECT pos, id, content, metadata FROM chunks ORDER BY pos").fetchall()
+        docs = {row[1]: _document(row[1:]) for row in rows}
+        return docs, {row[0]: row[1] for row in rows}
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SqliteIndexMap(Mapping):
+    """FAISS 向量位置 -> chunk ID 的對照，查詢時才向 SqliteDocstore 讀取，不必整份載入記憶體。"""
+
+    def __init__(self, docstore):
+        self.docstore = docstore
+        self._len = len(docstore)
+
+    def __getitem__(self, pos):
+        doc_id = self.docstore.id_at(int(pos))
+        if doc_id is None:
+            raise KeyError(pos)
+        return doc_id
+
+    def __iter__(self):
+        return iter(range(self._len))
+
+    def __len__(self):
+        return self._len
+
+    def values(self):
+        return self.docstore.ids()
+
+
+def _document(row):
+    doc_id, content, metadata = row
+    return Document(id=doc_id, page_content=content, metadata=json.loads(metadata))
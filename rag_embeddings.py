@@ -0,0 +1,623 @@
+import os
+import json
+import time
+import queue
+import sqlite3
+import hashlib
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Optional
+
+import numpy as np
+from pydantic import Field
+from langchain_core.embeddings import Embeddings
+from langchain_community.embeddings import HuggingFaceEmbeddings
+
+from rag_lexical import tokenize
+
+E5_MODEL_NAME = "intfloat/multilingual-e5-large"
+PASSAGE_PREFIX = "passage: "
+QUERY_PREFIX = "query: "
+
+DEFAULT_CACHE_DIR = ".embed_cache"
+DEFAULT_CACHE_MAX_MB = 1024
+DEFAULT_HASHING_DIM = 384
+DEFAULT_ONNX_DIR = os.path.join(".onnx", "multilingual-e5-large-int8")
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_INFO_FILE = "onnx_model.json"
+
+# 每批最多的 (batch 大小 x 最長序列) token 數；短區塊因此能用較大的 batch
+DEFAULT_TOKEN_BUDGET = int(os.getenv("RAG_EMBED_TOKEN_BUDGET", 8192))
+DEFAULT_MAX_BATCH_SIZE = 128
+# sentence-transformers encode() 預設的 batch 大小，用來估算原本做法的 padding
+NAIVE_BATCH_SIZE = 32
+
+
+def plan_batches(lengths, token_budget=DEFAULT_TOKEN_BUDGET, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+    """依 token 長度排序後切成批次，回傳每批的原始索引清單。
+
+    排序後長度相近的文字會落在同一批，每批大小由 `token_budget // 該批最長長度` 決定，
+    因此 padding 只發生在長度相近的文字之間。
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, batch = [], []
+    for i in order:
+        longest = max(lengths[i], 1)
+        if batch and ((len(batch) + 1) * longest > token_budget or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def padded_tokens(lengths, batches):
+    return sum(len(b) * max(lengths[i] for i in b) for b in batches)
+
+
+def embed_with_cache(cache, model_name, normalize, texts, prefix, encode):
+    """先查 EmbeddingCache，只把未命中的文字（加上前綴）交給 `encode`，回傳與輸入同順序的 float32 矩陣。"""
+    texts = list(texts)
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    if cache is None:
+        return encode([prefix + t for t in texts])
+
+    keys = [cache.make_key(model_name, prefix, normalize, t) for t in texts]
+    vectors = cache.get_many(keys)
+    missing = {}
+    for i, vec in enumerate(vectors):
+        if vec is None:
+            missing.setdefault(keys[i], i)
+    if missing:
+        encoded = encode([prefix + texts[i] for i in missing.values()])
+        cache.put_many(list(missing), encoded)
+        by_key = dict(zip(missing, encoded))
+        vectors = [by_key[keys[i]] if vec is None else vec for i, vec in enumerate(vectors)]
+    return np.vstack(vectors)
+
+
+@dataclass
+class EmbeddingStats:
+    """累計實際送進模型的文字數、token 數、padding 與耗時。"""
+
+    texts: int = 0
+    batches: int = 0
+    tokens: int = 0
+    padded_tokens: int = 0
+    naive_padded_tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def padding_ratio(self):
+        return 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.0
+
+    @property
+    def naive_padding_ratio(self):
+        return 1 - self.tokens / self.naive_padded_tokens if self.naive_padded_tokens else 0.0
+
+    @property
+    def tokens_per_second(self):
+        return self.tokens / self.seconds if self.seconds else 0.0
+
+    def record(self, texts, lengths, batches, seconds):
+        self.seconds += seconds
+        self.texts += len(texts)
+        self.batches += len(batches)
+        self.tokens += sum(lengths)
+        self.padded_tokens += padded_tokens(lengths, batches)
+        # 原本的做法：sentence-transformers 依字元數排序後固定 32 筆一批
+        by_chars = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+        naive = [by_chars[i:i + NAIVE_BATCH_SIZE] for i in range(0, len(texts), NAIVE_BATCH_SIZE)]
+        self.naive_padded_tokens += padded_tokens(lengths, naive)
+
+    def report(self):
+        if not self.texts:
+            return "Embedding 統計：沒有送進模型的文字（全部命中快取）。"
+        return (f"Embedding 統計：{self.texts} 段文字、{self.batches} 批、{self.tokens} tokens，"
+                f"{self.tokens_per_second:.0f} tokens/s；padding 比例 {self.padding_ratio:.1%}"
+                f"（固定 {NAIVE_BATCH_SIZE} 筆一批約 {self.naive_padding_ratio:.1%}）")
+
+
+class EmbeddingCache:
+    """磁碟上的 embedding 快取。
+
+    向量以 float32 存在一個可 memory-map 的 `vectors.f32` 檔（每列一個 slot），
+    key -> slot 的對應與最後使用時間存在 SQLite。超過容量時依 LRU 淘汰，
+    被淘汰的 slot 會被重複使用，因此檔案大小不會超過 `max_mb`。
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_mb=DEFAULT_CACHE_MAX_MB):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.vectors_path = os.path.join(cache_dir, "vectors.f32")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite3"), check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, slot INTEGER NOT NULL, last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            CREATE TABLE IF NOT EXISTS free_slots (slot INTEGER PRIMARY KEY);
+            """
+        )
+        dim = self._get_meta("dim")
+        self.dim = int(dim) if dim else None
+        self._next_slot = int(self._get_meta("next_slot") or 0)
+        if self.dim and os.path.exists(self.vectors_path):
+            self._open_vectors()
+
+    @classmethod
+    def from_env(cls, model_name=E5_MODEL_NAME):
+        """依環境變數建立快取；RAG_EMBED_CACHE=0 或資料夾無法寫入時回傳 None。"""
+        if os.getenv("RAG_EMBED_CACHE", "1").lower() in ("0", "false", "no", "off"):
+            return None
+        base_dir = os.getenv("RAG_EMBED_CACHE_DIR", DEFAULT_CACHE_DIR)
+        max_mb = float(os.getenv("RAG_EMBED_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB))
+        # 每個模型一個子資料夾，確保同一個 vectors.f32 內的維度一致
+        safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in model_name)
+        try:
+            return cls(os.path.join(base_dir, safe_name), max_mb=max_mb)
+        except Exception as e:
+            print(f"警告: 無法使用 embedding 快取 ({e})，將直接呼叫模型。")
+            return None
+
+    @staticmethod
+    def make_key(model_name, prefix, normalize, text):
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{model_name}\x00{prefix}\x00{int(bool(normalize))}\x00{text_hash}".encode("utf-8")).hexdigest()
+
+    @property
+    def capacity(self):
+        if not self.dim:
+            return 0
+        return max(1, self.max_bytes // (self.dim * 4))
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get_many(self, keys):
+        """回傳與 keys 對應的向量清單，沒有快取的位置為 None。"""
+        found = [None] * len(keys)
+        if not keys or self._vectors is None:
+            self.misses += len(keys)
+            return found
+        with self._lock:
+            slots = {}
+            for start in range(0, len(keys), 500):
+                batch = list(set(keys[start:start + 500]))
+                placeholders = ",".join("?" * len(batch))
+                rows = self._db.execute(f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", batch)
+                slots.update(rows.fetchall())
+            for i, key in enumerate(keys):
+                slot = slots.get(key)
+                if slot is not None:
+                    found[i] = np.array(self._vectors[slot])
+            if slots:
+                now = time.time()
+                self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, k) for k in slots])
+                self._db.commit()
+        hits = sum(v is not None for v in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(keys):
+            return
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                self._set_meta("dim", self.dim)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"embedding 維度不符: 快取為 {self.dim}，輸入為 {vectors.shape[1]}")
+            existing = {}
+            for start in range(0, len(keys), 500):
+                batch = list(keys[start:start + 500])
+                placeholders = ",".join("?" * len(batch))
+                rows = self._db.execute(f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", batch)
+                existing.update(rows.fetchall())
+            items = list(dict(zip(keys, vectors)).items())
+            updated = [(k, v) for k, v in items if k in existing]
+            new_items = [(k, v) for k, v in items if k not in existing]
+            room = max(0, self.capacity - len(updated))
+            new_items = new_items[max(0, len(new_items) - room):]
+            # 先淘汰最久未使用的項目，確保檔案不會超過容量；這次要覆寫的項目不能被淘汰，否則它們的 slot 會被重複使用
+            self._evict(len(self) + len(new_items) - self.capacity, keep=existing)
+
+            now = time.time()
+            rows = []
+            for key, vec in updated + new_items:
+                slot = existing[key] if key in existing else self._allocate_slot()
+                self._vectors[slot] = vec
+                rows.append((key, slot, now))
+            self._db.executemany("INSERT OR REPLACE INTO entries (key, slot, last_used) VALUES (?, ?, ?)", rows)
+            self._vectors.flush()
+            self._set_meta("next_slot", self._next_slot)
+            self._db.commit()
+
+    def _allocate_slot(self):
+        row = self._db.execute("SELECT slot FROM free_slots LIMIT 1").fetchone()
+        if row:
+            self._db.execute("DELETE FROM free_slots WHERE slot = ?", (row[0],))
+            return row[0]
+        slot = self._next_slot
+        self._next_slot += 1
+        if self._vectors is None or slot >= self._vectors.shape[0]:
+            self._grow(slot + 1)
+        return slot
+
+    def _grow(self, min_slots):
+        current = 0 if self._vectors is None else self._vectors.shape[0]
+        new_slots = max(min_slots, min(max(current * 2, 1024), self.capacity))
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(new_slots * self.dim * 4)
+        self._open_vectors()
+
+    def _open_vectors(self):
+        slots = os.path.getsize(self.vectors_path) // (self.dim * 4)
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(slots, self.dim))
+
+    def _evict(self, overflow, keep=()):
+        if overflow <= 0:
+            return
+        rows = []
+        for key, slot in self._db.execute("SELECT key, slot FROM entries ORDER BY last_used"):
+            if key in keep:
+                continue
+            rows.append((key, slot))
+            if len(rows) >= overflow:
+                break
+        self._db.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k, _ in rows])
+        self._db.executemany("INSERT OR IGNORE INTO free_slots (slot) VALUES (?)", [(s,) for _, s in rows])
+
+    def _get_meta(self, name):
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, str(value)))
+
+
+class E5Embeddings(HuggingFaceEmbeddings):
+    """multilingual-e5-large 包裝：加上 passage/query 前綴，並共用磁碟 embedding 快取。
+
+    快取 key 由模型名稱 + 前綴 + 是否正規化 + 文字 hash 組成，
+    因此重建 FAISS/Chroma 或調整 chunk_overlap 時只會計算沒看過的文字。
+    未命中的文字依 token 長度分批（見 `plan_batches`），輸出順序與輸入相同。
+    """
+
+    cache: Optional[Any] = None
+    token_budget: int = DEFAULT_TOKEN_BUDGET
+    max_batch_size: int = DEFAULT_MAX_BATCH_SIZE
+    stats: Any = Field(default_factory=EmbeddingStats)
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("model_name", E5_MODEL_NAME)
+        kwargs.setdefault("encode_kwargs", {"normalize_embeddings": True})
+        if "cache" not in kwargs:
+            kwargs["cache"] = EmbeddingCache.from_env(kwargs["model_name"])
+        super().__init__(**kwargs)
+
+    def embed_documents(self, texts):
+        # E5 文件前綴
+        return self.embed_with_prefix(texts, PASSAGE_PREFIX).tolist()
+
+    def embed_query(self, text):
+        # E5 查詢前綴
+        return self.embed_with_prefix([text], QUERY_PREFIX)[0].tolist()
+
+    def embed_with_prefix(self, texts, prefix):
+        """回傳 float32 矩陣；先查快取，只對未命中的文字呼叫模型。"""
+        normalize = self.encode_kwargs.get("normalize_embeddings", False)
+        return embed_with_cache(self.cache, self.model_name, normalize, texts, prefix, self._encode)
+
+    def _encode(self, texts):
+        texts = [t.replace("\n", " ") for t in texts]
+        lengths = self._token_lengths(texts)
+        batches = plan_batches(lengths, self.token_budget, self.max_batch_size)
+        encode_kwargs = dict(self.encode_kwargs)
+        encode_kwargs.pop("batch_size", None)
+
+        start = time.perf_counter()
+        out = [None] * len(texts)
+        for batch in batches:
+            vectors = self.client.encode([texts[i] for i in batch], batch_size=len(batch),
+                                         show_progress_bar=False, **encode_kwargs)
+            for i, vec in zip(batch, vectors):
+                out[i] = vec
+
+        self.stats.record(texts, lengths, batches, time.perf_counter() - start)
+        return np.asarray(out, dtype=np.float32)
+
+    def _token_lengths(self, texts):
+        """以模型 tokenizer 計算（截斷後的）token 長度；沒有 tokenizer 時以字元數估計。"""
+        tokenizer = getattr(self.client, "tokenizer", None)
+        max_len = getattr(self.client, "max_seq_length", None) or 512
+        if tokenizer is None:
+            return [min(len(t) + 2, max_len) for t in texts]
+        encoded = tokenizer(texts, add_special_tokens=True, truncation=True, max_length=max_len)
+        return [len(ids) for ids in encoded["input_ids"]]
+
+
+class OnnxE5Embeddings(Embeddings):
+    """multilingual-e5-large 的 ONNX 版本（動態 int8 量化），以 onnxruntime 在 CPU 上執行，不需要 PyTorch。
+
+    模型由 `rag_onnx_export.py` 匯出到 `model_dir`（model.onnx + tokenizer.json + onnx_model.json）。
+    passage/query 前綴、mean pooling 與 L2 正規化都與 E5Embeddings 相同；
+    快取以 `onnx_model.json` 記錄的名稱（例如 "intfloat/multilingual-e5-large-onnx-int8"）區分，不會與 fp32 向量混用。
+    """
+
+    def __init__(self, model_dir=DEFAULT_ONNX_DIR, threads=None, cache="env",
+                 token_budget=DEFAULT_TOKEN_BUDGET, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, ONNX_INFO_FILE), "r", encoding="utf-8") as f:
+            self.info = json.load(f)
+        self.model_dir = model_dir
+        self.model_name = self.info["model_name"]
+        self.max_length = int(self.info.get("max_length", 512))
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.stats = EmbeddingStats()
+        self.cache = EmbeddingCache.from_env(self.model_name) if cache == "env" else cache
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_truncation(max_length=self.max_length)
+        self.pad_id = self.tokenizer.token_to_id("<pad>") or 0
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = int(threads)
+        self.session = ort.InferenceSession(os.path.join(model_dir, ONNX_MODEL_FILE), options,
+                                            providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    @classmethod
+    def from_env(cls):
+        threads = os.getenv("RAG_ONNX_THREADS")
+        return cls(model_dir=os.getenv("RAG_ONNX_MODEL_DIR", DEFAULT_ONNX_DIR), threads=int(threads) if threads else None)
+
+    def embed_documents(self, texts):
+        return self.embed_with_prefix(texts, PASSAGE_PREFIX).tolist()
+
+    def embed_query(self, text):
+        return self.embed_with_prefix([text], QUERY_PREFIX)[0].tolist()
+
+    def embed_with_prefix(self, texts, prefix):
+        return embed_with_cache(self.cache, self.model_name, True, texts, prefix, self._encode)
+
+    def _encode(self, texts):
+        texts = [t.replace("\n", " ") for t in texts]
+        encodings = self.tokenizer.encode_batch(texts)
+        lengths = [len(e.ids) for e in encodings]
+        batches = plan_batches(lengths, self.token_budget, self.max_batch_size)
+
+        start = time.perf_counter()
+        out = np.zeros((len(texts), 0), dtype=np.float32)
+        for batch in batches:
+            width = max(lengths[i] for i in batch)
+            input_ids = np.full((len(batch), width), self.pad_id, dtype=np.int64)
+            attention_mask = np.zeros((len(batch), width), dtype=np.int64)
+            for row, i in enumerate(batch):
+                input_ids[row, :lengths[i]] = encodings[i].ids
+                attention_mask[row, :lengths[i]] = 1
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self._input_names:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+            hidden = self.session.run(None, feeds)[0]
+            # 與 sentence-transformers 的 E5 設定相同：mean pooling（只算非 padding token）後 L2 正規化
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            if out.shape[1] == 0:
+                out = np.zeros((len(texts), pooled.shape[1]), dtype=np.float32)
+            out[batch] = pooled
+
+        self.stats.record(texts, lengths, batches, time.perf_counter() - start)
+        return out
+
+
+def embedding_backend(backend=None):
+    backend = (backend or os.getenv("RAG_EMBEDDING_BACKEND", "torch")).lower()
+    if backend not in ("torch", "onnx"):
+        raise ValueError(f"未知的 embedding backend: {backend}（可用：torch、onnx）")
+    return backend
+
+
+def make_embeddings(backend=None):
+    """依 RAG_EMBEDDING_BACKEND 建立 E5 embedding：torch（預設，sentence-transformers）或 onnx（int8，onnxruntime）。"""
+    if embedding_backend(backend) == "onnx":
+        return OnnxE5Embeddings.from_env()
+    return E5Embeddings()
+
+
+def embedding_settings(backend=None):
+    """make_embeddings 會使用的 backend 與模型名稱（不載入模型），記在索引 manifest 中。
+
+    換 backend 或模型後 manifest 設定不同，增量建置會改為完整重建，不會把 int8 與 fp32 向量混在同一個索引。
+    """
+    backend = embedding_backend(backend)
+    model_name = E5_MODEL_NAME
+    if backend == "onnx":
+        model_dir = os.getenv("RAG_ONNX_MODEL_DIR", DEFAULT_ONNX_DIR)
+        try:
+            with open(os.path.join(model_dir, ONNX_INFO_FILE), "r", encoding="utf-8") as f:
+                model_name = json.load(f)["model_name"]
+        except (OSError, ValueError, KeyError):
+            model_name = model_dir
+    return {"embedding_backend": backend, "embedding_model": model_name}
+
+
+class HashingEmbeddings(Embeddings):
+    """離線用的 embedding 替身：把 BM25 tokenizer 的 token 以 feature hashing 投影到固定維度並正規化。
+
+    不需要下載模型、結果固定，適合在 CI 跑基準測試或離線測試流程；
+    相似度只反映字面重疊，數字不能代表 E5 的檢索品質。
+    """
+
+    def __init__(self, size=DEFAULT_HASHING_DIM):
+        self.size = size
+        self.stats = EmbeddingStats()
+
+    def embed_documents(self, texts):
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in tokenize(text):
+            slot, sign = _hash_token(token, self.size)
+            vector[slot] += sign
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+
+@lru_cache(maxsize=65536)
+def _hash_token(token, size):
+    # Python 內建 hash() 每次啟動都不同，改用 blake2b 讓向量可重現
+    digest = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+    return digest % size, 1.0 if digest >> 63 else -1.0
+
+
+DEFAULT_BATCH_WINDOW_MS = 2.0
+DEFAULT_BATCH_MAX_SIZE = 32
+# 統計 wait time 的最近樣本數
+BATCH_STATS_WINDOW = 1000
+
+
+class QueryBatcher(Embeddings):
+    """把同時到達的 embed_query 合併成一次模型呼叫（dynamic micro-batching）。
+
+    第一個請求到達後再等最多 `window_ms` 毫秒或湊滿 `max_batch_size` 筆，整批以一次
+    forward pass 計算，每個呼叫端各自拿回自己的向量。模型忙碌時到達的請求會自然累積成下一批，
+    所以 `window_ms=0` 也會合併，只是不額外等待。embed_documents 與其他屬性直接交給原本的 embedding。
+    """
+
+    def __init__(self, embedding, window_ms=DEFAULT_BATCH_WINDOW_MS, max_batch_size=DEFAULT_BATCH_MAX_SIZE):
+        self.embedding = embedding
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._pending = 0
+        self._max_pending = 0
+        self._batch_sizes = Counter()
+        self._waits = deque(maxlen=BATCH_STATS_WINDOW)
+        self._batch_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, embedding):
+        """RAG_EMBED_BATCH=0 時直接回傳原本的 embedding。"""
+        if os.getenv("RAG_EMBED_BATCH", "1").lower() in ("0", "false", "no", "off"):
+            return embedding
+        return cls(
+            embedding,
+            window_ms=float(os.getenv("RAG_EMBED_BATCH_WINDOW_MS", DEFAULT_BATCH_WINDOW_MS)),
+            max_batch_size=int(os.getenv("RAG_EMBED_BATCH_MAX", DEFAULT_BATCH_MAX_SIZE)),
+        )
+
+    def __getattr__(self, name):
+        # stats、cache、model_name… 等屬性沿用原本的 embedding（batcher 自己的統計在 batch_stats）
+        if name == "embedding":
+            raise AttributeError(name)
+        return getattr(self.embedding, name)
+
+    def embed_documents(self, texts):
+        return self.embedding.embed_documents(texts)
+
+    def embed_query(self, text):
+        future = Future()
+        with self._lock:
+            self._pending += 1
+            self._max_pending = max(self._max_pending, self._pending)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="rag-query-batcher", daemon=True)
+                self._worker.start()
+        self._queue.put((text, future, time.perf_counter()))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.window_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._embed_batch(batch)
+
+    def _embed_batch(self, batch):
+        start = time.perf_counter()
+        texts = [text for text, _, _ in batch]
+        try:
+            if hasattr(self.embedding, "embed_with_prefix"):
+                vectors = self.embedding.embed_with_prefix(texts, QUERY_PREFIX).tolist()
+            else:
+                vectors = [self.embedding.embed_query(t) for t in texts]
+        except Exception as e:
+            vectors, error = None, e
+        else:
+            error = None
+        with self._lock:
+            self._pending -= len(batch)
+            self._batch_sizes[len(batch)] += 1
+            self._waits.extend(start - enqueued for _, _, enqueued in batch)
+            self._batch_seconds += time.perf_counter() - start
+        for i, (_, future, _) in enumerate(batch):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(vectors[i])
+
+    def batch_stats(self):
+        """queue depth、batch 大小分佈與排隊等待時間（最近 BATCH_STATS_WINDOW 筆，毫秒）。"""
+        with self._lock:
+            sizes = dict(sorted(self._batch_sizes.items()))
+            waits = np.asarray(self._waits) * 1000
+            batches = sum(sizes.values())
+            queries = sum(size * n for size, n in sizes.items())
+            return {
+                "window_ms": self.window_ms,
+                "max_batch_size": self.max_batch_size,
+                "queue_depth": self._pending,
+                "max_queue_depth": self._max_pending,
+                "batches": batches,
+                "queries": queries,
+                "mean_batch_size": queries / batches if batches else 0.0,
+                "batch_size_histogram": sizes,
+                "wait_p50_ms": float(np.percentile(waits, 50)) if len(waits) else 0.0,
+                "wait_p95_ms": float(np.percentile(waits, 95)) if len(waits) else 0.0,
+                "batch_seconds": self._batch_seconds,
+            }
+
+    def batch_report(self):
+        s = self.batch_stats()
+        if not s["batches"]:
+            return "Query batcher：尚無查詢。"
+        histogram = ", ".join(f"{size}×{n}" for size, n in s["batch_size_histogram"].items())
+        return (f"Query batcher：{s['queries']} 個查詢、{s['batches']} 批（平均 {s['mean_batch_size']:.1f}；"
+                f"batch 大小×次數 {histogram}），等待 p50 {s['wait_p50_ms']:.1f} ms / p95 {s['wait_p95_ms']:.1f} ms，"
+                f"queue depth {s['queue_depth']}（最大 {s['max_queue_depth']}）")
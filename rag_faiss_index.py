@@ -0,0 +1,401 @@
+import os
+import re
+import json
+import mmap
+import time
+
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+from rag_docstore import (DOCSTORE_NAME, SqliteDocstore, SqliteIndexMap, read_store_manifest, write_docstore,
+                          write_store_manifest)
+
+INDEX_NAME = "index.faiss"
+LEGACY_DOCSTORE_NAME = "index.pkl"
+FAISS_SETTINGS_NAME = "faiss_index.json"
+FLAT_VECTORS_NAME = "flat_vectors.npy"
+DEFAULT_INDEX_SPEC = "Flat"
+DEFAULT_TRAIN_SAMPLE = 50000
+DEFAULT_EVAL_QUERIES = 200
+# search_params 中的 "rescore=N"：壓縮索引先取 k × N 個候選，再以原始向量精確重算距離
+RESCORE_PARAM = "rescore"
+
+
+def is_flat(spec):
+    return (spec or DEFAULT_INDEX_SPEC).replace(" ", "").lower() in ("flat", "idmap,flat")
+
+
+def load_index_settings(store_dir):
+    try:
+        with open(os.path.join(store_dir, FAISS_SETTINGS_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_index_settings(store_dir, settings):
+    path = os.path.join(store_dir, FAISS_SETTINGS_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(settings, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def settings_changed(store_dir, spec, search_params=""):
+    """要求的索引類型/查詢參數與資料夾內已存的不同時回傳 True（舊資料庫沒有設定檔，視為 Flat）。"""
+    saved = load_index_settings(store_dir) or {"spec": DEFAULT_INDEX_SPEC, "search_params": ""}
+    wanted = (DEFAULT_INDEX_SPEC, "") if is_flat(spec) else (spec, search_params or "")
+    return wanted != (saved.get("spec"), saved.get("search_params") or "")
+
+
+def split_search_params(params):
+    """把 "nprobe=8,rescore=4" 拆成交給 FAISS ParameterSpace 的部分與 rescore 倍數（沒有設定時為 0）。"""
+    faiss_params, rescore = [], 0
+    for item in (params or "").split(","):
+        name, _, value = item.strip().partition("=")
+        if name == RESCORE_PARAM:
+            rescore = int(value)
+        elif item.strip():
+            faiss_params.append(item.strip())
+    return ",".join(faiss_params), rescore
+
+
+def apply_search_params(index, params):
+    """套用查詢參數，例如 "efSearch=64"（HNSW）或 "nprobe=16"（IVF）；rescore 由 load_store 處理。"""
+    params, _ = split_search_params(params)
+    if params:
+        faiss = dependable_faiss_import()
+        faiss.ParameterSpace().set_index_parameters(index, params)
+
+
+def open_vectors(path):
+    """以唯讀 memory map 開啟 flat_vectors.npy；重排只讀取零散的列，關掉 read-ahead 以免整個檔案被讀進 page cache。"""
+    vectors = np.load(path, mmap_mode="r")
+    advise = getattr(getattr(vectors, "_mmap", None), "madvise", None)
+    if advise is not None and hasattr(mmap, "MADV_RANDOM"):
+        advise(mmap.MADV_RANDOM)
+    return vectors
+
+
+class RescoringIndex:
+    """壓縮索引（例如 "PCA256,SQfp16"、"PCA256,SQ8"）+ 原始向量的精確重排。
+
+    先在常駐記憶體的壓縮索引取 k × factor 個候選，再以 memory map 開啟的 flat_vectors.npy
+    只讀取候選所在的列、重算 L2 距離後取前 k 筆；回傳的距離與 Flat 索引相同。
+    其餘屬性（ntotal、metric_type…）轉給壓縮索引。
+    """
+
+    def __init__(self, index, vectors, factor):
+        self.index = index
+        self.vectors = vectors
+        self.factor = max(int(factor), 1)
+
+    def __getattr__(self, name):
+        if name == "index":
+            raise AttributeError(name)
+        return getattr(self.index, name)
+
+    @property
+    def d(self):
+        return self.vectors.shape[1]
+
+    def search(self, x, k):
+        x = np.asarray(x, dtype=np.float32)
+        _, candidates = self.index.search(x, min(k * self.factor, self.index.ntotal))
+        distances = np.full((len(x), k), np.inf, dtype=np.float32)
+        labels = np.full((len(x), k), -1, dtype=np.int64)
+        for row, (query, ids) in enumerate(zip(x, candidates)):
+            # 依 id 排序再讀取，memory map 的存取比較連續
+            ids = np.sort(ids[ids >= 0])
+            exact = np.sum((np.asarray(self.vectors[ids], dtype=np.float32) - query) ** 2, axis=1)
+            order = np.argsort(exact, kind="stable")[:k]
+            distances[row, :len(order)] = exact[order]
+            labels[row, :len(order)] = ids[order]
+        return distances, labels
+
+    def reconstruct(self, i):
+        return np.asarray(self.vectors[i], dtype=np.float32)
+
+
+def resident_bytes(index):
+    """查詢時需要常駐記憶體的索引大小；RescoringIndex 只計算壓縮索引，原始向量留在磁碟。"""
+    faiss = dependable_faiss_import()
+    if isinstance(index, RescoringIndex):
+        index = index.index
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def transform_bytes(index):
+    """resident_bytes 中 PCA/OPQ 等前置轉換矩陣佔的大小（d_in × d_out 個 float，與區塊數無關）；沒有轉換時為 0。"""
+    faiss = dependable_faiss_import()
+    if isinstance(index, RescoringIndex):
+        index = index.index
+    index = faiss.downcast_index(index)
+    if not isinstance(index, faiss.IndexPreTransform):
+        return 0
+    return resident_bytes(index) - resident_bytes(index.index)
+
+
+def check_index_spec(spec, d, ntotal, train_sample=DEFAULT_TRAIN_SAMPLE):
+    """在訓練前檢查 index_factory 字串是否適用於 d 維、ntotal 筆的向量，回傳問題清單（空清單代表可以建立）。
+
+    FAISS 要到 train() 才會丟出 "PCA matrix cannot output ..." 或 "Number of training points ..."，
+    這裡先擋下：PCA 輸出維度不能超過輸入維度與訓練筆數、IVF 的 nlist 與 PQ 的 2^nbits 不能超過訓練筆數、
+    PQ 的子向量數要整除維度。
+    """
+    problems = []
+    n_train = min(ntotal, train_sample)
+    for part in spec.replace(" ", "").split(","):
+        pca = re.match(r"PCAW?R?(\d+)$", part)
+        opq = re.match(r"OPQ(\d+)(?:_(\d+))?$", part)
+        ivf = re.match(r"IVF(\d+)", part)
+        pq = re.match(r"PQ(\d+)(?:x(\d+))?", part)
+        if pca:
+            d_out = int(pca.group(1))
+            if d_out > d:
+                problems.append(f"{part} 無法從 {d} 維降到 {d_out} 維")
+            elif d_out > n_train:
+                problems.append(f"{part} 需要至少 {d_out} 筆訓練向量，目前只有 {n_train} 筆")
+            d = min(d, d_out)
+        elif opq:
+            if n_train < 256:
+                problems.append(f"{part} 需要至少 256 筆訓練向量，目前只有 {n_train} 筆")
+            if d % int(opq.group(1)):
+                problems.append(f"{part} 的子向量數 {opq.group(1)} 無法整除 {d} 維")
+            d = int(opq.group(2) or d)
+        elif ivf:
+            nlist = int(ivf.group(1))
+            if nlist > n_train:
+                problems.append(f"{part} 需要至少 {nlist} 筆訓練向量（nlist），目前只有 {n_train} 筆")
+        elif pq:
+            m, nbits = int(pq.group(1)), int(pq.group(2) or 8)
+            if d % m:
+                problems.append(f"{part} 的子向量數 {m} 無法整除 {d} 維")
+            if 2 ** nbits > n_train:
+                problems.append(f"{part} 需要至少 {2 ** nbits} 筆訓練向量（2^{nbits} 個 centroid），"
+                                f"目前只有 {n_train} 筆")
+    return problems
+
+
+def build_ann_index(vectors, spec, search_params="", train_sample=DEFAULT_TRAIN_SAMPLE, seed=0):
+    """依 FAISS index_factory 字串（例如 "HNSW32"、"IVF256,Flat"、"IVF256,PQ64"、"PCA256,SQfp16"）建立索引。
+
+    需要訓練的索引（IVF/PQ/PCA/SQ8）只用隨機抽樣的 `train_sample` 筆向量訓練。回傳 (index, 訓練筆數, 耗時)。
+    """
+    faiss = dependable_faiss_import()
+    start = time.perf_counter()
+    index = faiss.index_factory(vectors.shape[1], spec, faiss.METRIC_L2)
+    trained_on = 0
+    if not index.is_trained:
+        trained_on = min(len(vectors), train_sample)
+        rng = np.random.default_rng(seed)
+        sample = vectors[np.sort(rng.choice(len(vectors), trained_on, replace=False))]
+        index.train(sample)
+    index.add(vectors)
+    apply_search_params(index, search_params)
+    return index, trained_on, time.perf_counter() - start
+
+
+def compare_with_flat(flat_index, ann_index, k=10, n_queries=DEFAULT_EVAL_QUERIES, seed=0, rescore=0):
+    """以抽樣的庫內向量當查詢，計算 ANN 相對 flat 的 recall@k，以及逐筆查詢的 QPS。
+
+    rescore > 0 時 ANN 端以 RescoringIndex 查詢（與 load_store 相同），另外記錄壓縮索引本身的 recall。
+    """
+    faiss = dependable_faiss_import()
+    n = flat_index.ntotal
+    k = min(k, n)
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(n, min(n_queries, n), replace=False)
+    queries = np.vstack([flat_index.reconstruct(int(i)) for i in ids]).astype(np.float32)
+
+    def timed_search(index):
+        results = []
+        start = time.perf_counter()
+        for q in queries:
+            _, found = index.search(q[None, :], k)
+            results.append(found[0])
+        return results, len(queries) / max(time.perf_counter() - start, 1e-9)
+
+    def recall_of(approx):
+        return float(np.mean([len(set(a) & set(e)) / k for a, e in zip(approx, exact)]))
+
+    exact, flat_qps = timed_search(flat_index)
+    report = {"k": k, "queries": len(queries), "flat_qps": flat_qps,
+              "flat_bytes": int(faiss.serialize_index(flat_index).nbytes),
+              "ann_bytes": int(faiss.serialize_index(ann_index).nbytes),
+              "transform_bytes": transform_bytes(ann_index)}
+    if rescore:
+        report["rescore"] = rescore
+        report["compact_recall"] = recall_of(timed_search(ann_index)[0])
+        ann_index = RescoringIndex(ann_index, flat_index.reconstruct_n(0, n), rescore)
+    approx, report["ann_qps"] = timed_search(ann_index)
+    report["recall"] = recall_of(approx)
+    return report
+
+
+def format_comparison(spec, report):
+    line = (f"[{spec}] recall@{report['k']} vs Flat: {report['recall']:.3f} "
+            f"({report['queries']} queries) · QPS: Flat {report['flat_qps']:.0f} -> {report['ann_qps']:.0f} · "
+            f"index size: {report['flat_bytes'] / 1e6:.1f} MB -> {report['ann_bytes'] / 1e6:.1f} MB")
+    if report.get("transform_bytes"):
+        line += f"（其中 PCA/OPQ 矩陣 {report['transform_bytes'] / 1e6:.1f} MB）"
+    if report["ann_bytes"] >= report["flat_bytes"]:
+        line += " · 常駐記憶體沒有比 Flat 小，區塊數少時建議維持 Flat"
+    if report.get("rescore"):
+        line += (f" · rescore x{report['rescore']}（壓縮索引本身 recall {report['compact_recall']:.3f}，"
+                 f"原始向量 {report['flat_bytes'] / 1e6:.1f} MB 留在磁碟）")
+    return line
+
+
+def write_index(index, path, name=INDEX_NAME):
+    """以暫存檔 + rename 寫入 FAISS 索引，讀取中的 app 不會讀到寫一半的檔案。"""
+    faiss = dependable_faiss_import()
+    target = os.path.join(path, name)
+    faiss.write_index(index, target + ".tmp")
+    os.replace(target + ".tmp", target)
+
+
+def read_index(path, name=INDEX_NAME, mmap=False):
+    """讀取 FAISS 索引；mmap=True 時以唯讀 memory map 開啟，向量資料由 OS 依需要分頁載入。"""
+    faiss = dependable_faiss_import()
+    target = os.path.join(path, name)
+    if mmap:
+        try:
+            return faiss.read_index(target, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # 部分平台/索引類型不支援 mmap，改為一般讀取
+            pass
+    return faiss.read_index(target)
+
+
+def _write_serving_files(store, index, path):
+    # 服務格式：index.faiss + docstore.sqlite + store.json，不再寫 index.pkl
+    os.makedirs(path, exist_ok=True)
+    write_index(index, path)
+    count = write_docstore(path, store.docstore, store.index_to_docstore_id)
+    write_store_manifest(path, "faiss", index=INDEX_NAME, docstore=DOCSTORE_NAME, count=count, dim=index.d)
+    legacy = os.path.join(path, LEGACY_DOCSTORE_NAME)
+    if os.path.exists(legacy):
+        os.remove(legacy)
+
+
+def save_store(store, path, spec=DEFAULT_INDEX_SPEC, search_params="", train_sample=DEFAULT_TRAIN_SAMPLE):
+    """儲存 FAISS vectorstore；`store.index` 需為 flat 索引。
+
+    非 Flat 的 spec 會在存檔時由 flat 向量訓練並建立 ANN 索引，另存一份原始向量
+    （flat_vectors.npy），讓增量更新時能還原成可刪除/新增的 flat 索引，search_params 含 rescore 時
+    也用來精確重排。設定寫在 faiss_index.json。
+    """
+    vectors_path = os.path.join(path, FLAT_VECTORS_NAME)
+    if is_flat(spec):
+        _write_serving_files(store, store.index, path)
+        if os.path.exists(vectors_path):
+            os.remove(vectors_path)
+        save_index_settings(path, {"spec": DEFAULT_INDEX_SPEC, "search_params": "",
+                                   "ntotal": store.index.ntotal, "dim": store.index.d})
+        return None
+
+    flat = store.index
+    problems = check_index_spec(spec, flat.d, flat.ntotal, train_sample)
+    if problems:
+        print(f"警告：{spec} 不適用於 {flat.ntotal} 個 {flat.d} 維向量（{'；'.join(problems)}），改存 Flat 索引。")
+        return save_store(store, path, DEFAULT_INDEX_SPEC)
+    vectors = flat.reconstruct_n(0, flat.ntotal)
+    ann, trained_on, seconds = build_ann_index(vectors, spec, search_params, train_sample)
+    report = compare_with_flat(flat, ann, rescore=split_search_params(search_params)[1])
+    _write_serving_files(store, ann, path)
+    np.save(vectors_path, vectors)
+    save_index_settings(path, {
+        "spec": spec,
+        "search_params": search_params,
+        "ntotal": ann.ntotal,
+        "dim": ann.d,
+        "trained_on": trained_on,
+        "build_seconds": round(seconds, 3),
+        "recall_vs_flat": round(report["recall"], 4),
+        "recall_k": report["k"],
+        "resident_bytes": report["ann_bytes"],
+        "transform_bytes": report["transform_bytes"],
+    })
+    print(f"已建立 {spec} 索引（訓練 {trained_on} 筆，{seconds:.2f}s）")
+    print(format_comparison(spec, report))
+    return report
+
+
+def is_legacy_store(path):
+    """LangChain save_local 產生的舊格式（index.faiss + index.pkl，沒有 store.json）。"""
+    return read_store_manifest(path) is None and os.path.exists(os.path.join(path, LEGACY_DOCSTORE_NAME))
+
+
+def _load_legacy_store(path, embeddings):
+    # FAISS deserialization uses pickle; allow only when loading trusted local DBs
+    return FAISS.load_local(path, embeddings=embeddings, allow_dangerous_deserialization=True)
+
+
+def load_store(path, embeddings):
+    """以服務格式載入 FAISS vectorstore（給查詢端使用，唯讀）。
+
+    索引以 memory map 開啟，chunk 內文留在 docstore.sqlite，檢索命中時才讀取；
+    並套用 faiss_index.json 記錄的查詢參數（efSearch / nprobe）。設定 rescore 時包成 RescoringIndex，
+    flat_vectors.npy 同樣以 memory map 開啟。
+    """
+    if is_legacy_store(path):
+        print(f"{path} 是舊的 index.pkl 格式，載入需要 unpickle 整份 docstore；"
+              f"可執行 python rag_faiss_index.py {path} 轉換。")
+        store = _load_legacy_store(path, embeddings)
+    else:
+        docstore = SqliteDocstore(os.path.join(path, DOCSTORE_NAME))
+        store = FAISS(embeddings, read_index(path, mmap=True), docstore, SqliteIndexMap(docstore))
+    settings = load_index_settings(path) or {}
+    apply_search_params(store.index, settings.get("search_params"))
+    _, rescore = split_search_params(settings.get("search_params"))
+    vectors_path = os.path.join(path, FLAT_VECTORS_NAME)
+    if rescore and not is_flat(settings.get("spec")) and os.path.exists(vectors_path):
+        store.index = RescoringIndex(store.index, open_vectors(vectors_path), rescore)
+    return store
+
+
+def load_flat_store(path, embeddings):
+    """載入供增量建置使用、可新增/刪除的 vectorstore。
+
+    docstore 整份讀入記憶體；ANN 索引會以 flat_vectors.npy 還原成 flat 索引。
+    """
+    if is_legacy_store(path):
+        store = _load_legacy_store(path, embeddings)
+    else:
+        reader = SqliteDocstore(os.path.join(path, DOCSTORE_NAME))
+        try:
+            docs, index_to_docstore_id = reader.load_all()
+        finally:
+            reader.close()
+        store = FAISS(embeddings, read_index(path), InMemoryDocstore(docs), index_to_docstore_id)
+    settings = load_index_settings(path) or {}
+    if is_flat(settings.get("spec")):
+        return store
+    vectors_path = os.path.join(path, FLAT_VECTORS_NAME)
+    if os.path.exists(vectors_path):
+        vectors = np.load(vectors_path)
+    else:
+        vectors = store.index.reconstruct_n(0, store.index.ntotal)
+    flat = dependable_faiss_import().IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    store.index = flat
+    return store
+
+
+if __name__ == "__main__":
+    # 把舊格式（index.pkl）的資料庫轉成服務格式：python rag_faiss_index.py faiss_db
+    import sys
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    # 只搬移已存的向量與 Document，不需要真正的 embedding 模型
+    placeholder = DeterministicFakeEmbedding(size=1)
+    for store_dir in sys.argv[1:] or ["faiss_db"]:
+        if not is_legacy_store(store_dir):
+            print(f"{store_dir} 已是服務格式，略過。")
+            continue
+        settings = load_index_settings(store_dir) or {}
+        store = load_flat_store(store_dir, placeholder)
+        save_store(store, store_dir, settings.get("spec", DEFAULT_INDEX_SPEC), settings.get("search_params", ""))
+        print(f"已轉換 {store_dir}：{store.index.ntotal} 個區塊 -> {DOCSTORE_NAME}")
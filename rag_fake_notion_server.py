@@ -0,0 +1,203 @@
+"""本機 fake Notion API，用來離線測試 rag03_notion_to_pdf.py 的資料庫匯出（並行、限速與重試）。
+
+用法：
+    python rag_fake_notion_server.py --port 8002 --pages 400 --latency 0.05 --error-rate 0.1
+    set NOTION_API_BASE_URL=http://127.0.0.1:8002
+    set NOTION_TOKEN=fake
+    python rag03_notion_to_pdf.py 00000000-0000-0000-0000-000000000db0
+
+支援 GET /v1/databases/{id}、POST /v1/databases/{id}/query（分頁）、GET /v1/pages/{id}
+與 GET /v1/blocks/{id}/children；`--error-rate` 會隨機回 429（附 Retry-After）或 503，
+測試時可用 fail_next() 指定接下來幾個請求的錯誤。
+資料庫查詢支援 last_edited_time 篩選；測試同步流程時可用 touch_page() / archive_page() 修改頁面。
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DATABASE_ID = "00000000-0000-0000-0000-000000000db0"
+DEFAULT_EDITED_TIME = "2025-01-01T00:00:00.000Z"
+
+
+def page_id_for(i):
+    return f"00000000-0000-0000-0000-{i:012d}"
+
+
+def rich_text(text):
+    return [{
+        "type": "text",
+        "text": {"content": text, "link": None},
+        "annotations": {"bold": False, "italic": False, "strikethrough": False,
+                        "underline": False, "code": False, "color": "default"},
+        "plain_text": text,
+        "href": None,
+    }]
+
+
+def make_page(i, last_edited_time=DEFAULT_EDITED_TIME, archived=False):
+    return {
+        "object": "page",
+        "id": page_id_for(i),
+        "archived": archived,
+        "in_trash": archived,
+        "last_edited_time": last_edited_time,
+        "properties": {"Name": {"id": "title", "type": "title", "title": rich_text(f"Fake Page {i}")}},
+    }
+
+
+def make_block(page_index, j, block_type, text):
+    return {
+        "object": "block",
+        "id": f"{page_id_for(page_index)[:-4]}{j:04d}",
+        "type": block_type,
+        "has_children": False,
+        block_type: {"rich_text": rich_text(text), "color": "default"},
+    }
+
+
+def make_blocks(i):
+    return [
+        make_block(i, 1, "heading_1", f"Fake Page {i}"),
+        make_block(i, 2, "paragraph", f"這是第 {i} 頁的測試內容，用來驗證匯出流程。"),
+        make_block(i, 3, "heading_2", "細節"),
+        make_block(i, 4, "paragraph", "git reset --hard HEAD~1 會丟棄最近一次 commit。"),
+    ]
+
+
+class FakeNotionHandler(BaseHTTPRequestHandler):
+    num_pages = 20
+    latency = 0.0
+    error_rate = 0.0
+    stats = None
+    edited = None
+    archived = None
+    failures = None
+
+    def do_GET(self):
+        parts = self._parts()
+        if parts[:1] == ["databases"] and len(parts) == 2:
+            return self._reply({"object": "database", "id": parts[1], "title": rich_text("Fake Database")})
+        if parts[:1] == ["pages"] and len(parts) == 2:
+            index = self._page_index(parts[1])
+            return self._reply(self._page(index)) if index is not None else self._not_found()
+        if parts[:1] == ["blocks"] and parts[2:] == ["children"]:
+            index = self._page_index(parts[1])
+            results = make_blocks(index) if index is not None else []
+            return self._reply({"object": "list", "results": results, "has_more": False, "next_cursor": None})
+        self._not_found()
+
+    def do_POST(self):
+        parts = self._parts()
+        if parts[:1] == ["databases"] and parts[2:] == ["query"]:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            size = min(100, int(body.get("page_size", 100)))
+            since = (body.get("filter") or {}).get("last_edited_time", {}).get("on_or_after")
+            pages = [self._page(i) for i in range(self.num_pages) if i not in self.archived]
+            if since:
+                # ISO 8601 (UTC, 同一格式) 可直接以字串比較
+                pages = [p for p in pages if p["last_edited_time"] >= since]
+            start = int(body.get("start_cursor") or 0)
+            end = min(len(pages), start + size)
+            return self._reply({
+                "object": "list",
+                "results": pages[start:end],
+                "has_more": end < len(pages),
+                "next_cursor": str(end) if end < len(pages) else None,
+            })
+        self._not_found()
+
+    def _page(self, index):
+        return make_page(index, self.edited.get(index, DEFAULT_EDITED_TIME), index in self.archived)
+
+    def _parts(self):
+        path = urlparse(self.path).path.strip("/").split("/")
+        return path[1:] if path[:1] == ["v1"] else path
+
+    def _page_index(self, page_id):
+        raw = page_id.replace("-", "")
+        if len(raw) != 32 or not raw.isdigit():
+            return None
+        index = int(raw[-12:])
+        return index if index < self.num_pages else None
+
+    def _reply(self, obj):
+        time.sleep(self.latency)
+        self.stats["requests"] += 1
+        if self.failures:
+            status, headers = self.failures.pop(0)
+            self.stats["errors"] += 1
+            return self._send(status, {"object": "error", "status": status, "code": "injected_error",
+                                       "message": "Injected error"}, headers)
+        if random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            if random.random() < 0.5:
+                return self._send(429, {"object": "error", "status": 429, "code": "rate_limited",
+                                        "message": "Rate limited"}, {"Retry-After": "0.2"})
+            return self._send(503, {"object": "error", "status": 503, "code": "service_unavailable",
+                                    "message": "Service unavailable"})
+        self._send(200, obj)
+
+    def _not_found(self):
+        self._send(404, {"object": "error", "status": 404, "code": "object_not_found", "message": "Not found"})
+
+    def _send(self, status, obj, headers=None):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host="127.0.0.1", port=8002, pages=20, latency=0.0, error_rate=0.0):
+    attrs = {"num_pages": pages, "latency": latency, "error_rate": error_rate,
+             "stats": {"requests": 0, "errors": 0}, "edited": {}, "archived": set(), "failures": []}
+    handler = type("ConfiguredFakeNotionHandler", (FakeNotionHandler,), attrs)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def touch_page(server, index, last_edited_time):
+    """模擬在 Notion 編輯了第 index 頁。"""
+    server.RequestHandlerClass.edited[index] = last_edited_time
+
+
+def archive_page(server, index):
+    """模擬把第 index 頁移到垃圾桶；資料庫查詢不再回傳該頁。"""
+    server.RequestHandlerClass.archived.add(index)
+
+
+def fail_next(server, status, count=1, retry_after=None):
+    """讓接下來 count 個請求回傳 status（例如 429 或 503）；retry_after 會放進 Retry-After 標頭。"""
+    headers = {"Retry-After": retry_after} if retry_after is not None else {}
+    server.RequestHandlerClass.failures.extend([(status, headers)] * count)
+
+
+def serve_in_background(**kwargs):
+    """在背景執行緒啟動 fake server，回傳 (server, base_url)；測試腳本用完呼叫 server.shutdown()。"""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake Notion API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--pages", type=int, default=20, help="number of pages in the fake database")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 429/503")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port, args.pages, args.latency, args.error_rate)
+    print(f"Fake Notion API listening on http://{args.host}:{args.port} (database id {DATABASE_ID})")
+    server.serve_forever()
@@ -0,0 +1,147 @@
+import os
+import json
+import uuid
+import hashlib
+from dataclasses import dataclass, field
+
+MANIFEST_NAME = "rag_manifest.json"
+MANIFEST_VERSION = 1
+
+# 固定 namespace，讓同一檔案內容 + 同一區塊位置永遠得到相同的 chunk ID
+CHUNK_ID_NAMESPACE = uuid.UUID("6f1c9a4e-4c1b-4b7e-9d0a-2f3e5a7b8c9d")
+
+
+def file_sha256(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def make_chunk_id(source, file_hash, index):
+    return str(uuid.uuid5(CHUNK_ID_NAMESPACE, f"{source}:{file_hash}:{index}"))
+
+
+def assign_chunk_ids(chunks, source, file_hash):
+    """替每個區塊產生穩定的 ID，並寫入 metadata 方便之後比對。"""
+    ids = []
+    for i, chunk in enumerate(chunks):
+        chunk_id = make_chunk_id(source, file_hash, i)
+        chunk.metadata["chunk_id"] = chunk_id
+        chunk.metadata["chunk_index"] = i
+        ids.append(chunk_id)
+    return ids
+
+
+@dataclass
+class UpdatePlan:
+    added: list = field(default_factory=list)
+    changed: list = field(default_factory=list)
+    removed: list = field(default_factory=list)
+    unchanged: list = field(default_factory=list)
+    hashes: dict = field(default_factory=dict)
+
+    @property
+    def to_index(self):
+        return self.added + self.changed
+
+    @property
+    def is_empty(self):
+        return not (self.added or self.changed or self.removed)
+
+    def summary(self):
+        return (f"新增 {len(self.added)}、變更 {len(self.changed)}、"
+                f"移除 {len(self.removed)}、未變更 {len(self.unchanged)}")
+
+
+class IndexManifest:
+    """記錄每個來源檔的 hash、loader 輸出與 chunk ID，供增量重建索引使用。
+
+    manifest 存在向量資料庫資料夾內（`<store_dir>/rag_manifest.json`），
+    與索引一起壓縮/部署；切割參數或 embedding backend/模型不同時視為無效，需完整重建。
+    """
+
+    def __init__(self, path, settings, files=None):
+        self.path = path
+        self.settings = settings
+        self.files = files or {}
+        self.reset_reason = None
+        self.mirror_paths = []
+
+    @classmethod
+    def load(cls, store_dir, **settings):
+        path = os.path.join(store_dir, MANIFEST_NAME)
+        manifest = cls(path, settings)
+        if not os.path.exists(path):
+            manifest.reset_reason = "找不到 manifest"
+            return manifest
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            manifest.reset_reason = f"manifest 讀取失敗: {e}"
+            return manifest
+        if data.get("version") != MANIFEST_VERSION:
+            manifest.reset_reason = "manifest 版本不同"
+        elif data.get("settings") != settings:
+            manifest.reset_reason = f"切割參數或 embedding 設定已變更 ({data.get('settings')} -> {settings})"
+        else:
+            manifest.files = data.get("files", {})
+        return manifest
+
+    def plan(self, upload_dir, filenames, only=None):
+        """比對目前檔案與 manifest；只計算 hash，不會執行任何 loader。
+
+        `only` 為變更清單（例如 rag03 --sync 產生的 notion_changes.json）中的檔名；
+        給定時，其餘已記錄在 manifest 的檔案直接視為未變更，不再重新計算 hash。
+        """
+        plan = UpdatePlan()
+        for fn in filenames:
+            entry = self.files.get(fn)
+            if only is not None and entry is not None and fn not in only:
+                plan.hashes[fn] = entry.get("sha256")
+                plan.unchanged.append(fn)
+                continue
+            sha = file_sha256(os.path.join(upload_dir, fn))
+            plan.hashes[fn] = sha
+            entry = self.files.get(fn)
+            if entry is None:
+                plan.added.append(fn)
+            elif entry.get("sha256") != sha:
+                plan.changed.append(fn)
+            else:
+                plan.unchanged.append(fn)
+        current = set(filenames)
+        plan.removed = sorted(fn for fn in self.files if fn not in current)
+        return plan
+
+    def chunk_ids(self, filenames):
+        ids = []
+        for fn in filenames:
+            ids.extend(self.files.get(fn, {}).get("chunk_ids", []))
+        return ids
+
+    def all_chunk_ids(self):
+        return self.chunk_ids(sorted(self.files))
+
+    def record(self, fn, sha, loader, num_docs, chunk_ids):
+        self.files[fn] = {
+            "sha256": sha,
+            "loader": loader,
+            "num_docs": num_docs,
+            "chunk_ids": list(chunk_ids),
+        }
+
+    def forget(self, fn):
+        return self.files.pop(fn, {}).get("chunk_ids", [])
+
+    def save(self):
+        # mirror_paths：同時建置多個 backend 時，每個資料夾各存一份相同的 manifest
+        for path in [self.path] + list(self.mirror_paths):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": MANIFEST_VERSION, "settings": self.settings, "files": self.files},
+                          f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+
+from rag_loaders import default_workers, iter_load_results, print_load_summary
+from rag_index_manifest import assign_chunk_ids, make_chunk_id
+
+CHECKPOINT_NAME = "ingest_checkpoint.json"
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_CHECKPOINT_EVERY = 10
+
+
+def add_ingest_arguments(parser):
+    """rag01_* 建置腳本共用的命令列參數。"""
+    parser.add_argument("--incremental", action="store_true",
+                        help="只重新處理新增/變更的檔案，並刪除已移除檔案的向量")
+    parser.add_argument("--changes", metavar="PATH",
+                        help="增量更新時只重新計算變更清單（rag03_notion_to_pdf.py --sync 產生的 "
+                             "notion_changes.json）列出的檔案；隱含 --incremental，建置成功後清除清單")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="平行解析文件的 process 數（預設為 CPU 核心數，可用 RAG_LOAD_WORKERS 設定）")
+    parser.add_argument("--stream", action="store_true",
+                        help="串流模式：載入 → 切割 → 分批 embedding → 分批寫入，記憶體用量固定，中斷後可續跑")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="串流模式每批 embedding/寫入的區塊數")
+    parser.add_argument("--checkpoint-every", type=int, default=DEFAULT_CHECKPOINT_EVERY,
+                        help="串流模式每幾批存一次索引與 checkpoint")
+    return parser
+
+
+class IngestCheckpoint:
+    """記錄串流建置進行中的檔案與已寫入的區塊數。
+
+    已完整寫入的檔案記在 manifest；checkpoint 只需要記住「目前這個檔案寫到第幾個區塊」。
+    檔案存在代表上次建置沒有正常結束。
+    """
+
+    def __init__(self, store_dir):
+        self.path = os.path.join(store_dir, CHECKPOINT_NAME)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def save(self, in_progress):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"in_progress": in_progress, "saved_at": time.time()}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def iter_chunks(results, splitter, hashes, skip=None, summary=None):
+    """逐檔切割並產生 (fn, chunk_index, chunk, chunk_id, file_info)。
+
+    一次只保留一個檔案的 Document 與區塊；`skip` 為 {fn: 已寫入區塊數}，用於續跑。
+    """
+    skip = skip or {}
+    for result in results:
+        if summary is not None:
+            summary.append(result)
+        if result.error:
+            print(f"載入 {result.fn} 失敗: {result.error}")
+            continue
+        chunks = splitter.split_documents(result.docs)
+        result.docs = []
+        ids = assign_chunk_ids(chunks, result.fn, hashes[result.fn])
+        info = {"loader": result.loader, "num_docs": result.num_docs, "ids": ids}
+        first = skip.get(result.fn, 0)
+        if first >= len(chunks):
+            # 沒有區塊要寫（空檔案或續跑時已全部寫入），仍需通知呼叫端以更新 manifest
+            yield result.fn, -1, None, None, info
+        for i in range(first, len(chunks)):
+            yield result.fn, i, chunks[i], ids[i], info
+
+
+def stream_ingest(writer, manifest, plan, upload_dir, splitter, batch_size=DEFAULT_BATCH_SIZE,
+                  workers=None, checkpoint_every=DEFAULT_CHECKPOINT_EVERY):
+    """以固定大小的批次把區塊寫入向量資料庫，並定期存 checkpoint。
+
+    每 `checkpoint_every` 批會依序 flush 索引 → 存 manifest（已完成的檔案）→ 存 checkpoint
+    （進行中的檔案與已寫入區塊數），因此中斷後重跑只會補上最後一個 checkpoint 之後的區塊。
+    """
+    checkpoint = IngestCheckpoint(writer.path)
+    state = checkpoint.load() or {}
+    in_progress = state.get("in_progress")
+    skip = {}
+    orphan_ids = []
+    if in_progress and plan.hashes.get(in_progress["file"]) == in_progress["sha256"]:
+        skip[in_progress["file"]] = in_progress["chunks_done"]
+        print(f"從 checkpoint 續跑：{in_progress['file']} 已寫入 {in_progress['chunks_done']} 個區塊。")
+    elif in_progress:
+        # 進行中的檔案在續跑前被修改或刪除：舊內容已寫入的區塊不在 manifest 裡，要依 ID 重建後刪掉
+        fn, file_hash = in_progress["file"], in_progress["sha256"]
+        orphan_ids = [make_chunk_id(fn, file_hash, i) for i in range(in_progress["chunks_done"])]
+        print(f"{fn} 在中斷後已變更或刪除，捨棄先前寫入的 {len(orphan_ids)} 個區塊。")
+
+    stale_ids = manifest.chunk_ids(plan.removed + plan.changed) + orphan_ids
+    for fn in plan.removed + plan.changed:
+        manifest.forget(fn)
+    deleted = writer.delete(stale_ids)
+    if deleted:
+        print(f"已刪除 {deleted} 個過期區塊。")
+
+    summary = []
+    start = time.perf_counter()
+    flushed = dict(skip)
+    batch_docs, batch_ids, batch_files = [], [], []
+    batches = 0
+    total = 0
+    files = {}
+    current = {}
+
+    def write_batch():
+        nonlocal batches, total
+        writer.add(batch_docs, batch_ids)
+        for fn in batch_files:
+            flushed[fn] = flushed.get(fn, 0) + 1
+        total += len(batch_docs)
+        batches += 1
+        batch_docs.clear()
+        batch_ids.clear()
+        batch_files.clear()
+        _record_finished()
+        if batches % checkpoint_every == 0:
+            save_checkpoint()
+            print(f"已寫入 {batches} 批、{total} 個區塊，checkpoint 已儲存。")
+
+    def _record_finished():
+        for fn in list(files):
+            info = files[fn]
+            if flushed.get(fn, 0) >= len(info["ids"]):
+                manifest.record(fn, plan.hashes[fn], info["loader"], info["num_docs"], info["ids"])
+                del files[fn]
+                if current.get("file") == fn:
+                    current.clear()
+
+    def save_checkpoint():
+        writer.flush(final=False)
+        manifest.save()
+        fn = current.get("file")
+        checkpoint.save({"file": fn, "sha256": plan.hashes[fn], "chunks_done": flushed.get(fn, 0)} if fn else None)
+
+    chunk_stream = iter_chunks(iter_load_results(upload_dir, plan.to_index, workers), splitter,
+                               plan.hashes, skip=skip, summary=summary)
+    for fn, _, chunk, chunk_id, info in chunk_stream:
+        files.setdefault(fn, info)
+        current["file"] = fn
+        if chunk is None:
+            _record_finished()
+            continue
+        batch_docs.append(chunk)
+        batch_ids.append(chunk_id)
+        batch_files.append(fn)
+        if len(batch_docs) >= batch_size:
+            write_batch()
+    if batch_docs:
+        write_batch()
+    _record_finished()
+
+    writer.flush()
+    manifest.save()
+    checkpoint.clear()
+    print_load_summary(summary, time.perf_counter() - start)
+    print(f"串流建置完成：共 {batches} 批、{total} 個區塊。")
+    return total
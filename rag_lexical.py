@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import time
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+LEXICAL_META_NAME = "lexical_index.json"
+LEXICAL_ARRAYS_NAME = "lexical_index.npz"
+LEXICAL_VERSION = 1
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 程式碼/英文 token：保留 git、--hard、t3.micro、user_id、HEAD~1 這類使用者會逐字輸入的字串
+_CODE_TOKEN = re.compile(r"-{0,2}[a-z0-9_]+(?:[.\-~/:#+][a-z0-9_]+)*")
+_CODE_PARTS = re.compile(r"[a-z0-9_]+")
+# 中日韓文字（含擴充區與相容字）
+_CJK_RUN = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+")
+
+
+def tokenize(text):
+    """BM25 用的 tokenizer。
+
+    英文與程式碼保留完整 token（例如 `--hard`、`t3.micro`），並額外拆出組成的單字；
+    中文沒有空白分詞，改用單字 + 相鄰二字（bigram），不需要斷詞字典也能比對「版本控制」這類詞。
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    for m in _CODE_TOKEN.finditer(text):
+        token = m.group(0)
+        tokens.append(token)
+        parts = _CODE_PARTS.findall(token)
+        if len(parts) > 1 or parts[0] != token:
+            tokens.extend(parts)
+    for m in _CJK_RUN.finditer(text):
+        run = m.group(0)
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class LexicalIndex:
+    """以 CSR 陣列存放的 BM25 倒排索引，跟向量資料庫放在同一個資料夾。
+
+    詞彙表與 chunk ID 存在 JSON，posting list 存在未壓縮的 .npz，載入只需要幾毫秒。
+    """
+
+    def __init__(self, chunk_ids, vocab, offsets, postings, tfs, doc_lens, k1=BM25_K1, b=BM25_B):
+        self.chunk_ids = chunk_ids
+        self.vocab = vocab
+        self.term_index = {t: i for i, t in enumerate(vocab)}
+        self.offsets = offsets
+        self.postings = postings
+        self.tfs = tfs
+        self.doc_lens = doc_lens
+        self.k1 = k1
+        self.b = b
+        n = len(chunk_ids)
+        df = np.diff(offsets).astype(np.float32)
+        self.idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(doc_lens.mean()) if n else 1.0
+        self._norm = (k1 * (1 - b + b * doc_lens / max(avgdl, 1e-9))).astype(np.float32)
+
+    @classmethod
+    def build(cls, chunk_ids, texts):
+        postings_by_term = {}
+        doc_lens = np.zeros(len(chunk_ids), dtype=np.float32)
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lens[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                postings_by_term.setdefault(term, []).append((doc, tf))
+        vocab = sorted(postings_by_term)
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        postings, tfs = [], []
+        for i, term in enumerate(vocab):
+            entries = postings_by_term[term]
+            offsets[i + 1] = offsets[i] + len(entries)
+            postings.extend(d for d, _ in entries)
+            tfs.extend(tf for _, tf in entries)
+        return cls(list(chunk_ids), vocab, offsets, np.asarray(postings, dtype=np.int32),
+                   np.asarray(tfs, dtype=np.float32), doc_lens)
+
+    def save(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        arrays_path = os.path.join(store_dir, LEXICAL_ARRAYS_NAME)
+        meta_path = os.path.join(store_dir, LEXICAL_META_NAME)
+        with open(arrays_path + ".tmp", "wb") as f:
+            np.savez(f, offsets=self.offsets, postings=self.postings, tfs=self.tfs, doc_lens=self.doc_lens)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"version": LEXICAL_VERSION, "k1": self.k1, "b": self.b,
+                       "chunk_ids": self.chunk_ids, "vocab": self.vocab}, f, ensure_ascii=False)
+        os.replace(arrays_path + ".tmp", arrays_path)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    @classmethod
+    def load(cls, store_dir):
+        """讀取索引；不存在或版本不符時回傳 None。"""
+        meta_path = os.path.join(store_dir, LEXICAL_META_NAME)
+        arrays_path = os.path.join(store_dir, LEXICAL_ARRAYS_NAME)
+        if not (os.path.exists(meta_path) and os.path.exists(arrays_path)):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != LEXICAL_VERSION:
+            return None
+        with np.load(arrays_path) as arrays:
+            return cls(meta["chunk_ids"], meta["vocab"], arrays["offsets"], arrays["postings"],
+                       arrays["tfs"], arrays["doc_lens"], meta["k1"], meta["b"])
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def search(self, query, k):
+        """回傳 BM25 分數最高的 [(chunk_id, score)]。"""
+        if not self.chunk_ids:
+            return []
+        scores = np.zeros(len(self.chunk_ids), dtype=np.float32)
+        for term, qtf in Counter(tokenize(query)).items():
+            t = self.term_index.get(term)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            docs = self.postings[start:end]
+            tf = self.tfs[start:end]
+            scores[docs] += qtf * self.idf[t] * tf * (self.k1 + 1) / (tf + self._norm[docs])
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(self.chunk_ids[i], float(scores[i])) for i in hits]
+
+
+def iter_store_documents(store):
+    """逐一產生向量資料庫中的 (chunk_id, 內文)，FAISS 與 Chroma 皆可。"""
+    docstore = getattr(store, "docstore", None)
+    if docstore is not None:
+        for doc_id in store.index_to_docstore_id.values():
+            doc = docstore.search(doc_id)
+            if hasattr(doc, "page_content"):
+                yield doc_id, doc.page_content
+        return
+    result = store.get(include=["documents"])
+    yield from zip(result["ids"], result["documents"])
+
+
+def write_lexical_index(store, store_dir):
+    """建置完成後，依向量資料庫目前的內容重建並儲存 BM25 索引。"""
+    if store is None:
+        return None
+    start = time.perf_counter()
+    ids, texts = [], []
+    for doc_id, text in iter_store_documents(store):
+        ids.append(doc_id)
+        texts.append(text)
+    index = LexicalIndex.build(ids, texts)
+    index.save(store_dir)
+    print(f"已建立 BM25 索引：{len(index)} 個區塊、{len(index.vocab)} 個詞（{time.perf_counter() - start:.2f}s）")
+    return index
+
+
+if __name__ == "__main__":
+    # 為既有的向量資料庫（在加入 BM25 之前建置的）補建索引：python rag_lexical.py faiss_db chroma_db
+    import sys
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    # 只讀取已存的 Document，不需要真正的 embedding 模型
+    placeholder = DeterministicFakeEmbedding(size=1)
+    for store_dir in sys.argv[1:] or ["faiss_db"]:
+        from rag_vectorstores import open_vectorstore
+        write_lexical_index(open_vectorstore(store_dir, placeholder), store_dir)
@@ -0,0 +1,124 @@
+import os
+import re
+import time
+
+# Groq 提供 OpenAI 相容的 API，因此兩個供應商都用 openai SDK 以 stream=True 呼叫
+PROVIDER_BASE_URLS = {
+    "groq": "https://api.groq.com/openai/v1",
+    "openai": None,
+}
+PROVIDER_KEY_ENVS = {
+    "groq": "GROQ_API_KEY",
+    "openai": "OPENAI_API_KEY",
+}
+
+
+def split_model(model, default_provider="openai"):
+    """把 aisuite 風格的 "groq:openai/gpt-oss-120b" 拆成 ("groq", "openai/gpt-oss-120b")。"""
+    provider, sep, name = model.partition(":")
+    if sep and provider in PROVIDER_BASE_URLS:
+        return provider, name
+    return default_provider, model
+
+
+def make_client(provider):
+    """建立指向供應商（或 RAG_LLM_BASE_URL 指定的本機 mock server）的 OpenAI client。"""
+    from openai import OpenAI
+
+    override = os.getenv("RAG_LLM_BASE_URL")
+    base_url = override or os.getenv(f"{provider.upper()}_BASE_URL") or PROVIDER_BASE_URLS[provider]
+    api_key = os.getenv(PROVIDER_KEY_ENVS[provider])
+    if not api_key:
+        if not override:
+            raise RuntimeError(f"{PROVIDER_KEY_ENVS[provider]} not found in environment.")
+        api_key = "mock"
+    return OpenAI(api_key=api_key, base_url=base_url)
+
+
+_CJK_CHAR = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]")
+_NON_CJK_RUN = re.compile(r"[^\s㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+")
+
+
+def estimate_tokens(text):
+    """不載入 tokenizer 的粗估：中日韓文字每字約 1 token，其餘每 4 個字元約 1 token。"""
+    text = text or ""
+    return len(_CJK_CHAR.findall(text)) + sum((len(run) + 3) // 4 for run in _NON_CJK_RUN.findall(text))
+
+
+class StreamStats:
+    """記錄一次串流生成的 time-to-first-token、總耗時與 token 數。"""
+
+    def __init__(self, provider, model):
+        self.provider = provider
+        self.model = model
+        self.start = time.perf_counter()
+        self.first_token_at = None
+        self.end = None
+        self.chars = 0
+        self.prompt_tokens_estimate = 0
+        self.usage = None
+        self._completion = []
+
+    @property
+    def ttft(self):
+        return self.first_token_at - self.start if self.first_token_at else None
+
+    @property
+    def total_seconds(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def summary(self):
+        ttft = f"{self.ttft:.2f}s" if self.ttft is not None else "n/a"
+        return (f"[LLM] provider={self.provider} model={self.model} ttft={ttft} "
+                f"total={self.total_seconds:.2f}s chars={self.chars}")
+
+    def token_counts(self):
+        """供應商有回傳 usage 時使用實際值，否則以 estimate_tokens 粗估。"""
+        if self.usage:
+            return {"prompt": self.usage.get("prompt_tokens"), "completion": self.usage.get("completion_tokens"),
+                    "estimated": False}
+        return {"prompt": self.prompt_tokens_estimate, "completion": estimate_tokens("".join(self._completion)),
+                "estimated": True}
+
+
+def stream_chat(model, messages, client=None, stats=None, default_provider="openai", **kwargs):
+    """以 stream=True 呼叫 chat completions，逐段 yield 文字。
+
+    `stats`（StreamStats）會在第一段文字到達時記錄 TTFT，結束時記錄總耗時。
+    """
+    provider, name = split_model(model, default_provider)
+    client = client or make_client(provider)
+    if stats is None:
+        stats = StreamStats(provider, name)
+    stats.prompt_tokens_estimate = sum(estimate_tokens(m.get("content")) for m in messages)
+    if provider in PROVIDER_BASE_URLS:
+        # OpenAI 相容端點要有 include_usage 才會在最後一個 chunk 回報實際 token 數
+        kwargs.setdefault("stream_options", {"include_usage": True})
+    response = client.chat.completions.create(model=name, messages=messages, stream=True, **kwargs)
+    for chunk in response:
+        usage = _chunk_usage(chunk)
+        if usage:
+            stats.usage = usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        if stats.first_token_at is None:
+            stats.first_token_at = time.perf_counter()
+        stats.chars += len(delta)
+        stats._completion.append(delta)
+        yield delta
+    stats.end = time.perf_counter()
+    print(stats.summary())
+
+
+def _chunk_usage(chunk):
+    # OpenAI 在最後一個 chunk 放 usage（需 stream_options），Groq 放在 x_groq.usage
+    usage = getattr(chunk, "usage", None)
+    if usage is None:
+        x_groq = getattr(chunk, "x_groq", None)
+        usage = x_groq.get("usage") if isinstance(x_groq, dict) else getattr(x_groq, "usage", None)
+    if usage is None:
+        return None
+    return usage if isinstance(usage, dict) else usage.model_dump()
@@ -0,0 +1,126 @@
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain_core.documents import Document
+from langchain_community.document_loaders import TextLoader, PyPDFLoader, UnstructuredWordDocumentLoader
+
+from rag_chunking import parse_front_matter
+
+# 支援的副檔名（.md 為 rag03_notion_to_pdf.py 直接匯出的 Notion Markdown）
+SUPPORTED_EXTENSIONS = (".txt", ".pdf", ".docx", ".md")
+
+
+class MarkdownLoader:
+    """載入 Markdown 檔；開頭的 front matter（notion_page_id、title 等）併入 metadata。"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            meta, body = parse_front_matter(f.read())
+        return [Document(page_content=body, metadata={**meta, "source": self.path})]
+
+
+def is_supported(fn):
+    return fn.lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def get_loader(path):
+    """依副檔名挑選 LangChain loader；不支援的格式回傳 None。"""
+    lower = path.lower()
+    if lower.endswith(".txt"):
+        return TextLoader(path, encoding="utf-8")
+    if lower.endswith(".pdf"):
+        return PyPDFLoader(path)
+    if lower.endswith(".docx"):
+        return UnstructuredWordDocumentLoader(path)
+    if lower.endswith(".md"):
+        return MarkdownLoader(path)
+    return None
+
+
+def load_file(path):
+    """載入單一檔案，回傳 (loader 名稱, Document 清單)。"""
+    loader = get_loader(path)
+    if loader is None:
+        raise ValueError(f"不支援的檔案格式: {os.path.basename(path)}")
+    return type(loader).__name__, loader.load()
+
+
+def list_upload_files(upload_dir):
+    """回傳 (支援的檔名, 不支援的檔名)，檔名已排序以確保輸出順序固定。"""
+    supported, skipped = [], []
+    for fn in sorted(os.listdir(upload_dir)):
+        if not os.path.isfile(os.path.join(upload_dir, fn)):
+            continue
+        (supported if is_supported(fn) else skipped).append(fn)
+    return supported, skipped
+
+
+@dataclass
+class LoadResult:
+    fn: str
+    loader: str = ""
+    docs: list = field(default_factory=list)
+    error: str = ""
+    seconds: float = 0.0
+    num_docs: int = 0
+
+
+def _timed_load(upload_dir, fn):
+    # 在 worker process 執行；例外轉成字串回傳，避免無法 pickle 的例外卡住 pool
+    start = time.perf_counter()
+    try:
+        loader_name, docs = load_file(os.path.join(upload_dir, fn))
+        return LoadResult(fn, loader_name, docs, seconds=time.perf_counter() - start, num_docs=len(docs))
+    except Exception as e:
+        return LoadResult(fn, error=str(e) or type(e).__name__, seconds=time.perf_counter() - start)
+
+
+def default_workers():
+    return int(os.getenv("RAG_LOAD_WORKERS", 0)) or (os.cpu_count() or 1)
+
+
+def iter_load_results(upload_dir, filenames, workers=None):
+    """依 filenames 順序逐一產生 LoadResult。
+
+    背景最多同時解析 `workers * 2` 個檔案，避免整個資料夾的 Document 同時留在記憶體。
+    """
+    workers = max(1, min(workers or default_workers(), len(filenames) or 1))
+    if workers == 1:
+        for fn in filenames:
+            yield _timed_load(upload_dir, fn)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        names = iter(filenames)
+        for fn in names:
+            pending.append(pool.submit(_timed_load, upload_dir, fn))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            yield pending.popleft().result()
+            fn = next(names, None)
+            if fn is not None:
+                pending.append(pool.submit(_timed_load, upload_dir, fn))
+
+
+def load_files_parallel(upload_dir, filenames, workers=None):
+    """用多個 process 平行解析檔案，回傳順序與 filenames 相同的 LoadResult 清單。"""
+    return list(iter_load_results(upload_dir, filenames, workers))
+
+
+def print_load_summary(results, wall_seconds):
+    """列出每個檔案的解析時間（由慢到快），以及平行化後的實際耗時。"""
+    if not results:
+        return
+    print("檔案解析時間：")
+    for r in sorted(results, key=lambda r: r.seconds, reverse=True):
+        status = f"{r.num_docs} 文件片段" if not r.error else "失敗"
+        print(f"  {r.seconds:7.2f}s  {r.fn} ({status})")
+    total = sum(r.seconds for r in results)
+    print(f"合計 {total:.2f}s，實際耗時 {wall_seconds:.2f}s（{len(results)} 個檔案）")
@@ -0,0 +1,100 @@
+"""本機 mock LLM server，模擬 OpenAI/Groq 的 /v1/chat/completions（含 stream=True 的 SSE）。
+
+用法：
+    python rag_mock_llm_server.py --port 8001 --ttft 0.5 --token-delay 0.02
+    set RAG_LLM_BASE_URL=http://127.0.0.1:8001/v1
+之後 rag02_rag_system.py / rag_streamlit_app.py 的串流路徑就可以離線測試。
+"""
+import json
+import time
+import uuid
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def mock_answer(messages):
+    question = messages[-1]["content"] if messages else ""
+    return f"（mock 回覆）已收到問題，共 {len(question)} 字。這是一段用來測試串流顯示的假回答，會逐字送出。"
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    ttft = 0.3
+    token_delay = 0.02
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        model = body.get("model", "mock")
+        answer = mock_answer(body.get("messages", []))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        time.sleep(self.ttft)
+        if not body.get("stream"):
+            self._send_json({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": answer}}],
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        for i, piece in enumerate(answer):
+            delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+            self._send_event({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+            })
+            time.sleep(self.token_delay)
+        self._send_event({
+            "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        })
+        if (body.get("stream_options") or {}).get("include_usage"):
+            # 與 OpenAI 相同：最後一個 chunk 沒有 choices，只帶 usage（token 數以字元數代替）
+            prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", []))
+            self._send_event({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [], "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(answer),
+                                         "total_tokens": prompt_tokens + len(answer)},
+            })
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _send_json(self, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_event(self, obj):
+        self.wfile.write(f"data: {json.dumps(obj, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host="127.0.0.1", port=8001, ttft=0.3, token_delay=0.02):
+    handler = type("ConfiguredMockLLMHandler", (MockLLMHandler,), {"ttft": ttft, "token_delay": token_delay})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock OpenAI-compatible LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between streamed tokens")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port, args.ttft, args.token_delay)
+    print(f"Mock LLM server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
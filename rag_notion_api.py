@@ -0,0 +1,127 @@
+import os
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from notion_client import Client
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+# Notion 官方限制平均每秒 3 個請求
+DEFAULT_RATE = 3.0
+DEFAULT_BURST = 3
+DEFAULT_MAX_RETRIES = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """執行緒安全的 token bucket：平均每秒 `rate` 個請求，最多累積 `burst` 個。"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def retry_after_seconds(error):
+    """429 回應的 Retry-After（秒數或 HTTP-date）換算成秒；沒有或無法解析時回傳 None。"""
+    value = (getattr(error, "headers", None) or {}).get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimitedClient(Client):
+    """所有 Notion API 請求都先經過 token bucket，遇到 429/5xx/逾時則以指數退避重試。"""
+
+    def __init__(self, *args, bucket=None, max_retries=DEFAULT_MAX_RETRIES, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket or TokenBucket()
+        self.max_retries = max_retries
+        self.retries = 0
+
+    def request(self, path, method, query=None, body=None, form_data=None, auth=None):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return super().request(path, method, query=query, body=body, form_data=form_data, auth=auth)
+            except (HTTPResponseError, RequestTimeoutError) as e:
+                status = getattr(e, "status", None)
+                if attempt >= self.max_retries or (status is not None and status not in RETRY_STATUSES):
+                    raise
+                self.retries += 1
+                retry_after = retry_after_seconds(e) if status == 429 else None
+                delay = retry_after if retry_after is not None else min(30.0, 0.5 * 2 ** attempt)
+                time.sleep(delay + random.uniform(0, 0.25))
+
+
+def make_notion_client(token, rate=None, max_retries=DEFAULT_MAX_RETRIES):
+    """建立限速的 Notion client；NOTION_API_BASE_URL 可指向本機 fake server。"""
+    options = {"auth": token}
+    base_url = os.getenv("NOTION_API_BASE_URL")
+    if base_url:
+        options["base_url"] = base_url
+    rate = rate or float(os.getenv("NOTION_RATE_LIMIT", DEFAULT_RATE))
+    return RateLimitedClient(options, bucket=TokenBucket(rate, max(1, int(rate))), max_retries=max_retries)
+
+
+def install_for_notion2md(client):
+    """讓 notion2md 的 StringExporter 共用同一個限速 client（notion2md 內部是 singleton）。"""
+    from notion2md.notion_api import NotionClient
+
+    NotionClient(client.options.auth)._client = client
+
+
+def query_database(client, database_id, start_cursor=None, page_size=100, filter=None, filter_properties=None):
+    """查詢資料庫的一頁結果（notion-client 2.7 已移除 databases.query，改直接呼叫 REST 路徑）。
+
+    `filter_properties` 只回傳指定的屬性 ID（例如 ["title"]），只需要頁面 ID 時可減少傳輸量。
+    """
+    body = {"page_size": page_size}
+    if start_cursor:
+        body["start_cursor"] = start_cursor
+    if filter:
+        body["filter"] = filter
+    query = {"filter_properties": filter_properties} if filter_properties is not None else None
+    return client.request(path=f"databases/{database_id}/query", method="POST", query=query, body=body)
+
+
+def iter_database_items(client, database_id, page_size=100, filter=None, filter_properties=None):
+    """逐筆產生資料庫項目；處理目前這頁時，下一頁的 cursor 已在背景查詢。"""
+    def fetch(cursor):
+        return query_database(client, database_id, cursor, page_size, filter, filter_properties)
+
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        future = prefetch.submit(fetch, None)
+        while future is not None:
+            resp = future.result()
+            future = None
+            if resp.get("has_more") and resp.get("next_cursor"):
+                future = prefetch.submit(fetch, resp["next_cursor"])
+            yield from resp.get("results", [])
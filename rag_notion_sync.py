@@ -0,0 +1,182 @@
+import os
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+SYNC_STATE_PATH = "notion_sync_state.json"
+CHANGES_PATH = "notion_changes.json"
+# Notion 的 last_edited_time 只精確到分鐘，查詢時把水位往前推一點，再以 state 精確比對
+WATERMARK_SLACK = timedelta(minutes=2)
+
+
+def utc_now_iso():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def edited_since_filter(watermark):
+    """資料庫查詢用的 last_edited_time 篩選條件；沒有水位（第一次同步）時回傳 None。"""
+    if not watermark:
+        return None
+    since = datetime.fromisoformat(watermark.replace("Z", "+00:00")) - WATERMARK_SLACK
+    return {"timestamp": "last_edited_time",
+            "last_edited_time": {"on_or_after": since.strftime("%Y-%m-%dT%H:%M:%S.000Z")}}
+
+
+def is_archived(page):
+    return bool(page.get("archived") or page.get("in_trash"))
+
+
+class NotionSyncState:
+    """記錄每個 Notion 頁面上次匯出時的 last_edited_time 與輸出檔案。
+
+    pages: {page_id: {"last_edited_time", "outputs": [路徑], "parent": 資料庫 ID 或 "page"}}
+    databases: {database_id: {"watermark": 上次同步開始的時間}}
+    """
+
+    def __init__(self, path=SYNC_STATE_PATH, pages=None, databases=None):
+        self.path = path
+        self.pages = pages or {}
+        self.databases = databases or {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or os.getenv("NOTION_SYNC_STATE", SYNC_STATE_PATH)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cls(path)
+        return cls(path, data.get("pages"), data.get("databases"))
+
+    def needs_export(self, page_id, last_edited_time):
+        entry = self.pages.get(page_id)
+        if entry is None or entry.get("last_edited_time") != last_edited_time:
+            return True
+        return not all(os.path.exists(p) for p in entry.get("outputs", []))
+
+    def record(self, page_id, last_edited_time, outputs, parent="page"):
+        """記錄匯出結果，回傳這次不再使用的舊輸出檔（例如頁面改名）。"""
+        with self._lock:
+            old = self.pages.get(page_id, {}).get("outputs", [])
+            self.pages[page_id] = {"last_edited_time": last_edited_time, "outputs": list(outputs), "parent": parent}
+        return [p for p in old if p not in outputs]
+
+    def forget(self, page_id):
+        with self._lock:
+            return self.pages.pop(page_id, {}).get("outputs", [])
+
+    def page_ids(self, parent):
+        return [pid for pid, entry in self.pages.items() if entry.get("parent") == parent]
+
+    def watermark(self, database_id):
+        return self.databases.get(database_id, {}).get("watermark")
+
+    def set_watermark(self, database_id, watermark):
+        self.databases[database_id] = {"watermark": watermark}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"pages": self.pages, "databases": self.databases}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class ChangeList:
+    """給 rag01_* `--changes` 使用的變更清單（uploaded_docs 內的檔名）。
+
+    多次同步之間若還沒重建索引，新的變更會併入既有清單；建置完成後由建置腳本清除。
+    """
+
+    def __init__(self, path=CHANGES_PATH):
+        self.path = path
+        self.changed = set()
+        self.removed = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=None):
+        changes = cls(path or os.getenv("NOTION_CHANGES_PATH", CHANGES_PATH))
+        try:
+            with open(changes.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            changes.changed = set(data.get("changed", []))
+            changes.removed = set(data.get("removed", []))
+        except (OSError, ValueError):
+            pass
+        return changes
+
+    def add_changed(self, paths):
+        with self._lock:
+            for p in paths:
+                fn = os.path.basename(p)
+                self.changed.add(fn)
+                self.removed.discard(fn)
+
+    def add_removed(self, paths):
+        with self._lock:
+            for p in paths:
+                fn = os.path.basename(p)
+                self.removed.add(fn)
+                self.changed.discard(fn)
+
+    def filenames(self):
+        return self.changed | self.removed
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"updated_at": utc_now_iso(), "changed": sorted(self.changed),
+                       "removed": sorted(self.removed)}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class NotionSync:
+    """把同步狀態與變更清單綁在一起，供 rag03_notion_to_pdf.py 的匯出流程呼叫。"""
+
+    def __init__(self, state=None, changes=None):
+        self.state = state or NotionSyncState.load()
+        self.changes = changes or ChangeList.load()
+        self.skipped = 0
+
+    def should_export(self, page):
+        if self.state.needs_export(page["id"], page.get("last_edited_time")):
+            return True
+        self.skipped += 1
+        return False
+
+    def exported(self, page_id, last_edited_time, written, parent="page"):
+        stale = remove_outputs(self.state.record(page_id, last_edited_time, written, parent))
+        self.changes.add_changed(written)
+        self.changes.add_removed(stale)
+
+    def archived(self, page_id):
+        removed = remove_outputs(self.state.forget(page_id))
+        self.changes.add_removed(removed)
+        for p in removed:
+            print(f"Removed output of archived page {page_id}: {p}")
+
+    def save(self):
+        self.state.save()
+        self.changes.save()
+
+    def summary(self):
+        return (f"[sync] unchanged={self.skipped} changed={len(self.changes.changed)} "
+                f"removed={len(self.changes.removed)} -> {self.changes.path}")
+
+
+def remove_outputs(paths):
+    """刪除已封存頁面的輸出檔，回傳實際刪除的路徑。"""
+    removed = []
+    for p in paths:
+        try:
+            os.remove(p)
+            removed.append(p)
+        except FileNotFoundError:
+            pass
+    return removed
@@ -0,0 +1,211 @@
+"""把 multilingual-e5-large 匯出成 ONNX 並做動態 int8 量化，再與 PyTorch fp32 模型比對品質與速度。
+
+用法：
+    python rag_onnx_export.py                         # 匯出到 .onnx/multilingual-e5-large-int8
+    python rag_onnx_export.py --check --store faiss_db --json-out onnx_parity.json
+    set RAG_EMBEDDING_BACKEND=onnx                    # 之後建索引與查詢都改用 onnxruntime
+
+--check 以向量資料庫內的區塊（最多 --sample 筆）與 rag_bench_queries.jsonl 的問題比較：
+  - cosine：同一段文字 fp32 與 int8 向量的 cosine（平均、p5、最小）
+  - recall@k：int8 檢索前 k 筆與 fp32 檢索前 k 筆的重疊比例
+  - 吞吐量：passage 批次 texts/s、tokens/s，單一 query 延遲 p50/p95
+需要 torch、transformers（匯出與 fp32 基準）、onnx 與 onnxruntime。
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+
+import numpy as np
+
+from rag_bench_retrieval import DEFAULT_QUERIES_PATH, load_queries
+from rag_embeddings import (DEFAULT_ONNX_DIR, E5_MODEL_NAME, ONNX_INFO_FILE, ONNX_MODEL_FILE, PASSAGE_PREFIX,
+                            QUERY_PREFIX, E5Embeddings, HashingEmbeddings, OnnxE5Embeddings)
+from rag_vectorstores import get_documents_by_ids, open_vectorstore, store_chunk_ids
+
+DEFAULT_OPSET = 17
+DEFAULT_SAMPLE = 512
+DEFAULT_K = 10
+MAX_LENGTH = 512
+
+
+def export_fp32(model_name, out_path, opset=DEFAULT_OPSET):
+    """以 TorchScript exporter 匯出 last_hidden_state；batch 與序列長度為動態維度。
+
+    e5-large 的 fp32 權重超過 2GB，exporter 會自動把權重存成外部檔案。
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    sample = tokenizer([QUERY_PREFIX + "範例問題", PASSAGE_PREFIX + "example passage"], padding=True,
+                       return_tensors="pt")
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model, (sample["input_ids"], sample["attention_mask"]), out_path,
+            input_names=["input_ids", "attention_mask"], output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"}
+                          for name in ("input_ids", "attention_mask", "last_hidden_state")},
+            opset_version=opset, do_constant_folding=True, dynamo=False,
+        )
+    return tokenizer
+
+
+def quantize_int8(fp32_path, int8_path, per_channel=True, reduce_range=False):
+    """動態量化：權重（MatMul、Gather）存成 int8，activation 在執行時才量化，不需要校正資料。"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8, per_channel=per_channel,
+                     reduce_range=reduce_range)
+
+
+def export(model_name, out_dir, opset=DEFAULT_OPSET, per_channel=True, reduce_range=False, keep_fp32=False):
+    fp32_dir = os.path.join(out_dir, "fp32")
+    fp32_path = os.path.join(fp32_dir, ONNX_MODEL_FILE)
+    start = time.perf_counter()
+    tokenizer = export_fp32(model_name, fp32_path, opset)
+    print(f"已匯出 fp32 ONNX（{time.perf_counter() - start:.1f}s）")
+
+    start = time.perf_counter()
+    quantize_int8(fp32_path, os.path.join(out_dir, ONNX_MODEL_FILE), per_channel, reduce_range)
+    print(f"已量化為 int8（{time.perf_counter() - start:.1f}s）")
+
+    # OnnxE5Embeddings 只需要 tokenizer.json（tokenizers 套件），執行時不用 import transformers
+    tokenizer.save_pretrained(out_dir)
+    with open(os.path.join(out_dir, ONNX_INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "model_name": f"{model_name}-onnx-int8",
+            "source_model": model_name,
+            "quantization": "dynamic-int8",
+            "per_channel": per_channel,
+            "reduce_range": reduce_range,
+            "opset": opset,
+            "max_length": MAX_LENGTH,
+            "pooling": "mean",
+            "normalize": True,
+        }, f, ensure_ascii=False, indent=2)
+    if not keep_fp32:
+        shutil.rmtree(fp32_dir, ignore_errors=True)
+    size = os.path.getsize(os.path.join(out_dir, ONNX_MODEL_FILE))
+    print(f"✅ {out_dir}/{ONNX_MODEL_FILE}（{size / 1e6:.0f} MB）")
+
+
+def corpus_texts(store_dir, sample, seed=0):
+    # 只讀區塊文字，開啟時的 embedding 不會被用到
+    store = open_vectorstore(store_dir, HashingEmbeddings())
+    ids = sorted(store_chunk_ids(store))
+    if len(ids) > sample:
+        ids = sorted(np.random.default_rng(seed).choice(ids, sample, replace=False))
+    return [d.page_content for d in get_documents_by_ids(store, ids)]
+
+
+def timed_embed(embedding, texts, prefix):
+    start = time.perf_counter()
+    vectors = embedding.embed_with_prefix(texts, prefix)
+    return np.asarray(vectors, dtype=np.float32), time.perf_counter() - start
+
+
+def query_latencies(embedding, questions):
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        embedding.embed_with_prefix([question], QUERY_PREFIX)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def top_k(queries, passages, k):
+    return np.argsort(-(queries @ passages.T), axis=1)[:, :k]
+
+
+def check(model_dir, store_dir, queries_path, sample=DEFAULT_SAMPLE, k=DEFAULT_K):
+    """fp32（PyTorch）對 int8（onnxruntime）的 cosine 一致性、recall@k 與吞吐量。兩邊都不使用 embedding 快取。"""
+    texts = corpus_texts(store_dir, sample)
+    questions = [q["question"] for q in load_queries(queries_path)]
+    k = min(k, len(texts))
+    print(f"{len(texts)} 個區塊、{len(questions)} 個問題")
+
+    results = {}
+    vectors = {}
+    for name, embedding in (("fp32", E5Embeddings(cache=None)), ("int8", OnnxE5Embeddings(model_dir, cache=None))):
+        # 先跑一次，避免把第一次配置記憶體的時間算進去
+        embedding.embed_with_prefix(texts[:2], PASSAGE_PREFIX)
+        embedding.stats.tokens = embedding.stats.seconds = 0
+        passages, seconds = timed_embed(embedding, texts, PASSAGE_PREFIX)
+        tokens = embedding.stats.tokens
+        queries, _ = timed_embed(embedding, questions, QUERY_PREFIX)
+        latencies = query_latencies(embedding, questions)
+        vectors[name] = (passages, queries)
+        results[name] = {
+            "texts_per_s": len(texts) / seconds,
+            "tokens_per_s": tokens / seconds if seconds else 0.0,
+            "query_p50_ms": float(np.percentile(latencies, 50)),
+            "query_p95_ms": float(np.percentile(latencies, 95)),
+        }
+
+    (p32, q32), (p8, q8) = vectors["fp32"], vectors["int8"]
+    cosines = np.sum(p32 * p8, axis=1)
+    query_cosines = np.sum(q32 * q8, axis=1)
+    ref, got = top_k(q32, p32, k), top_k(q8, p8, k)
+    overlap = [len(set(a) & set(b)) / k for a, b in zip(ref, got)]
+    top1 = float(np.mean(ref[:, 0] == got[:, 0]))
+    results["parity"] = {
+        "passage_cosine_mean": float(cosines.mean()),
+        "passage_cosine_p5": float(np.percentile(cosines, 5)),
+        "passage_cosine_min": float(cosines.min()),
+        "query_cosine_mean": float(query_cosines.mean()),
+        f"recall@{k}": float(np.mean(overlap)),
+        "top1_agreement": top1,
+        "speedup": results["int8"]["texts_per_s"] / results["fp32"]["texts_per_s"],
+        "model_mb": os.path.getsize(os.path.join(model_dir, ONNX_MODEL_FILE)) / 1e6,
+    }
+    return results
+
+
+def format_report(results):
+    lines = ["| backend | texts/s | tokens/s | query p50 ms | query p95 ms |", "|---|---|---|---|---|"]
+    for name in ("fp32", "int8"):
+        r = results[name]
+        lines.append(f"| {name} | {r['texts_per_s']:.1f} | {r['tokens_per_s']:.0f} | "
+                     f"{r['query_p50_ms']:.1f} | {r['query_p95_ms']:.1f} |")
+    lines.append("")
+    lines.extend(f"- {key}: {value:.4f}" for key, value in results["parity"].items())
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export multilingual-e5-large to int8 ONNX and check parity")
+    parser.add_argument("--model", default=E5_MODEL_NAME)
+    parser.add_argument("--out", default=os.getenv("RAG_ONNX_MODEL_DIR", DEFAULT_ONNX_DIR))
+    parser.add_argument("--opset", type=int, default=DEFAULT_OPSET)
+    parser.add_argument("--no-per-channel", action="store_true", help="per-tensor weight scales (smaller, less accurate)")
+    parser.add_argument("--reduce-range", action="store_true", help="7-bit weights for CPUs without VNNI")
+    parser.add_argument("--keep-fp32", action="store_true", help="keep the intermediate fp32 ONNX model")
+    parser.add_argument("--force", action="store_true", help="re-export even if the model already exists")
+    parser.add_argument("--check", action="store_true", help="compare with the PyTorch fp32 model")
+    parser.add_argument("--store", default="faiss_db", help="vector store whose chunks are used for --check")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES_PATH)
+    parser.add_argument("--sample", type=int, default=DEFAULT_SAMPLE, help="max chunks used for --check")
+    parser.add_argument("--k", type=int, default=DEFAULT_K)
+    parser.add_argument("--json-out", help="write --check results as JSON")
+    args = parser.parse_args()
+
+    if args.force or not os.path.exists(os.path.join(args.out, ONNX_MODEL_FILE)):
+        export(args.model, args.out, args.opset, per_channel=not args.no_per_channel,
+               reduce_range=args.reduce_range, keep_fp32=args.keep_fp32)
+    else:
+        print(f"{args.out} 已存在，略過匯出（--force 重新匯出）。")
+
+    if args.check:
+        results = check(args.out, args.store, args.queries, args.sample, args.k)
+        print(format_report(results))
+        if args.json_out:
+            with open(args.json_out, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import os
+import queue
+import threading
+from importlib.util import find_spec
+from concurrent.futures import Future
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_MAX_RENDERS = 50
+
+
+class PdfRenderer:
+    """長駐的 Playwright PDF renderer，讓整批匯出共用少數幾個 Chromium。
+
+    Playwright 的 sync API 物件只能在建立它的執行緒中使用，所以每個 worker 執行緒各自擁有
+    一個 browser 與 browser context，工作透過 queue 交給 worker。context 每渲染
+    `max_renders` 頁或發生錯誤時重建；browser 斷線時重新啟動。
+    render() 回傳 False 時，呼叫端應改用 xhtml2pdf / Markdown 回退。
+    """
+
+    def __init__(self, size=None, max_renders=None):
+        self.size = max(1, size or int(os.getenv("NOTION_PDF_BROWSERS", DEFAULT_POOL_SIZE)))
+        self.max_renders = max(1, max_renders or int(os.getenv("NOTION_PDF_MAX_RENDERS", DEFAULT_MAX_RENDERS)))
+        self.available = False
+        self.renders = 0
+        self.restarts = 0
+        self.failures = 0
+        self._jobs = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if find_spec("playwright") is None:
+            print("Playwright not installed; PDF rendering will use the xhtml2pdf/markdown fallback.")
+            return self
+        self.available = True
+        for i in range(self.size):
+            t = threading.Thread(target=self._worker, name=f"pdf-renderer-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def render(self, html, output_path):
+        """以 pool 中的瀏覽器把 HTML 存成 PDF；成功回傳 True。"""
+        if not self.available:
+            return False
+        future = Future()
+        self._jobs.put((html, output_path, future))
+        return future.result()
+
+    def close(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self.available = False
+
+    def summary(self):
+        return f"renders={self.renders} context_restarts={self.restarts} failures={self.failures}"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _worker(self):
+        from playwright.sync_api import sync_playwright
+
+        try:
+            playwright = sync_playwright().start()
+        except Exception as e:
+            print(f"Failed to start Playwright: {e}")
+            playwright = None
+        browser = None
+        context = None
+        used = 0
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            html, output_path, future = job
+            if playwright is None:
+                future.set_result(False)
+                continue
+            try:
+                if browser is None or not browser.is_connected():
+                    browser = playwright.chromium.launch()
+                    context = None
+                if context is not None and used >= self.max_renders:
+                    _close_quietly(context)
+                    context = None
+                    self._count("restarts")
+                if context is None:
+                    context = browser.new_context()
+                    used = 0
+                page = context.new_page()
+                try:
+                    page.set_content(html, wait_until="networkidle")
+                    page.pdf(path=output_path, print_background=True, format="A4")
+                finally:
+                    _close_quietly(page)
+                used += 1
+                self._count("renders")
+                future.set_result(True)
+            except Exception as e:
+                print(f"Playwright render failed for {output_path}: {e}")
+                self._count("failures")
+                # 視為 context 損毀：下一頁重建 context，browser 斷線則重新啟動
+                if context is not None:
+                    _close_quietly(context)
+                    context = None
+                    self._count("restarts")
+                if browser is not None and not browser.is_connected():
+                    browser = None
+                future.set_result(False)
+
+        _close_quietly(context)
+        _close_quietly(browser)
+        if playwright is not None:
+            playwright.stop()
+
+
+def _close_quietly(obj):
+    if obj is None:
+        return
+    try:
+        obj.close()
+    except Exception:
+        pass
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from rag_index_manifest import MANIFEST_NAME
+from rag_faiss_index import FAISS_SETTINGS_NAME
+from rag_vectorstores import chunk_id_of, get_documents_by_ids
+
+DEFAULT_MAX_ENTRIES = 512
+# SQLite 的暫存檔在讀取時也會變動，不列入指紋
+_VOLATILE_SUFFIXES = ("-wal", "-shm", "-journal", ".tmp")
+# 只換索引類型或查詢參數時 manifest 不變，設定檔也要列入指紋
+_FINGERPRINT_SIDECARS = (FAISS_SETTINGS_NAME,)
+
+
+def normalize_query(text):
+    """全形轉半形、去頭尾空白、合併連續空白並轉小寫，讓相同問題得到相同 key。"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return " ".join(text.split()).lower()
+
+
+def index_fingerprint(*paths):
+    """計算向量資料庫的版本指紋；重建索引後指紋會改變。
+
+    有 manifest 時以其內容（加上 ANN 索引設定檔）為準，否則以索引檔的大小與修改時間計算。
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        if not path or not os.path.exists(path):
+            continue
+        manifest_path = os.path.join(path, MANIFEST_NAME)
+        if os.path.isfile(manifest_path):
+            for name in (MANIFEST_NAME,) + _FINGERPRINT_SIDECARS:
+                sidecar = os.path.join(path, name)
+                if os.path.isfile(sidecar):
+                    with open(sidecar, "rb") as f:
+                        h.update(f.read())
+            continue
+        for root, _, files in sorted(os.walk(path)):
+            for fn in sorted(files):
+                if fn.endswith(_VOLATILE_SUFFIXES):
+                    continue
+                st = os.stat(os.path.join(root, fn))
+                h.update(f"{os.path.relpath(os.path.join(root, fn), path)}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+class QueryCache:
+    """查詢端快取：記住問題的 query 向量與檢索到的 chunk ID。
+
+    key 為 (正規化問題, k, 索引指紋)，程序內以 LRU 保存，可選擇同時寫入 SQLite
+    讓重啟後仍能命中。索引指紋改變時（重建向量資料庫）舊資料會自動清除。
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, path=None):
+        self.max_entries = max_entries
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._vectors = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, value TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        path = os.getenv("RAG_QUERY_CACHE_PATH") or None
+        return cls(max_entries=int(os.getenv("RAG_QUERY_CACHE_SIZE", DEFAULT_MAX_ENTRIES)), path=path)
+
+    def sync(self, fingerprint):
+        """設定目前索引指紋；指紋改變時清空快取並回傳 True。"""
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return False
+            changed = self.fingerprint is not None
+            self.fingerprint = fingerprint
+            # 重建可能換了 embedding backend/模型，舊的 query 向量也不能再用
+            self._entries.clear()
+            self._vectors.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM entries WHERE fingerprint != ?", (fingerprint,))
+                self._db.commit()
+            return changed
+
+    def _key(self, query, k):
+        return f"{self.fingerprint}:{k}:{normalize_query(query)}"
+
+    def get(self, query, k):
+        key = self._key(query, k)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                if row:
+                    entry = json.loads(row[0])
+                    self._store(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def get_vector(self, query):
+        with self._lock:
+            vector = self._vectors.get(normalize_query(query))
+            if vector is not None:
+                self._vectors.move_to_end(normalize_query(query))
+            return vector
+
+    def put(self, query, k, vector, chunk_ids):
+        key = self._key(query, k)
+        entry = {"vector": [float(x) for x in vector], "chunk_ids": list(chunk_ids)}
+        with self._lock:
+            self._store(key, entry)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO entries (key, fingerprint, value, last_used) VALUES (?, ?, ?, ?)",
+                    (key, self.fingerprint, json.dumps(entry), time.time()),
+                )
+                self._db.execute(
+                    "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+                self._db.commit()
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        query = key.split(":", 2)[2]
+        self._vectors[query] = entry["vector"]
+        self._vectors.move_to_end(query)
+        while len(self._vectors) > self.max_entries:
+            self._vectors.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "fingerprint": self.fingerprint,
+        }
+
+
+def cached_similarity_search(store, query, k, cache=None, embedding=None, timings=None):
+    """先查 QueryCache，未命中時才計算 query 向量並搜尋向量資料庫。
+
+    `timings`（dict）會填入 embed_ms、dense_ms 與 query_cache_hit。
+    """
+    timings = {} if timings is None else timings
+    timings["query_cache_hit"] = False
+    if cache is not None:
+        start = time.perf_counter()
+        entry = cache.get(query, k)
+        if entry is not None:
+            docs = get_documents_by_ids(store, entry["chunk_ids"])
+            if len(docs) == len(entry["chunk_ids"]):
+                timings["dense_ms"] = (time.perf_counter() - start) * 1000
+                timings["query_cache_hit"] = True
+                return docs
+
+    start = time.perf_counter()
+    vector = cache.get_vector(query) if cache is not None else None
+    if vector is None:
+        embedding = embedding or store.embeddings
+        vector = embedding.embed_query(query)
+    searched = time.perf_counter()
+    docs = store.similarity_search_by_vector(vector, k=k)
+    timings["embed_ms"] = (searched - start) * 1000
+    timings["dense_ms"] = (time.perf_counter() - searched) * 1000
+    if cache is not None:
+        ids = [chunk_id_of(d) for d in docs]
+        if all(ids):
+            cache.put(query, k, vector, ids)
+    return docs
@@ -0,0 +1,152 @@
+import os
+import time
+
+import numpy as np
+
+from rag_lexical import tokenize
+
+RERANKERS = ("none", "lexical", "embedding", "cross-encoder")
+DEFAULT_CANDIDATES = 20
+DEFAULT_BATCH_SIZE = 8
+DEFAULT_BUDGET_MS = 300
+# 多語 cross-encoder（支援中文），約 120M 參數，CPU 上一批 8 筆約數十毫秒
+DEFAULT_CROSS_ENCODER = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+
+class LexicalScorer:
+    """最便宜的 scorer：query token（含中文 bigram）在段落中出現的比例，用來測試流程或當作後備。"""
+
+    name = "lexical"
+
+    def bind(self, query):
+        """回傳只對這個 query 評分的函式；scorer 由多個請求共用，與 query 相關的狀態只留在回傳的函式裡。"""
+        terms = set(tokenize(query))
+
+        def score(texts):
+            if not terms:
+                return [0.0] * len(texts)
+            return [len(terms & set(tokenize(t))) / len(terms) for t in texts]
+        return score
+
+    def score(self, query, texts):
+        return self.bind(query)(texts)
+
+
+class EmbeddingScorer:
+    """以 embedding cosine 相似度重新評分；E5Embeddings 建索引時已快取段落向量，幾乎不用再跑模型。"""
+
+    name = "embedding"
+
+    def __init__(self, embedding):
+        self.embedding = embedding
+
+    def bind(self, query):
+        # query 向量每次 rerank 只算一次（第一批評分時），各批候選共用
+        query_vector = None
+
+        def score(texts):
+            nonlocal query_vector
+            if query_vector is None:
+                query_vector = _unit(self.embedding.embed_query(query))
+            vectors = np.asarray(self.embedding.embed_documents(list(texts)), dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            return ((vectors / np.maximum(norms, 1e-12)) @ query_vector).tolist()
+        return score
+
+    def score(self, query, texts):
+        return self.bind(query)(texts)
+
+
+class CrossEncoderScorer:
+    """sentence-transformers CrossEncoder；模型在第一次評分時才載入。"""
+
+    name = "cross-encoder"
+
+    def __init__(self, model_name=None):
+        self.model_name = model_name or os.getenv("RAG_RERANK_MODEL", DEFAULT_CROSS_ENCODER)
+        self._model = None
+
+    def bind(self, query):
+        return lambda texts: self.score(query, texts)
+
+    def score(self, query, texts):
+        if self._model is None:
+            from sentence_transformers import CrossEncoder
+            self._model = CrossEncoder(self.model_name)
+        pairs = [(query, t) for t in texts]
+        return np.asarray(self._model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)).tolist()
+
+
+class Reranker:
+    """第二階段重新排序：第一階段多取 `candidates` 筆，依 scorer 分數保留前 k 筆。
+
+    候選依第一階段順序分批評分；時間預算（budget_ms）用完、或預估下一批會超時，就停止評分。
+    已評分的前段依分數重排，其餘保留第一階段順序接在後面（預算為 0 等同不重排）。
+    """
+
+    def __init__(self, scorer, candidates=DEFAULT_CANDIDATES, batch_size=DEFAULT_BATCH_SIZE,
+                 budget_ms=DEFAULT_BUDGET_MS):
+        self.scorer = scorer
+        self.candidates = candidates
+        self.batch_size = max(1, batch_size)
+        self.budget_ms = budget_ms
+
+    @property
+    def name(self):
+        return self.scorer.name
+
+    def rerank(self, query, docs, k, timings=None, budget_ms=None):
+        """`budget_ms` 只覆寫這次呼叫的時間預算（例如 Streamlit 各 session 的設定），不修改共用的 reranker。"""
+        start = time.perf_counter()
+        deadline = start + (self.budget_ms if budget_ms is None else budget_ms) / 1000.0
+        scores = []
+        batch_seconds = 0.0
+        budget_hit = False
+        score = self.scorer.bind(query)
+        for i in range(0, len(docs), self.batch_size):
+            now = time.perf_counter()
+            if now + batch_seconds > deadline:
+                budget_hit = True
+                break
+            batch = docs[i:i + self.batch_size]
+            scores.extend(score([d.page_content for d in batch]))
+            batch_seconds = max(batch_seconds, time.perf_counter() - now)
+
+        scored = len(scores)
+        order = sorted(range(scored), key=lambda i: -scores[i])
+        result = [docs[i] for i in order] + list(docs[scored:])
+        if timings is not None:
+            timings["rerank_ms"] = (time.perf_counter() - start) * 1000
+            timings["rerank_scored"] = scored
+            timings["rerank_candidates"] = len(docs)
+            timings["rerank_budget_hit"] = budget_hit
+        return result[:k]
+
+
+def make_reranker(kind=None, embedding=None, candidates=None, budget_ms=None, batch_size=None):
+    """依名稱（或 RAG_RERANKER 環境變數）建立 Reranker；"none" 回傳 None。"""
+    kind = (kind or os.getenv("RAG_RERANKER", "none")).lower()
+    if kind == "lexical":
+        scorer = LexicalScorer()
+    elif kind == "embedding":
+        if embedding is None:
+            raise ValueError("embedding reranker 需要 embedding 物件")
+        scorer = EmbeddingScorer(embedding)
+    elif kind == "cross-encoder":
+        scorer = CrossEncoderScorer()
+    elif kind == "none":
+        return None
+    else:
+        raise ValueError(f"未知的 reranker: {kind}（可用：{', '.join(RERANKERS)}）")
+    return Reranker(
+        scorer,
+        candidates=candidates or int(os.getenv("RAG_RERANK_CANDIDATES", DEFAULT_CANDIDATES)),
+        batch_size=batch_size or int(os.getenv("RAG_RERANK_BATCH_SIZE", DEFAULT_BATCH_SIZE)),
+        budget_ms=float(budget_ms if budget_ms is not None else os.getenv("RAG_RERANK_BUDGET_MS", DEFAULT_BUDGET_MS)),
+    )
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
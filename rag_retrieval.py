@@ -0,0 +1,89 @@
+import os
+import time
+
+from rag_lexical import LexicalIndex
+from rag_query_cache import cached_similarity_search
+from rag_vectorstores import chunk_id_of, get_documents_by_ids
+
+RRF_K = 60
+# 兩路各多取幾筆再融合，避免只出現在其中一路前段的區塊被截掉
+DEFAULT_FETCH_MULTIPLIER = 3
+
+
+def hybrid_enabled():
+    return os.getenv("RAG_HYBRID", "1").lower() not in ("0", "false", "no", "off")
+
+
+def load_lexical_index(store_dir):
+    """讀取向量資料庫旁的 BM25 索引；關閉 hybrid 或索引不存在時回傳 None。"""
+    if not hybrid_enabled():
+        return None
+    return LexicalIndex.load(store_dir)
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Reciprocal rank fusion：每個排名清單貢獻 1 / (k + rank)，回傳依總分排序的 ID。"""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda item: -scores[item])
+
+
+def hybrid_search(store, query, k, lexical=None, cache=None, embedding=None, fetch_k=None, timings=None):
+    """dense（FAISS/Chroma）與 BM25 各取 fetch_k 筆，以 RRF 合併後回傳前 k 個 Document。
+
+    沒有 BM25 索引，或舊索引的區塊沒有 chunk ID 時，退回純 dense 檢索。
+    `timings`（dict）會填入 embed_ms、dense_ms、lexical_ms。
+    """
+    if lexical is None or not len(lexical):
+        return cached_similarity_search(store, query, k=k, cache=cache, embedding=embedding, timings=timings)
+    fetch_k = fetch_k or k * DEFAULT_FETCH_MULTIPLIER
+    dense_docs = cached_similarity_search(store, query, k=fetch_k, cache=cache, embedding=embedding, timings=timings)
+    dense_ids = [chunk_id_of(d) for d in dense_docs]
+    if not all(dense_ids):
+        return dense_docs[:k]
+    start = time.perf_counter()
+    lexical_ids = [chunk_id for chunk_id, _ in lexical.search(query, fetch_k)]
+    if timings is not None:
+        timings["lexical_ms"] = (time.perf_counter() - start) * 1000
+
+    fused = reciprocal_rank_fusion([dense_ids, lexical_ids])[:k]
+    by_id = dict(zip(dense_ids, dense_docs))
+    missing = [i for i in fused if i not in by_id]
+    for doc in get_documents_by_ids(store, missing):
+        by_id[chunk_id_of(doc)] = doc
+    return [by_id[i] for i in fused if i in by_id]
+
+
+def retrieve(store, query, k, lexical=None, cache=None, embedding=None, reranker=None, timings=None,
+             rerank_candidates=None, rerank_budget_ms=None):
+    """完整的檢索流程：第一階段 hybrid（或 dense）檢索，有 reranker 時多取候選再重新排序。
+
+    `rerank_candidates` / `rerank_budget_ms` 覆寫這次請求的 reranker 設定（reranker 由多個 session 共用）。
+    `timings`（dict）會填入各階段耗時（毫秒），例如 embed_ms、dense_ms、lexical_ms、first_stage_ms、rerank_ms。
+    """
+    start = time.perf_counter()
+    if reranker is not None:
+        fetch = max(k, rerank_candidates or reranker.candidates)
+    else:
+        fetch = k
+    docs = hybrid_search(store, query, fetch, lexical=lexical, cache=cache, embedding=embedding, timings=timings)
+    if timings is not None:
+        timings["first_stage_ms"] = (time.perf_counter() - start) * 1000
+        timings["first_stage_hits"] = len(docs)
+    if reranker is not None:
+        docs = reranker.rerank(query, docs, k, timings=timings, budget_ms=rerank_budget_ms)
+    if timings is not None:
+        timings["retrieval_ms"] = (time.perf_counter() - start) * 1000
+    return docs[:k]
+
+
+def format_timings(timings):
+    """把各階段耗時整理成一行文字，給終端機 log 與 Streamlit caption 使用。"""
+    parts = [f"first stage {timings.get('first_stage_ms', 0):.0f} ms"]
+    if "rerank_ms" in timings:
+        rerank = f"rerank {timings['rerank_ms']:.0f} ms ({timings['rerank_scored']}/{timings['rerank_candidates']} scored"
+        parts.append(rerank + (", budget hit)" if timings.get("rerank_budget_hit") else ")"))
+    parts.append(f"total {timings.get('retrieval_ms', 0):.0f} ms")
+    return " · ".join(parts)
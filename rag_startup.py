@@ -0,0 +1,136 @@
+"""冷啟動：把重量級 import、模型與索引載入移到背景執行緒，並記錄各階段耗時。
+
+Gradio / Streamlit 先把畫面送出去，UI 以 `BackgroundInit.describe()` 顯示目前進度，
+初始化完成後才開放提問。完成時印出 import / 載入 / warm-up 的時間分解。
+
+環境變數：
+    RAG_STARTUP=background|eager    背景初始化（預設）或在啟動時同步完成（舊行為）
+    RAG_WARMUP=1                    初始化最後以範例問題跑一次檢索，預先填好 query 快取與模型（預設開啟）
+"""
+import os
+import time
+import importlib
+import threading
+from contextlib import contextmanager
+
+# Gradio 與 Streamlit 共用的範例問題，也是 warm-up 使用的問題
+PRESET_QUESTIONS = ["GIT reset 怎麼寫？", "Vue 的 props 是甚麼用途", "AWS EC2 是甚麼？"]
+
+PENDING, LOADING, READY, FAILED = "pending", "loading", "ready", "failed"
+
+
+def background_enabled():
+    return os.getenv("RAG_STARTUP", "background").lower() != "eager"
+
+
+def warmup_enabled():
+    return os.getenv("RAG_WARMUP", "1").lower() not in ("0", "false", "no", "off")
+
+
+class StartupTimer:
+    """依序記錄啟動各階段（import、載入模型、開啟索引、warm-up…）的耗時。"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self.current = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        with self._lock:
+            self.current = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, time.perf_counter() - start))
+                self.current = None
+
+    def import_module(self, name):
+        with self.phase(f"import {name}"):
+            return importlib.import_module(name)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def report(self):
+        with self._lock:
+            phases = list(self.phases)
+        lines = ["啟動時間分解："]
+        for name, seconds in phases:
+            lines.append(f"  {name:<28} {seconds:8.2f}s")
+        lines.append(f"  {'total (wall)':<28} {self.elapsed:8.2f}s")
+        return "\n".join(lines)
+
+
+class BackgroundInit:
+    """在背景執行緒執行 `init(timer)` 一次，保存結果或例外，並提供 UI 可顯示的狀態。"""
+
+    def __init__(self, init, name="startup", timer=None):
+        self.init = init
+        self.name = name
+        # 傳入模組一開始建立的 timer，時間分解才包含初始化之前的 import（例如 gradio）
+        self.timer = timer if timer is not None else StartupTimer()
+        self.state = PENDING
+        self.result = None
+        self.error = None
+        self.seconds = None
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self, background=None):
+        """背景啟動（預設依 RAG_STARTUP）；`background=False` 時同步執行完才回傳。"""
+        if self.state != PENDING:
+            return self
+        self.state = LOADING
+        if background is None:
+            background = background_enabled()
+        if background:
+            self._thread = threading.Thread(target=self._run, name=f"rag-{self.name}", daemon=True)
+            self._thread.start()
+        else:
+            self._run()
+        return self
+
+    def _run(self):
+        try:
+            self.result = self.init(self.timer)
+        except Exception as e:
+            self.error = e
+        self.seconds = self.timer.elapsed
+        self.state = FAILED if self.error is not None else READY
+        self._done.set()
+        print(self.timer.report())
+        if self.error is not None:
+            print(f"初始化失敗: {self.error}")
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    def wait(self, timeout=None):
+        """等待初始化完成並回傳結果；失敗時重新丟出原本的例外。"""
+        if self.state == PENDING:
+            self.start()
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"{self.name} 尚未完成（{self.describe()}）")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def describe(self):
+        if self.state == READY:
+            return f"✅ 已就緒（啟動 {self.seconds:.1f}s）"
+        if self.state == FAILED:
+            return f"❌ 初始化失敗：{self.error}"
+        current = self.timer.current or "準備中"
+        return f"⏳ 載入中：{current}（已經過 {self.timer.elapsed:.1f}s）"
+
+
+def warm_up(search, questions=PRESET_QUESTIONS):
+    """以範例問題各跑一次 `search(question)`：載入模型權重、填好 query 快取並讓 memory map 的索引頁進入記憶體。"""
+    for question in questions:
+        search(question)
@@ -1,106 +1,126 @@
 import os
+import time
+from functools import partial
 from dotenv import load_dotenv
 load_dotenv()
 
 import streamlit as st
-from sentence_transformers import SentenceTransformer
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from dotenv import load_dotenv
-load_dotenv()
 
-import streamlit as st
-from sentence_transformers import SentenceTransformer
-from langchain_community.vectorstores import FAISS
+# Only light modules are imported here; sentence-transformers, langchain and FAISS are imported by the
+# background initializer so the page renders right away on a cold start (see rag_startup.py)
+from rag_startup import FAILED, PRESET_QUESTIONS, BackgroundInit, warm_up, warmup_enabled
+from rag_rerank import RERANKERS, make_reranker
+from rag_llm import StreamStats, make_client, split_model, stream_chat
+from rag_tracing import Tracer, format_stage_stats
 
-try:
-    import aisuite as ai
-except Exception:
-    ai = None
-import time
+# How often the page re-runs while the background initializer is still loading
+STARTUP_POLL_SECONDS = 0.5
 
 
-class E5Embeddings(HuggingFaceEmbeddings):
-    def __init__(self, **kwargs):
-        super().__init__(
-            model_name="intfloat/multilingual-e5-large",
-            encode_kwargs={"normalize_embeddings": True},
-            **kwargs,
-        )
+def open_store(path, emb, notes):
+    # Returns (store, path actually opened); problems are collected in notes because this runs off the script thread
+    from rag_vectorstores import detect_backend, open_vectorstore
 
-    def embed_documents(self, texts):
-        texts = [f"passage: {t}" for t in texts]
-        return super().embed_documents(texts)
+    try:
+        # store.json records the backend; FAISS opens memory-mapped with a lazy SQLite docstore
+        return open_vectorstore(path, emb), path
+    except ImportError as e:
+        # FAISS (or chromadb) isn't installed in this deployment: fall back to the prebuilt Chroma DB
+        chroma_dir = "chroma_db"
+        if path != chroma_dir and detect_backend(chroma_dir) == "chroma":
+            try:
+                store = open_vectorstore(chroma_dir, emb)
+                notes.append(("warning", f"{e} — using existing Chroma DB at 'chroma_db'."))
+                return store, chroma_dir
+            except Exception as e2:
+                notes.append(("error", f"Vectorstore backend not available and Chroma fallback failed: {e2}"))
+                return None, path
+        notes.append(("error", f"Vectorstore backend not available for {path}: {e}"))
+        return None, path
+    except Exception as e:
+        notes.append(("error", f"Failed to load vectorstore from {path}: {e}"))
+        return None, path
+
+
+def initialize(path, timer):
+    # Background startup: heavy imports, E5 model, vectorstore, caches and an optional warm-up
+    rag_embeddings = timer.import_module("rag_embeddings")
+    rag_query_cache = timer.import_module("rag_query_cache")
+    rag_retrieval = timer.import_module("rag_retrieval")
+    rag_answer_cache = timer.import_module("rag_answer_cache")
+    rag_context = timer.import_module("rag_context")
+    notes = []
+    with timer.phase("load embedding model"):
+        # concurrent sessions share this store; their query embeddings are micro-batched
+        emb = rag_embeddings.QueryBatcher.from_env(rag_embeddings.make_embeddings())
+    with timer.phase(f"open {path}"):
+        store, store_path = open_store(path, emb, notes)
+    # Shared across sessions so repeated preset questions hit the cache
+    query_cache = rag_query_cache.QueryCache.from_env()
+    query_cache.sync(rag_query_cache.index_fingerprint(path, "chroma_db"))
+    if store is not None and warmup_enabled():
+        # Runs the preset questions once: loads model weights, fills the query cache, pages in the index
+        with timer.phase(f"warm-up ({len(PRESET_QUESTIONS)} questions)"):
+            lexical = rag_retrieval.load_lexical_index(store_path)
+            warm_up(lambda q: rag_retrieval.retrieve(store, q, k=4, lexical=lexical, cache=query_cache))
+    return {
+        "store": store,
+        "store_path": store_path,
+        "query_cache": query_cache,
+        "embedding": emb,
+        "answer_cache": rag_answer_cache.SemanticAnswerCache.from_env(),
+        "context_packer": rag_context.ContextPacker.from_env(),
+        "notes": notes,
+    }
 
-    def embed_query(self, text):
-        return super().embed_query(f"query: {text}")
+
+@st.cache_resource
+def get_startup(path):
+    # One initializer per store path and process; every session polls the same one
+    return BackgroundInit(partial(initialize, path), name=f"startup:{path}").start()
 
 
 @st.cache_resource
-def load_vectorstore(path="chroma_db"):
-    emb = E5Embeddings()
-    try:
-        # FAISS deserialization uses pickle; allow only when loading trusted local DBs
-        store = FAISS.load_local(path, emb, allow_dangerous_deserialization=True)
-        return store
-    except Exception as e:
-        # If faiss python package is missing or FAISS can't be imported, try Chromadb fallback
-        msg = str(e)
-        if "faiss" in msg.lower() or isinstance(e, ModuleNotFoundError) or "Could not import faiss" in msg:
-            try:
-                # Try langchain_community first (some deployments use this package)
-                try:
-                    from langchain_community.vectorstores import Chroma
-                except Exception:
-                    try:
-                        from langchain.vectorstores import Chroma
-                    except Exception as e_import:
-                        raise ImportError("Chroma vectorstore not found in langchain_community or langchain") from e_import
-
-                chroma_dir = "chroma_db"
-                if os.path.exists(chroma_dir):
-                    store = Chroma(persist_directory=chroma_dir, embedding_function=emb)
-                    st.warning("FAISS isn't available in this environment — using existing Chroma DB at 'chroma_db'.")
-                    return store
-                else:
-                    st.error("FAISS not available and no 'chroma_db' found. Please run the indexing script locally to create a vectorstore or deploy with FAISS support.")
-                    return None
-            except Exception as e2:
-                st.error(f"FAISS not available and Chroma fallback failed: {e2}")
-                return None
-        else:
-            st.error(f"Failed to load FAISS vectorstore from {path}: {e}")
-            return None
-
-
-def generate_from_openai(prompt: str, model_name: str = "gpt-3.5-turbo", temperature: float = 0.2):
-    import openai
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY not found in environment.")
-    openai.api_key = api_key
-    resp = openai.ChatCompletion.create(
-        model=model_name,
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=512,
-        temperature=temperature,
-    )
-    return resp.choices[0].message.content
+def get_lexical_index(path):
+    # BM25 index saved next to the vectorstore by the rag01_* builders (None if missing)
+    from rag_retrieval import load_lexical_index
 
+    return load_lexical_index(path)
 
-def generate_from_groq(client, model, system_prompt, final_prompt, temperature: float = 0.2):
-    # Uses aisuite client from rag02 implementation style
-    try:
-        # Attempt to pass temperature if supported by client
-        kwargs = {"model": model, "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": final_prompt}]}
-        try:
-            kwargs["temperature"] = float(temperature)
-        except Exception:
-            pass
-        response = client.chat.completions.create(**kwargs)
-        return response.choices[0].message.content
-    except Exception as e:
-        raise
+
+@st.cache_resource
+def get_reranker(kind, _embedding):
+    # Cached so a cross-encoder model is loaded once per process
+    return make_reranker(kind, embedding=_embedding)
+
+
+@st.cache_resource
+def get_tracer():
+    # One tracer per process: rotating JSONL file plus rolling per-stage percentiles for the sidebar
+    return Tracer.from_env()
+
+
+def generate_from_openai(prompt: str, model_name: str = "gpt-3.5-turbo", temperature: float = 0.2, stats=None):
+    # Streams text deltas from the OpenAI chat completions API
+    client = make_client("openai")
+    messages = [{"role": "user", "content": prompt}]
+    yield from stream_chat(model_name, messages, client=client, stats=stats, max_tokens=512, temperature=temperature)
+
+
+def generate_from_groq(client, model, system_prompt, final_prompt, temperature: float = 0.2, stats=None):
+    # Streams text deltas from Groq's OpenAI-compatible endpoint
+    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": final_prompt}]
+    yield from stream_chat(model, messages, client=client, stats=stats, default_provider="groq", temperature=float(temperature))
+
+
+def render_stream(placeholder, deltas):
+    # Render tokens as they arrive and return the full text
+    text = ""
+    for delta in deltas:
+        text += delta
+        placeholder.markdown(f"**Assistant:** {text}▌")
+    placeholder.markdown(f"**Assistant:** {text}")
+    return text
 
 
 def main():
@@ -125,7 +145,7 @@ def main():
     st.sidebar.header("Settings")
     k = st.sidebar.number_input("Number of results (k)", min_value=1, max_value=10, value=4)
     db_path = st.sidebar.text_input("FAISS folder path", value="chroma_db")
-    use_groq = st.sidebar.checkbox("Use Groq (aisuite) if available", value=True)
+    use_groq = st.sidebar.checkbox("Use Groq if available", value=True)
     # Prompt / model controls
     st.sidebar.markdown("---")
     system_prompt_input = st.sidebar.text_area("System prompt", value="你是我的筆記管理人，請根據提供內容並以台灣中文簡潔回覆。", height=120)
@@ -134,23 +154,74 @@ def main():
     openai_model = st.sidebar.text_input("OpenAI model", value="gpt-3.5-turbo")
     groq_model_input = st.sidebar.text_input("Groq model", value=os.getenv("GROQ_MODEL", "groq:openai/gpt-oss-120b"))
 
+    use_query_cache = st.sidebar.checkbox("Cache query embeddings / retrieval", value=True)
+    use_hybrid = st.sidebar.checkbox("Hybrid retrieval (BM25 + dense)", value=True)
+    default_reranker = os.getenv("RAG_RERANKER", "none")
+    reranker_kind = st.sidebar.selectbox(
+        "Reranker", options=RERANKERS, index=RERANKERS.index(default_reranker) if default_reranker in RERANKERS else 0
+    )
+    rerank_candidates = st.sidebar.number_input("Rerank candidates", min_value=4, max_value=100, value=20)
+    rerank_budget_ms = st.sidebar.number_input("Rerank time budget (ms)", min_value=0, max_value=5000, value=300, step=50)
+    tracer = get_tracer()
+
+    # Heavy imports, model and index loading run in a background thread; until they finish, reruns only show progress
+    startup = get_startup(db_path)
+    if not startup.ready:
+        if startup.state == FAILED:
+            st.error(f"Startup failed: {startup.error}")
+            return
+        st.info(startup.describe())
+        time.sleep(STARTUP_POLL_SECONDS)
+        st.rerun()
+    st.sidebar.caption(startup.describe())
+    resources = startup.result
+    for level, note in resources["notes"]:
+        getattr(st, level)(note)
+    # Already imported by the initializer, so these are cheap
+    from rag_query_cache import index_fingerprint
+    from rag_retrieval import format_timings, retrieve
+    from rag_answer_cache import chunk_signature, context_key
+    from rag_context import format_context_report
+    from rag_vectorstores import chunk_id_of
+
+    # The caches, packer and reranker are shared by every session, so the sidebar values are passed per call
+    answer_cache = resources["answer_cache"]
+    use_answer_cache = not st.sidebar.checkbox("Bypass answer cache", value=not answer_cache.enabled)
+    answer_threshold = st.sidebar.slider(
+        "Answer cache similarity threshold", min_value=0.80, max_value=1.0, value=float(answer_cache.threshold), step=0.01
+    )
+    # merge overlapping chunks, drop near-duplicates and cap the prompt context (0 = no limit)
+    context_packer = resources["context_packer"]
+    context_tokens = int(st.sidebar.number_input(
+        "Context token budget", min_value=0, max_value=32000, value=int(context_packer.max_tokens), step=250
+    ))
+    cache_stats_box = st.sidebar.empty()
+    batch_stats_box = st.sidebar.empty()
+    st.sidebar.markdown("**Latency by stage (recent requests)**")
+    trace_stats_box = st.sidebar.empty()
+
     # (Preset UI moved to the Chat panel)
 
-    with st.spinner("Loading vectorstore and embeddings..."):
-        store = load_vectorstore(db_path)
+    # Drop cached queries and reload the store when the index on disk was rebuilt
+    query_cache = resources["query_cache"]
+    if query_cache.sync(index_fingerprint(db_path, "chroma_db")):
+        get_startup.clear()
+        get_lexical_index.clear()
+        st.rerun()
 
+    store = resources["store"]
     if store is None:
         st.error("Vectorstore not available. Run rag01_create_vector_db.py first.")
         return
+    # The initializer falls back to chroma_db when FAISS can't load db_path
+    lexical = get_lexical_index(resources["store_path"]) if use_hybrid else None
+    reranker = get_reranker(reranker_kind, store.embeddings)
 
-    # Setup aisuite client if GROQ key is present and aisuite is installed
-    groq_key = os.getenv("GROQ_API_KEY")
+    # Setup a streaming Groq client if GROQ key (or a mock server via RAG_LLM_BASE_URL) is present
     groq_client = None
-    groq_model = os.getenv("GROQ_MODEL", "groq:openai/gpt-oss-120b")
-    if use_groq and groq_key and ai is not None:
-        os.environ["GROQ_API_KEY"] = groq_key
+    if use_groq:
         try:
-            groq_client = ai.Client()
+            groq_client = make_client("groq")
         except Exception:
             groq_client = None
 
@@ -164,7 +235,7 @@ def main():
     with left:
         st.subheader("Chat")
         # Demo preset selectbox placed above the chat input (fills the input but does not auto-send)
-        preset_options = ["", "GIT reset 怎麼寫？", "Vue 的 props 是甚麼用途", "AWS EC2 是甚麼？"]
+        preset_options = [""] + PRESET_QUESTIONS
         preset_choice = st.selectbox("Demo Preset Questions", options=preset_options, index=0, key="preset_select")
         if preset_choice:
             st.session_state["user_input"] = preset_choice
@@ -185,22 +256,21 @@ def main():
 
     if send and user_input.strip():
         st.session_state.history.append(("user", user_input))
+        trace = tracer.start("streamlit", question=user_input)
 
         # retrieval
         try:
-            # try retriever.invoke if available for newer vectorstore
-            retriever = None
-            try:
-                retriever = store.as_retriever(search_kwargs={"k": k})
-                if hasattr(retriever, "invoke"):
-                    docs = retriever.invoke(user_input)
-                else:
-                    docs = store.similarity_search(user_input, k=k)
-            except Exception:
-                docs = store.similarity_search(user_input, k=k)
+            timings = {}
+            docs = retrieve(store, user_input, k=k, lexical=lexical, cache=query_cache if use_query_cache else None,
+                            reranker=reranker, timings=timings, rerank_candidates=int(rerank_candidates),
+                            rerank_budget_ms=float(rerank_budget_ms))
+            st.caption(f"Retrieval: {format_timings(timings)}")
+            trace.add_retrieval(timings)
         except Exception as e:
             st.error(f"Retrieval failed: {e}")
+            trace.event("retrieval_error", error=str(e))
             docs = []
+        trace.set(chunk_ids=[chunk_id_of(d) for d in docs])
 
         # show retrieved
         snippets = []
@@ -211,46 +281,98 @@ def main():
         result_container.write("\n\n---\n\n".join(snippets) if snippets else "(no results)")
 
         # prepare prompt using sidebar inputs
-        system_prompt = system_prompt_input
-        retrieved_chunks = "\n\n".join([d.page_content for d in docs])
-        try:
-            final_prompt = prompt_template_input.format(retrieved_chunks=retrieved_chunks, question=user_input)
-        except Exception:
-            # if formatting fails, fall back to a simple concatenation
-            final_prompt = f"{prompt_template_input}\n\n{retrieved_chunks}\n\nQuestion: {user_input}"
+        with trace.span("prompt"):
+            system_prompt = system_prompt_input
+            retrieved_chunks, context_report = context_packer.pack(docs, max_tokens=context_tokens)
+            try:
+                final_prompt = prompt_template_input.format(retrieved_chunks=retrieved_chunks, question=user_input)
+            except Exception:
+                # if formatting fails, fall back to a simple concatenation
+                final_prompt = f"{prompt_template_input}\n\n{retrieved_chunks}\n\nQuestion: {user_input}"
+        st.caption(f"Prompt {format_context_report(context_report)}")
+        trace.set(context=context_report)
+
+        # semantic answer cache: reuse the answer of a paraphrased question with the same retrieved chunks
+        # (the query vector is only needed for the cache, so a bypassed cache skips the embedding)
+        answer_text, similarity = None, 0.0
+        if use_answer_cache:
+            with trace.span("answer_cache"):
+                query_vector = query_cache.get_vector(user_input) if use_query_cache else None
+                if query_vector is None:
+                    query_vector = store.embeddings.embed_query(user_input)
+                chunk_ids = chunk_signature(docs)
+                answer_context = context_key(
+                    groq_model_input if groq_client else "", openai_model, system_prompt, prompt_template_input,
+                    temperature, context_tokens,
+                )
+                answer_text, similarity = answer_cache.lookup(query_vector, chunk_ids, answer_context,
+                                                              threshold=answer_threshold)
+        cache_hit = answer_text is not None
+        trace.set(answer_cache_hit=cache_hit)
+        if cache_hit:
+            st.caption(f"Answer served from cache (similarity {similarity:.3f})")
 
         # generate answer: prefer groq if client available and enabled, else openai if key present
-        answer_text = None
-        if groq_client:
+        left.markdown(f"**You:** {user_input}")
+        answer_box = left.empty()
+        if cache_hit:
+            answer_box.markdown(f"**Assistant:** {answer_text}")
+        llm_stats = None
+
+        if not answer_text and groq_client:
             try:
                 with st.spinner("Generating answer via Groq..."):
-                    answer_text = generate_from_groq(groq_client, groq_model_input, system_prompt, final_prompt, temperature)
+                    llm_stats = StreamStats(*split_model(groq_model_input, "groq"))
+                    answer_text = render_stream(answer_box, generate_from_groq(
+                        groq_client, groq_model_input, system_prompt, final_prompt, temperature, stats=llm_stats))
             except Exception as e:
                 st.error(f"Groq generation failed: {e}")
+                trace.event("llm_error", provider="groq", error=str(e))
                 answer_text = None
 
         if not answer_text:
             openai_key = os.getenv("OPENAI_API_KEY")
-            if openai_key:
+            if openai_key or os.getenv("RAG_LLM_BASE_URL"):
+                if groq_client and not cache_hit:
+                    trace.event("fallback", from_provider="groq", to_provider="openai")
                 try:
                     with st.spinner("Generating answer via OpenAI..."):
-                        answer_text = generate_from_openai(final_prompt, model_name=openai_model, temperature=temperature)
+                        llm_stats = StreamStats("openai", openai_model)
+                        answer_text = render_stream(answer_box, generate_from_openai(
+                            final_prompt, model_name=openai_model, temperature=temperature, stats=llm_stats))
                 except Exception as e:
                     st.error(f"OpenAI generation failed: {e}")
+                    trace.event("llm_error", provider="openai", error=str(e))
                     answer_text = None
 
         if not answer_text:
             answer_text = "無法產生回覆：未設定或呼叫 LLM 失敗。"
-
-        # simulate progressive display (simple non-streaming chunked reveal)
-        st.session_state.history.append(("assistant", ""))
-        assistant_index = len(st.session_state.history) - 1
-        chunk_size = 200
-        for i in range(0, len(answer_text), chunk_size):
-            st.session_state.history[assistant_index] = ("assistant", answer_text[: i + chunk_size])
-            time.sleep(0.05)
-        # ensure final stored
-        st.session_state.history[assistant_index] = ("assistant", answer_text)
+            answer_box.markdown(f"**Assistant:** {answer_text}")
+        elif not cache_hit and use_answer_cache:
+            answer_cache.store(query_vector, chunk_ids, answer_text, llm_stats.total_seconds, answer_context)
+        if llm_stats is not None and llm_stats.ttft is not None:
+            st.caption(f"Time to first token: {llm_stats.ttft:.2f}s · total: {llm_stats.total_seconds:.2f}s")
+        trace.add_llm(llm_stats)
+        trace.finish("ok" if cache_hit or llm_stats is not None and llm_stats.end else "error")
+
+        st.session_state.history.append(("assistant", answer_text))
+
+    stats = query_cache.stats()
+    answer_stats = answer_cache.stats()
+    context_stats = context_packer.stats()
+    cache_stats_box.markdown(
+        f"**Query cache** — hits: {stats['hits']} / misses: {stats['misses']} "
+        f"({stats['hit_rate']:.0%}), entries: {stats['entries']}  \n"
+        f"**Answer cache** — hits: {answer_stats['hits']} / misses: {answer_stats['misses']} "
+        f"({answer_stats['hit_rate']:.0%}), saved LLM time: {answer_stats['saved_seconds']:.1f}s  \n"
+        f"**Context packing** — saved {context_stats['saved_tokens']} prompt tokens "
+        f"({context_stats['saved_ratio']:.0%}) over {context_stats['requests']} requests"
+    )
+    # queue depth, batch-size histogram and wait time of the shared query micro-batcher (RAG_EMBED_BATCH=0 disables it)
+    batch_report = getattr(resources["embedding"], "batch_report", None)
+    if batch_report is not None:
+        batch_stats_box.caption(batch_report())
+    trace_stats_box.markdown(format_stage_stats(tracer.stage_stats()))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+import numpy as np
+
+DEFAULT_TRACE_PATH = os.path.join("logs", "rag_traces.jsonl")
+DEFAULT_MAX_MB = 10
+DEFAULT_BACKUPS = 5
+# 側欄 / metrics 面板的 p50、p95 以最近幾筆請求計算
+DEFAULT_WINDOW = 500
+MAX_QUESTION_CHARS = 200
+
+# retrieve() 的 timings key -> trace 的階段名稱
+RETRIEVAL_STAGES = {
+    "embed_ms": "query_embedding",
+    "dense_ms": "vector_search",
+    "lexical_ms": "lexical_search",
+    "rerank_ms": "rerank",
+}
+
+
+class Trace:
+    """一次 RAG 請求的追蹤紀錄：各階段耗時（毫秒）、屬性（模型、token 數、chunk ID…）與事件（例如 fallback）。"""
+
+    def __init__(self, tracer, name, **attrs):
+        self.tracer = tracer
+        self.record = {
+            "trace_id": uuid.uuid4().hex,
+            "ts": time.time(),
+            "name": name,
+            "spans": {},
+            "events": [],
+            **attrs,
+        }
+        self._start = time.perf_counter()
+        self._finished = False
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add_span(stage, (time.perf_counter() - start) * 1000)
+
+    def add_span(self, stage, ms):
+        if ms is not None:
+            spans = self.record["spans"]
+            spans[stage] = spans.get(stage, 0.0) + float(ms)
+
+    def add_retrieval(self, timings):
+        """把 retrieve(timings=...) 的結果轉成 query_embedding / vector_search / lexical_search / rerank 階段。"""
+        for key, stage in RETRIEVAL_STAGES.items():
+            if key in timings:
+                self.add_span(stage, timings[key])
+        if "query_cache_hit" in timings:
+            self.set(query_cache_hit=timings["query_cache_hit"])
+
+    def add_llm(self, stats):
+        """記錄 StreamStats：TTFT、生成總耗時、provider/model 與 token 數。"""
+        if stats is None:
+            return
+        if stats.ttft is not None:
+            self.add_span("llm_ttft", stats.ttft * 1000)
+        self.add_span("llm", stats.total_seconds * 1000)
+        self.set(provider=stats.provider, model=stats.model, tokens=stats.token_counts())
+
+    def set(self, **attrs):
+        self.record.update(attrs)
+
+    def event(self, name, **attrs):
+        self.record["events"].append({"name": name, "at_ms": round(self._elapsed_ms(), 3), **attrs})
+
+    def finish(self, status="ok", error=None):
+        if self._finished:
+            return self.record
+        self._finished = True
+        self.record["status"] = status
+        if error is not None:
+            self.record["error"] = str(error)
+        self.record["total_ms"] = self._elapsed_ms()
+        self.tracer.emit(self.record)
+        return self.record
+
+    def _elapsed_ms(self):
+        return (time.perf_counter() - self._start) * 1000
+
+
+class Tracer:
+    """把 Trace 以 JSONL 寫入會輪替的檔案，並保留最近 `window` 筆各階段耗時供 p50/p95 統計。
+
+    檔案寫入交給背景執行緒（QueueHandler + QueueListener + RotatingFileHandler），
+    請求路徑只需要 json.dumps 與放進佇列。
+    """
+
+    def __init__(self, path=DEFAULT_TRACE_PATH, max_mb=DEFAULT_MAX_MB, backups=DEFAULT_BACKUPS,
+                 window=DEFAULT_WINDOW, enabled=True):
+        self.path = path
+        self.enabled = enabled
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._listener = None
+        self._logger = None
+        if enabled and path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            handler = RotatingFileHandler(path, maxBytes=int(max_mb * 1024 * 1024), backupCount=backups,
+                                          encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            log_queue = queue.SimpleQueue()
+            self._listener = QueueListener(log_queue, handler)
+            self._listener.start()
+            self._logger = logging.getLogger(f"rag_tracing.{id(self)}")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(QueueHandler(log_queue))
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv("RAG_TRACE_PATH", DEFAULT_TRACE_PATH),
+            max_mb=float(os.getenv("RAG_TRACE_MAX_MB", DEFAULT_MAX_MB)),
+            backups=int(os.getenv("RAG_TRACE_BACKUPS", DEFAULT_BACKUPS)),
+            window=int(os.getenv("RAG_TRACE_WINDOW", DEFAULT_WINDOW)),
+            enabled=os.getenv("RAG_TRACE", "1").lower() not in ("0", "false", "no", "off"),
+        )
+
+    def start(self, name, question=None, **attrs):
+        if question is not None:
+            attrs["question"] = question[:MAX_QUESTION_CHARS]
+        return Trace(self, name, **attrs)
+
+    def emit(self, record):
+        if not self.enabled:
+            return
+        with self._lock:
+            for stage, ms in list(record["spans"].items()) + [("total", record["total_ms"])]:
+                samples = self._samples.get(stage)
+                if samples is None:
+                    samples = self._samples[stage] = deque(maxlen=self.window)
+                samples.append(ms)
+        if self._logger is not None:
+            self._logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+    def stage_stats(self):
+        """回傳 {階段: {"count", "p50_ms", "p95_ms"}}（最近 window 筆）。"""
+        with self._lock:
+            samples = {stage: list(values) for stage, values in self._samples.items()}
+        stats = {}
+        for stage, values in samples.items():
+            p50, p95 = np.percentile(values, [50, 95])
+            stats[stage] = {"count": len(values), "p50_ms": float(p50), "p95_ms": float(p95)}
+        return stats
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+
+def format_stage_stats(stats):
+    """整理成 Markdown 表格，給 Gradio metrics 面板與 Streamlit 側欄使用。"""
+    if not stats:
+        return "尚無追蹤資料。"
+    lines = ["| stage | n | p50 ms | p95 ms |", "|---|---|---|---|"]
+    for stage in sorted(stats, key=lambda s: (s == "total", s)):
+        s = stats[stage]
+        lines.append(f"| {stage} | {s['count']} | {s['p50_ms']:.1f} | {s['p95_ms']:.1f} |")
+    return "\n".join(lines)
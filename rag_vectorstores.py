@@ -0,0 +1,209 @@
+import os
+import time
+
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+
+from rag_docstore import STORE_MANIFEST_NAME, read_store_manifest, write_store_manifest
+from rag_faiss_index import DEFAULT_INDEX_SPEC, DEFAULT_TRAIN_SAMPLE, INDEX_NAME, load_flat_store, load_store, save_store
+
+# Try to import Chroma from community or core
+try:
+    from langchain_community.vectorstores import Chroma
+except Exception:
+    try:
+        from langchain.vectorstores import Chroma
+    except Exception:
+        Chroma = None
+
+
+class FaissWriter:
+    """寫入 FAISS 的薄包裝：第一批資料才建立索引，flush() 時存檔。
+
+    寫入期間一律使用 flat 索引（可新增/刪除）；`index_spec` 不是 Flat 時，
+    最後一次 flush(final=True) 才訓練並存成 HNSW/IVF/IVF-PQ 索引（見 rag_faiss_index）。
+    """
+
+    name = "faiss"
+
+    def __init__(self, path, embedding, load_existing=False, index_spec=DEFAULT_INDEX_SPEC, search_params="",
+                 train_sample=DEFAULT_TRAIN_SAMPLE):
+        self.path = path
+        self.embedding = embedding
+        self.index_spec = index_spec
+        self.search_params = search_params
+        self.train_sample = train_sample
+        self.store = None
+        if load_existing:
+            self.store = load_flat_store(path, embedding)
+
+    def delete(self, ids):
+        if self.store is None:
+            return 0
+        ids = set(ids) & set(self.store.index_to_docstore_id.values())
+        if ids:
+            self.store.delete(list(ids))
+        return len(ids)
+
+    def add(self, docs, ids):
+        if not docs:
+            return
+        if self.store is None:
+            self.store = FAISS.from_documents(docs, self.embedding, ids=ids)
+        else:
+            self.store.add_documents(docs, ids=ids)
+
+    def add_embeddings(self, docs, ids, vectors):
+        """以已算好的向量寫入（MultiWriter 共用同一次 embedding 結果）。"""
+        if not docs:
+            return
+        pairs = list(zip((d.page_content for d in docs), vectors))
+        metadatas = [d.metadata for d in docs]
+        if self.store is None:
+            self.store = FAISS.from_embeddings(pairs, self.embedding, metadatas=metadatas, ids=ids)
+        else:
+            self.store.add_embeddings(pairs, metadatas=metadatas, ids=ids)
+
+    def flush(self, final=True):
+        # 串流建置的中途 checkpoint 先存 flat 索引，避免每次都重新訓練 ANN 索引
+        if self.store is not None:
+            save_store(self.store, self.path, self.index_spec if final else DEFAULT_INDEX_SPEC,
+                       self.search_params, self.train_sample)
+
+
+class ChromaWriter:
+    """寫入 Chroma 的薄包裝；Chroma 以 upsert 寫入，重複寫入相同 ID 不會產生重複區塊。"""
+
+    name = "chroma"
+
+    def __init__(self, path, embedding):
+        if Chroma is None:
+            raise ImportError("找不到 Chroma vectorstore 套件 (chromadb). 請先安裝 chromadb。")
+        self.path = path
+        self.store = Chroma(persist_directory=path, embedding_function=embedding)
+
+    def delete(self, ids):
+        ids = list(ids)
+        if ids:
+            self.store.delete(ids=ids)
+        return len(ids)
+
+    def add(self, docs, ids):
+        if docs:
+            self.store.add_documents(docs, ids=ids)
+
+    def add_embeddings(self, docs, ids, vectors):
+        """以已算好的向量 upsert（LangChain 的 Chroma 沒有 add_embeddings，直接寫入 collection）。"""
+        if docs:
+            self.store._collection.upsert(
+                ids=list(ids),
+                embeddings=[[float(x) for x in v] for v in vectors],
+                documents=[d.page_content for d in docs],
+                metadatas=[d.metadata for d in docs],
+            )
+
+    def flush(self, final=True):
+        try:
+            self.store.persist()
+        except Exception:
+            pass
+        write_store_manifest(self.path, "chroma")
+
+
+class MultiWriter:
+    """同一批區塊只計算一次 embeddings，再以相同的向量與 chunk ID 寫入多個向量資料庫。
+
+    `timings` 累計各階段耗時（秒），例如 "embed"、"faiss write"、"chroma flush"。
+    """
+
+    def __init__(self, writers, embedding):
+        self.writers = list(writers)
+        self.embedding = embedding
+        self.name = "+".join(w.name for w in self.writers)
+        # 串流建置的 checkpoint 放在第一個 backend 的資料夾
+        self.path = self.writers[0].path
+        self.timings = {}
+
+    @property
+    def store(self):
+        return self.writers[0].store
+
+    def _timed(self, stage, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+    def delete(self, ids):
+        ids = list(ids)
+        return max(self._timed(f"{w.name} write", w.delete, ids) for w in self.writers)
+
+    def add(self, docs, ids):
+        if not docs:
+            return
+        vectors = self._timed("embed", self.embedding.embed_documents, [d.page_content for d in docs])
+        for w in self.writers:
+            self._timed(f"{w.name} write", w.add_embeddings, docs, ids, vectors)
+
+    def flush(self, final=True):
+        for w in self.writers:
+            self._timed(f"{w.name} flush", w.flush, final)
+
+
+def store_chunk_ids(store):
+    """回傳向量資料庫內所有 chunk ID 的集合（FAISS 與 Chroma 皆可），用來確認多個 backend 內容一致。"""
+    if store is None:
+        return set()
+    mapping = getattr(store, "index_to_docstore_id", None)
+    if mapping is not None:
+        return set(mapping.values())
+    return set(store.get(include=[])["ids"])
+
+
+def detect_backend(path):
+    """依 store.json 判斷向量資料庫的 backend；舊資料夾沒有 store.json 時依檔案判斷。"""
+    manifest = read_store_manifest(path)
+    if manifest is not None:
+        return manifest.get("backend")
+    if os.path.exists(os.path.join(path, INDEX_NAME)):
+        return "faiss"
+    if os.path.exists(os.path.join(path, "chroma.sqlite3")):
+        return "chroma"
+    return None
+
+
+def open_vectorstore(path, embedding):
+    """以查詢端（唯讀）方式開啟 faiss_db 或 chroma_db。"""
+    backend = detect_backend(path)
+    if backend == "faiss":
+        return load_store(path, embedding)
+    if backend == "chroma":
+        if Chroma is None:
+            raise ImportError("找不到 Chroma vectorstore 套件 (chromadb). 請先安裝 chromadb。")
+        return Chroma(persist_directory=path, embedding_function=embedding)
+    raise FileNotFoundError(f"{path} 不是向量資料庫（找不到 {STORE_MANIFEST_NAME}），請先執行 rag01_* 建立。")
+
+
+def get_documents_by_ids(store, ids):
+    """依 chunk ID 取回 Document（保持 ids 順序），找不到的 ID 會被略過。"""
+    if not ids:
+        return []
+    docstore = getattr(store, "docstore", None)
+    if docstore is not None:
+        docs = [docstore.search(i) for i in ids]
+        return [d for d in docs if isinstance(d, Document)]
+    if hasattr(store, "get"):
+        # Chroma
+        result = store.get(ids=list(ids), include=["documents", "metadatas"])
+        by_id = {
+            i: Document(id=i, page_content=text, metadata=meta or {})
+            for i, text, meta in zip(result["ids"], result["documents"], result["metadatas"])
+        }
+        return [by_id[i] for i in ids if i in by_id]
+    return store.get_by_ids(list(ids))
+
+
+def chunk_id_of(doc):
+    """回傳 Document 的 chunk ID（向量資料庫 ID 或建置時寫入的 metadata），沒有則為 None。"""
+    return getattr(doc, "id", None) or doc.metadata.get("chunk_id")
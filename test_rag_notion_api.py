@@ -0,0 +1,125 @@
+import time
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("notion_client")
+from notion_client.errors import HTTPResponseError
+
+import rag_notion_api
+from rag_notion_api import RateLimitedClient, TokenBucket, iter_database_items, query_database, retry_after_seconds
+from rag_fake_notion_server import DATABASE_ID, fail_next, page_id_for, serve_in_background
+
+
+@pytest.fixture
+def fake_notion():
+    server, base_url = serve_in_background(port=0, pages=250)
+    yield server, base_url
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(base_url, max_retries=2):
+    # bucket 容量夠大，測試中不會因限速而等待
+    return RateLimitedClient({"auth": "fake", "base_url": base_url}, bucket=TokenBucket(1000, 1000),
+                             max_retries=max_retries)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+    # time 模組與 fake server 共用；server 的 latency 為 0，只記錄非零的等待
+    monkeypatch.setattr(rag_notion_api.time, "sleep", lambda seconds: seconds and recorded.append(seconds))
+    return recorded
+
+
+def test_429_waits_for_retry_after(fake_notion, sleeps):
+    server, base_url = fake_notion
+    client = make_client(base_url)
+    fail_next(server, 429, retry_after="1.5")
+
+    resp = query_database(client, DATABASE_ID, page_size=10)
+
+    assert len(resp["results"]) == 10
+    assert client.retries == 1
+    assert 1.5 <= sleeps[0] <= 1.75
+
+
+def test_503_backs_off_then_gives_up(fake_notion, sleeps):
+    server, base_url = fake_notion
+    client = make_client(base_url, max_retries=2)
+    fail_next(server, 503, count=3)
+
+    with pytest.raises(HTTPResponseError) as excinfo:
+        query_database(client, DATABASE_ID)
+
+    assert excinfo.value.status == 503
+    assert client.retries == 2
+    assert server.RequestHandlerClass.stats["requests"] == 3
+    assert 0.5 <= sleeps[0] <= 0.75 and 1.0 <= sleeps[1] <= 1.25
+
+
+def test_503_recovers_within_max_retries(fake_notion, sleeps):
+    server, base_url = fake_notion
+    client = make_client(base_url, max_retries=2)
+    fail_next(server, 503, count=2)
+
+    assert query_database(client, DATABASE_ID, page_size=5)["results"]
+    assert client.retries == 2
+
+
+def test_retry_after_parsing():
+    assert retry_after_seconds(SimpleNamespace(headers={"retry-after": "2"})) == 2.0
+    assert retry_after_seconds(SimpleNamespace(headers=None)) is None
+    assert retry_after_seconds(SimpleNamespace()) is None
+    assert retry_after_seconds(SimpleNamespace(headers={"retry-after": "soon"})) is None
+    http_date = formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= retry_after_seconds(SimpleNamespace(headers={"retry-after": http_date})) <= 30
+    past = formatdate(time.time() - 30, usegmt=True)
+    assert retry_after_seconds(SimpleNamespace(headers={"retry-after": past})) == 0.0
+
+
+def test_unparsable_retry_after_falls_back_to_backoff(fake_notion, sleeps):
+    server, base_url = fake_notion
+    client = make_client(base_url)
+    fail_next(server, 429, retry_after="not-a-date")
+
+    assert query_database(client, DATABASE_ID, page_size=1)["results"]
+    assert 0.5 <= sleeps[0] <= 0.75
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=20, burst=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    elapsed = time.monotonic() - start
+    # 第一個 token 立即可用，其餘 10 個每個間隔 1/20 秒
+    assert 0.45 <= elapsed < 1.0
+
+
+def test_pagination_returns_every_page_once(fake_notion):
+    server, base_url = fake_notion
+    client = make_client(base_url)
+
+    ids = [item["id"] for item in iter_database_items(client, DATABASE_ID, page_size=100)]
+
+    assert ids == [page_id_for(i) for i in range(250)]
+    assert server.RequestHandlerClass.stats["requests"] == 3
+
+
+def test_next_cursor_is_prefetched(fake_notion):
+    server, base_url = fake_notion
+    client = make_client(base_url)
+    stats = server.RequestHandlerClass.stats
+
+    items = iter_database_items(client, DATABASE_ID, page_size=100)
+    next(items)
+    deadline = time.monotonic() + 5
+    while stats["requests"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # 仍在處理第一頁時，第二頁的查詢已經送出
+    assert stats["requests"] == 2
+    assert len(list(items)) == 249
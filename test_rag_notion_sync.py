@@ -0,0 +1,53 @@
+import os
+import json
+
+import pytest
+
+pytest.importorskip("notion_client")
+pytest.importorskip("notion2md")
+
+from rag03_notion_to_pdf import fetch_notion_database_as_pdfs
+from rag_notion_sync import ChangeList, NotionSync, NotionSyncState
+from rag_fake_notion_server import DATABASE_ID, archive_page, serve_in_background, touch_page
+
+
+@pytest.fixture
+def fake_notion(monkeypatch):
+    server, base_url = serve_in_background(port=0, pages=3)
+    monkeypatch.setenv("NOTION_API_BASE_URL", base_url)
+    monkeypatch.setenv("NOTION_TOKEN", "fake")
+    monkeypatch.setenv("NOTION_RATE_LIMIT", "1000")
+    monkeypatch.setenv("NOTION_EXPORT_FORMAT", "md")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run_sync(tmp_path):
+    sync = NotionSync(NotionSyncState.load(str(tmp_path / "state.json")),
+                      ChangeList.load(str(tmp_path / "changes.json")))
+    fetch_notion_database_as_pdfs(DATABASE_ID, str(tmp_path / "docs"), workers=2, sync=sync)
+    with open(tmp_path / "changes.json", "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_sync_reexports_touched_and_removes_archived(fake_notion, tmp_path):
+    docs = tmp_path / "docs"
+    docs.mkdir()
+
+    first = run_sync(tmp_path)
+    assert first["changed"] == ["Fake Page 0.md", "Fake Page 1.md", "Fake Page 2.md"]
+    # 建置腳本用完變更清單後會清除
+    os.remove(tmp_path / "changes.json")
+
+    edited = "2999-01-01T00:00:00.000Z"
+    touch_page(fake_notion, 1, edited)
+    archive_page(fake_notion, 2)
+    second = run_sync(tmp_path)
+
+    assert second["changed"] == ["Fake Page 1.md"]
+    assert second["removed"] == ["Fake Page 2.md"]
+    assert sorted(os.listdir(docs)) == ["Fake Page 0.md", "Fake Page 1.md"]
+    assert edited in (docs / "Fake Page 1.md").read_text(encoding="utf-8")
+    state = NotionSyncState.load(str(tmp_path / "state.json"))
+    assert len(state.page_ids(DATABASE_ID)) == 2